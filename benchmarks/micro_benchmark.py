@@ -0,0 +1,278 @@
+"""
+Micro-benchmarks for the analysis and raster hot paths.
+
+Runs offline on synthetic data: the analysis functions across series
+lengths and the raster functions across raster sizes.  Results (the best
+of --repeat runs of each case) are written as JSON, and can be compared
+against a saved baseline:
+
+    python benchmarks/micro_benchmark.py --out /tmp/before.json
+    # ... make a change ...
+    python benchmarks/micro_benchmark.py --baseline /tmp/before.json
+
+The defaults keep a run to a few minutes.  For the full range:
+
+    python benchmarks/micro_benchmark.py --lengths 10 30 100 500 \
+        --sizes 256 1024 4096 8192
+
+apply_grid and data2raster work a point at a time, so above --max-points
+pixels they're run on a random sample of that many points (each result
+records its number of points).
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import classes
+import utils
+
+LENGTHS = [10, 30, 100]
+SIZES = [256, 1024]
+MAX_POINTS = 1000000
+LINE_COST = 10
+TARGET_DATE = utils.parse_date('2000-07-01')
+INDEX_EQN = 'B4 - B3'
+LABEL_RULES = [
+    classes.LabelRule({'name': 'fd', 'val': 1, 'change_type': 'FD'}),
+    classes.LabelRule({'name': 'gd', 'val': 2, 'change_type': 'GD',
+                       'duration': ['<', 4], 'pre_threshold': ['>', 0]}),
+    classes.LabelRule({'name': 'ld', 'val': 3, 'change_type': 'LD'})
+]
+REGRESSION_TOLERANCE = 0.1  # fraction slower than baseline to flag
+
+
+def best_of(fn, repeat, setup=None):
+    """
+    Given a function, a number of runs and an optional setup function
+    (run untimed before each run), return the fastest run in seconds
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def synthetic_pix_datas(length, seed=0):
+    """
+    Given a series length, return pix_datas (see utils.analyze) for a
+    pixel with one scene a year: a noisy recovery with a disturbance in
+    the middle and a spike
+    """
+    rand = np.random.RandomState(seed)
+    vals = np.linspace(100, 200, length) + rand.normal(0, 5, length)
+    vals[length // 2:] -= 80
+    vals[length // 4] += 150
+    return [
+        {'date': utils.date2code(utils.parse_date('%s-07-01' % (1900 + i))),
+         'val': float(val)}
+        for i, val in enumerate(vals)
+    ]
+
+
+def synthetic_raster(size, out_fn, num_bands=6):
+    """
+    Given a size and an output filename, write a (size x size) multi-band
+    int16 raster of random reflectances and return its metadata
+    """
+    meta = {
+        'geotransform': [0, 30, 0, 0, 0, -30],
+        'size': [size, size],
+        'projection': ''
+    }
+    rand = np.random.RandomState(0)
+    ds = utils.create_raster(out_fn, meta, num_bands=num_bands,
+                             data_type=gdal.GDT_Int16, compress=False)
+    for b in range(1, num_bands + 1):
+        ds.GetRasterBand(b).WriteArray(
+            rand.randint(0, 10000, (size, size)).astype(np.int16), 0, 0)
+    ds = None
+    return meta
+
+
+def sample_mask(size, max_points):
+    """
+    Given a raster size, return None (every pixel) or, for rasters with
+    more than max_points pixels, a boolean array picking a random
+    max_points of them
+    """
+    if size * size <= max_points:
+        return None
+    rand = np.random.RandomState(0)
+    flat = np.zeros(size * size, dtype=bool)
+    flat[rand.choice(size * size, max_points, replace=False)] = True
+    return flat.reshape((size, size))
+
+
+def bench_series(length, repeat):
+    """
+    Given a series length, time the analysis hot paths on one pixel
+    """
+    pix_datas = synthetic_pix_datas(length)
+    ts = utils.dicts2timeseries(
+        utils.pick_winners(pix_datas, TARGET_DATE))
+    int_series = utils.timeseries2int_series(utils.despike(ts))
+    trendline = utils.analyze(pix_datas, LINE_COST, TARGET_DATE)
+
+    return {
+        'segmented_least_squares': best_of(
+            lambda: utils.segmented_least_squares(int_series, LINE_COST),
+            repeat),
+        'analyze': best_of(
+            lambda: utils.analyze(pix_datas, LINE_COST, TARGET_DATE), repeat),
+        'despike': best_of(lambda: utils.despike(ts), repeat),
+        'match_rule': best_of(
+            lambda: [trendline.match_rule(lr) for lr in LABEL_RULES], repeat),
+        'change_labeling': best_of(
+            lambda: utils.change_labeling(trendline, LABEL_RULES), repeat)
+    }
+
+
+def bench_raster(size, repeat, max_points, out_dir):
+    """
+    Given a raster size, time the raster hot paths on a synthetic scene
+    """
+    rast_fn = os.path.join(out_dir, 'scene.tif')
+    meta = synthetic_raster(size, rast_fn)
+    results = {}
+
+    index_fn = os.path.join(out_dir, 'index.tif')
+    results['rast_algebra'] = best_of(
+        lambda: utils.rast_algebra(rast_fn, INDEX_EQN, out_fn=index_fn),
+        repeat)
+
+    mask = sample_mask(size, max_points)
+    points = size * size if mask is None else max_points
+    grid_fn = utils.meta2grid(
+        meta, mask, out_csv=os.path.join(out_dir, 'grid.csv'))
+    results['apply_grid'] = best_of(
+        lambda: list(utils.apply_grid(index_fn, grid_fn, {'date': 0})),
+        repeat)
+
+    wkts = pd.read_csv(grid_fn)['pix_ctr_wkt']
+    data = [{'pix_ctr_wkt': wkt, 'value': i % 100}
+            for i, wkt in enumerate(wkts)]
+    results['data2raster'] = best_of(
+        lambda: utils.data2raster(
+            data, index_fn, os.path.join(out_dir, 'out.tif')),
+        repeat)
+
+    zip_fn = utils.compress([rast_fn], os.path.join(out_dir, 'scene.zip'))
+    unzip_dir = os.path.join(out_dir, 'decompressed')
+    results['decompress'] = best_of(
+        lambda: utils.decompress(zip_fn, unzip_dir), repeat,
+        setup=lambda: shutil.rmtree(unzip_dir, ignore_errors=True))
+
+    return results, points
+
+
+def run(lengths, sizes, repeat, max_points, out_dir='/tmp/micro_benchmark'):
+    """
+    Run every benchmark and return the results in the format:
+    {
+        'meta': {...},
+        'results': {'<function>/<length or size>': {'seconds': X, ...}, ...}
+    }
+    """
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    results = {}
+    for length in lengths:
+        for name, seconds in bench_series(length, repeat).iteritems():
+            results['%s/%s' % (name, length)] = {
+                'seconds': seconds, 'length': length}
+    for size in sizes:
+        timings, points = bench_raster(size, repeat, max_points, out_dir)
+        for name, seconds in timings.iteritems():
+            result = {'seconds': seconds, 'size': size}
+            if name in ('apply_grid', 'data2raster'):
+                result['points'] = points
+            results['%s/%s' % (name, size)] = result
+
+    shutil.rmtree(out_dir)
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'gdal': gdal.__version__,
+            'repeat': repeat
+        },
+        'results': results
+    }
+
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Given benchmark results and saved baseline results (see run), return
+    a list of lines comparing each case and the number of cases more than
+    tolerance (a fraction) slower than the baseline
+    """
+    lines = ['%-32s %10s %10s %8s' % ('case', 'baseline', 'seconds', 'ratio')]
+    regressions = 0
+    for case in sorted(results['results']):
+        seconds = results['results'][case]['seconds']
+        if case not in baseline['results']:
+            lines.append('%-32s %10s %10.4f %8s' % (case, '-', seconds, 'new'))
+            continue
+        base = baseline['results'][case]['seconds']
+        ratio = seconds / base if base else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions += 1
+            flag = ' SLOWER'
+        elif ratio < 1 - tolerance:
+            flag = ' faster'
+        lines.append('%-32s %10.4f %10.4f %7.2fx%s' % (
+            case, base, seconds, ratio, flag))
+    return lines, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the analysis and raster hot paths')
+    parser.add_argument('--lengths', type=int, nargs='+', default=LENGTHS,
+                        help='Series lengths (years) for the analysis cases')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Width/height of the synthetic rasters')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each case (the fastest is kept)')
+    parser.add_argument('--max-points', type=int, default=MAX_POINTS,
+                        help='Most points to sample/write per raster')
+    parser.add_argument('--out', help='Write the results JSON here')
+    parser.add_argument('--baseline',
+                        help='Compare against results JSON saved with --out')
+    parser.add_argument('--tolerance', type=float,
+                        default=REGRESSION_TOLERANCE,
+                        help='Fraction slower than the baseline to flag')
+    args = parser.parse_args()
+
+    results = run(args.lengths, args.sizes, args.repeat, args.max_points)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        for line in lines:
+            print line
+        sys.exit(1 if regressions else 0)
+    elif not args.out:
+        print json.dumps(results, indent=2, sort_keys=True)
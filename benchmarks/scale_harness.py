@@ -0,0 +1,179 @@
+"""
+End-to-end scale harness.
+
+Runs the whole MRLandTrendrJob on synthetic stacks (see synthetic_stack)
+of growing size and scene count, against a local directory standing in
+for S3 (see settings.LOCAL_STORAGE_ENV), and reports each run's wall time,
+peak memory and label accuracy against the planted disturbances:
+
+    python benchmarks/scale_harness.py --sizes 64 128 --years 10 20 \
+        --scenes-per-year 1 2 --out /tmp/scale.json
+
+Each job runs in its own `land_trendr.py run` process, so its peak memory
+(the largest resident set of it and the tasks it waited for) is measured
+on its own.  Job output goes to <storage>/<job>/output/.
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from osgeo import gdal
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+import settings as s
+import utils
+import synthetic_stack
+
+LABEL_NAME = 'gd'
+JOB_SETTINGS = {
+    'index_eqn': synthetic_stack.INDEX_EQN,
+    'line_cost': 10,
+    'target_date': '2000-07-01',
+    'label_rules': [
+        {'name': LABEL_NAME, 'val': 1, 'change_type': 'GD'}
+    ]
+}
+
+
+def clear_cache(job):
+    """
+    Delete the local copies of a job's files in settings.WORK_DIR (see
+    utils.keyname2filename) and the directories its archives were
+    decompressed to, so the job reads the inputs staged for this run
+    instead of the ones an earlier run with the same name left behind
+    """
+    for fn in glob.glob(utils.keyname2filename(job + '/') + '*'):
+        if os.path.isdir(fn):
+            shutil.rmtree(fn)
+        else:
+            os.remove(fn)
+
+
+def stage_job(storage_dir, job, stack):
+    """
+    Given the local storage directory, a job name and a synthetic stack
+    (see synthetic_stack.generate), put the stack's archives and the
+    job's settings.json where the job will look for them, and clear any
+    cached copies of an earlier run's (see clear_cache)
+    """
+    clear_cache(job)
+    job_dir = os.path.join(storage_dir, job)
+    if os.path.exists(job_dir):
+        shutil.rmtree(job_dir)
+    rasts_dir = os.path.join(storage_dir, s.IN_RASTS % job)
+    os.makedirs(rasts_dir)
+    for fn in stack['scenes'] + stack['masks']:
+        shutil.move(fn, os.path.join(rasts_dir, os.path.basename(fn)))
+    with open(os.path.join(storage_dir, s.IN_SETTINGS % job), 'w') as f:
+        json.dump(JOB_SETTINGS, f)
+
+
+def run_job(storage_dir, job, platform, log_fn):
+    """
+    Run a job in its own process and return (wall seconds, peak RSS in KB)
+    """
+    env = dict(os.environ)
+    env[s.LOCAL_STORAGE_ENV] = storage_dir
+    env['LT_JOB'] = job
+    start = time.time()
+    with open(log_fn, 'w') as log:
+        proc = subprocess.Popen(
+            [sys.executable, 'land_trendr.py', 'run', '-p', platform,
+             '-j', job],
+            cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    seconds = time.time() - start
+    if status:
+        raise Exception('Job %s failed, see %s' % (job, log_fn))
+    return seconds, rusage.ru_maxrss
+
+
+def read_labels(storage_dir, job):
+    """
+    Given the local storage directory and a finished job, return its
+    label arrays (see synthetic_stack.label_accuracy)
+    """
+    labels = {}
+    for key in synthetic_stack.TRUTH_KEYS:
+        rast_fn = os.path.join(storage_dir, s.OUT_RAST_KEYNAME % (
+            job, '%s_%s' % (LABEL_NAME, key)))
+        labels[key] = utils.ds2array(gdal.Open(rast_fn)).astype(float)
+    return labels
+
+
+def run(storage_dir, sizes, years, scenes_per_year, platform,
+        disturbances, work_dir='/tmp/scale_harness'):
+    """
+    Run a job for every combination of size, years and scenes per year
+    and return a list of results in the format:
+    {'job': X, 'size': X, 'years': X, 'scenes': X, 'pixels': X,
+     'seconds': X, 'peak_rss_kb': X, 'accuracy': {...}}
+    """
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    results = []
+    for size, num_years, per_year in itertools.product(
+            sizes, years, scenes_per_year):
+        job = 'scale-%spx-%syr-%sper' % (size, num_years, per_year)
+        stack = synthetic_stack.generate(
+            os.path.join(work_dir, job), size, num_years, per_year,
+            disturbances)
+        stage_job(storage_dir, job, stack)
+
+        seconds, peak_rss_kb = run_job(
+            storage_dir, job, platform, os.path.join(work_dir, job + '.log'))
+        accuracy = synthetic_stack.label_accuracy(
+            stack['truth'], read_labels(storage_dir, job))
+        results.append({
+            'job': job,
+            'size': size,
+            'years': num_years,
+            'scenes': len(stack['scenes']),
+            'pixels': size * size,
+            'seconds': seconds,
+            'peak_rss_kb': peak_rss_kb,
+            'accuracy': accuracy
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run LandTrendr jobs on growing synthetic stacks')
+    parser.add_argument('--storage', default='/tmp/lt_storage',
+                        help='Directory standing in for the S3 bucket')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128],
+                        help='Width/height of the scenes')
+    parser.add_argument('--years', type=int, nargs='+', default=[10, 20],
+                        help='Years in the stack')
+    parser.add_argument('--scenes-per-year', type=int, nargs='+',
+                        default=[1])
+    parser.add_argument('--platform', default='inline',
+                        choices=['inline', 'local'])
+    parser.add_argument('--disturbances', type=int, default=8,
+                        help='Number of disturbance patches to plant')
+    parser.add_argument('--out', help='Write the results JSON here')
+    args = parser.parse_args()
+
+    results = run(args.storage, args.sizes, args.years, args.scenes_per_year,
+                  args.platform, args.disturbances)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    print '%-28s %7s %9s %10s %7s %7s %7s' % (
+        'job', 'scenes', 'seconds', 'peak MB', 'recall', 'fp', 'onset')
+    for r in results:
+        acc = r['accuracy']
+        print '%-28s %7d %9.1f %10.1f %7.3f %7.3f %7.3f' % (
+            r['job'], r['scenes'], r['seconds'], r['peak_rss_kb'] / 1024.0,
+            acc['recall'] or 0, acc['false_positive_rate'] or 0,
+            acc['onset_year'] or 0)
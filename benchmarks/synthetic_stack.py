@@ -0,0 +1,236 @@
+"""
+Synthetic Landsat stack generator.
+
+Writes georeferenced 6-band scene archives and cloud masks with
+LEDAPS-style filenames (see settings.RAST_TRIGGER/MASK_TRIGGER), with
+disturbances of known onset, magnitude and duration planted in them, plus
+the truth rasters to check a job's labels against (see label_accuracy).
+
+The scenes' "B4 - B3" index (INDEX_EQN) is a stable baseline plus noise,
+except in square patches where it drops by the patch's magnitude over its
+duration (starting after its onset year) and then partly recovers.
+Cloudy pixels are masked and saturated.
+
+    python benchmarks/synthetic_stack.py --size 256 --years 20 \
+        --out-dir /tmp/synthetic_stack
+"""
+import argparse
+import os
+import sys
+import tarfile
+
+import numpy as np
+from osgeo import gdal, osr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import settings as s
+import utils
+
+INDEX_EQN = 'B4 - B3'
+FIRST_YEAR = 1990
+TARGET_DOY = 182  # scenes are spread around July 1st
+SCENE_NAME = 'LE7045029_%s_%03d_20140101_000000_%s.tif'  # % (yr, doy, trigger)
+EPSG = 32610  # UTM zone 10N
+ORIGIN = (500000, 5000000)
+PIX_SIZE = 30
+
+BASELINE = 2500  # undisturbed index value
+NOISE = 40  # standard deviation of the index noise
+MAGNITUDES = (800, 2000)  # range of planted index drops
+DURATIONS = (1, 4)  # range of planted durations, in years
+RECOVERY = 0.5  # fraction of the magnitude recovered ...
+RECOVERY_YEARS = 10  # ... over this many years after the drop
+TRUTH_KEYS = ['onset_year', 'magnitude', 'duration']
+
+
+def grid_meta(size):
+    """
+    Given a raster size, return the metadata (see utils.rast2meta) of
+    the synthetic scenes
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    return {
+        'geotransform': [ORIGIN[0], PIX_SIZE, 0, ORIGIN[1], 0, -PIX_SIZE],
+        'size': [size, size],
+        'projection': srs.ExportToWkt()
+    }
+
+
+def plant_disturbances(size, years, count, rand):
+    """
+    Given a raster size, the years of the stack, a number of disturbances
+    and a numpy RandomState, return the truth arrays in the format:
+        {'onset_year': <array>, 'magnitude': <array>, 'duration': <array>}
+    (NODATA outside the planted patches).  Later patches overwrite earlier
+    ones where they overlap.
+    """
+    truth = dict([(k, utils.nodata_array((size, size))) for k in TRUTH_KEYS])
+    patch = max(size // 16, 2)
+    for i in range(count):
+        duration = rand.randint(DURATIONS[0], DURATIONS[1] + 1)
+        # keep a few undisturbed years on either side
+        onset_year = rand.randint(years[0] + 2, years[-1] - duration - 1)
+        x, y = rand.randint(0, size - patch, 2)
+        window = (slice(y, y + patch), slice(x, x + patch))
+        truth['onset_year'][window] = onset_year
+        truth['magnitude'][window] = rand.randint(*MAGNITUDES)
+        truth['duration'][window] = duration
+    return truth
+
+
+def index_for_year(truth, year):
+    """
+    Given the truth arrays and a year, return the noise-free index value
+    of every pixel in that year
+    """
+    index = np.ones(truth['onset_year'].shape) * BASELINE
+    planted = truth['onset_year'] != s.NODATA
+    onset = truth['onset_year'][planted]
+    magnitude = truth['magnitude'][planted]
+    duration = truth['duration'][planted]
+
+    # linear drop after the onset year, then a linear partial recovery
+    into_drop = np.clip((year - onset) / duration, 0, 1)
+    into_recovery = np.clip(
+        (year - onset - duration) / float(RECOVERY_YEARS), 0, 1)
+    index[planted] -= magnitude * (into_drop - RECOVERY * into_recovery)
+    return index
+
+
+def write_archive(arrays, meta, tif_fn, data_type=gdal.GDT_Int16):
+    """
+    Given a list of band arrays, grid metadata and a tif filename, write
+    the bands to the tif, tar.gz it and return the archive's filename
+    """
+    ds = utils.create_raster(tif_fn, meta, num_bands=len(arrays),
+                             data_type=data_type, compress=False)
+    for b, arr in enumerate(arrays, 1):
+        ds.GetRasterBand(b).WriteArray(arr, 0, 0)
+    ds = None
+
+    archive_fn = tif_fn + '.tar.gz'
+    tar = tarfile.open(archive_fn, 'w:gz')
+    tar.add(tif_fn, os.path.basename(tif_fn))
+    tar.close()
+    os.remove(tif_fn)
+    return archive_fn
+
+
+def cloud_mask(size, fraction, rand):
+    """
+    Given a raster size, the fraction of it to cover and a numpy
+    RandomState, return a mask (0 - cloud, 1 - clear) of blocky clouds
+    """
+    block = max(size // 32, 1)
+    blocks = -(-size // block)
+    clear = rand.random_sample((blocks, blocks)) >= fraction
+    mask = np.kron(clear, np.ones((block, block), dtype=bool))
+    return mask[:size, :size].astype(np.uint8)
+
+
+def generate(out_dir, size=256, num_years=20, scenes_per_year=1,
+             num_disturbances=8, cloud_fraction=0.1, seed=0):
+    """
+    Write a synthetic stack of scene archives (and their cloud masks) to
+    out_dir, and return:
+    {
+        'scenes': [<scene archive filenames>],
+        'masks': [<cloud mask archive filenames>],
+        'truth': {'onset_year': <array>, 'magnitude': ..., 'duration': ...},
+        'meta': <grid metadata>
+    }
+    Each year's scenes are 16 days apart, centered on TARGET_DOY.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    rand = np.random.RandomState(seed)
+    meta = grid_meta(size)
+    years = range(FIRST_YEAR, FIRST_YEAR + num_years)
+    truth = plant_disturbances(size, years, num_disturbances, rand)
+
+    scenes, masks = [], []
+    for year in years:
+        index = index_for_year(truth, year)
+        for i in range(scenes_per_year):
+            doy = TARGET_DOY + 16 * (i - scenes_per_year // 2)
+            red = rand.normal(600, 30, (size, size))
+            nir = red + index + rand.normal(0, NOISE, (size, size))
+            other = rand.normal(1000, 50, (4, size, size))
+            mask = cloud_mask(size, cloud_fraction, rand)
+            cloudy = mask == 0
+            red[cloudy] = nir[cloudy] = 9000  # bright and flat
+
+            bands = [other[0], other[1], red, nir, other[2], other[3]]
+            scenes.append(write_archive(
+                [b.astype(np.int16) for b in bands], meta,
+                os.path.join(out_dir, SCENE_NAME % (
+                    year, doy, s.RAST_TRIGGER))
+            ))
+            masks.append(write_archive(
+                [mask], meta,
+                os.path.join(out_dir, SCENE_NAME % (
+                    year, doy, s.MASK_TRIGGER)),
+                data_type=gdal.GDT_Byte
+            ))
+    return {'scenes': scenes, 'masks': masks, 'truth': truth, 'meta': meta}
+
+
+def label_accuracy(truth, labels, min_magnitude=None):
+    """
+    Given the truth arrays (see generate) and a job's label arrays of the
+    same shape ({'onset_year': <array>, 'magnitude': ..., 'duration': ...},
+    NODATA where unlabeled), return:
+    {
+        'recall': <fraction of planted pixels detected>,
+        'false_positive_rate': <fraction of other pixels detected>,
+        'onset_year': <fraction of detected ones within a year of truth>,
+        'duration': <fraction of detected ones within a year of truth>,
+        'magnitude_error': <mean relative magnitude error of detected ones>
+    }
+    Pixels are detected when their labeled magnitude is at least
+    min_magnitude (defaults to half the smallest planted magnitude).
+    """
+    if min_magnitude is None:
+        min_magnitude = MAGNITUDES[0] / 2.0
+    planted = truth['onset_year'] != s.NODATA
+    detected = ((labels['magnitude'] != s.NODATA) &
+                (labels['magnitude'] >= min_magnitude))
+    hits = planted & detected
+
+    def fraction(arr):
+        return float(arr.mean()) if arr.size else None
+
+    def within_a_year(key):
+        return fraction(np.abs(labels[key][hits] - truth[key][hits]) <= 1)
+
+    return {
+        'recall': fraction(detected[planted]),
+        'false_positive_rate': fraction(detected[~planted]),
+        'onset_year': within_a_year('onset_year'),
+        'duration': within_a_year('duration'),
+        'magnitude_error': fraction(
+            np.abs(labels['magnitude'][hits] - truth['magnitude'][hits]) /
+            truth['magnitude'][hits]
+        )
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic Landsat stack')
+    parser.add_argument('--out-dir', default='/tmp/synthetic_stack')
+    parser.add_argument('--size', type=int, default=256,
+                        help='Width/height of the scenes')
+    parser.add_argument('--years', type=int, default=20)
+    parser.add_argument('--scenes-per-year', type=int, default=1)
+    parser.add_argument('--disturbances', type=int, default=8)
+    parser.add_argument('--cloud-fraction', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    stack = generate(args.out_dir, args.size, args.years,
+                     args.scenes_per_year, args.disturbances,
+                     args.cloud_fraction, args.seed)
+    for fn in stack['scenes'] + stack['masks']:
+        print fn
@@ -0,0 +1,97 @@
+"""
+Benchmark for writing output rasters.
+
+Writes synthetic label rasters with each data type / codec / predictor
+combination and reports the write time against the resulting file size.
+
+    python benchmarks/write_benchmark.py [--size 2048]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from osgeo import gdal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import settings as s
+import utils
+
+CODECS = ['LZW', 'DEFLATE']
+PREDICTORS = [None, 2, 3]
+LABELS = ['gd_class_val', 'gd_onset_year', 'gd_magnitude']
+
+
+def synthetic_label(label_key, size):
+    """
+    Given a label key and a size, return a (size x size) array that looks
+    like that kind of label: mostly NODATA, with patches of disturbance
+    """
+    rand = np.random.RandomState(0)
+    arr = np.ones((size, size)) * s.NODATA
+    patches = rand.random_sample((size // 16, size // 16)) > 0.8
+    mask = np.kron(patches, np.ones((16, 16), dtype=bool))[:size, :size]
+    if label_key.endswith('class_val'):
+        vals = np.ones((size, size))
+    elif label_key.endswith('onset_year'):
+        vals = rand.randint(1985, 2015, (size, size))
+    else:
+        vals = rand.normal(100, 30, (size, size))
+    arr[mask] = vals[mask]
+    return arr
+
+
+def run(size, out_dir='/tmp/write_benchmark'):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    meta = {
+        'geotransform': [0, 30, 0, 0, 0, -30],
+        'size': [size, size],
+        'projection': ''
+    }
+
+    results = []
+    for label_key in LABELS:
+        arr = synthetic_label(label_key, size)
+        for data_type in [gdal.GDT_Float32, utils.label_data_type(label_key)]:
+            for codec in CODECS:
+                for predictor in PREDICTORS:
+                    if predictor == 3 and data_type != gdal.GDT_Float32:
+                        continue  # floating point predictor only for floats
+                    block_fn = os.path.join(out_dir, 'block.tif')
+                    out_fn = os.path.join(out_dir, 'out.tif')
+                    start = time.time()
+                    ds = utils.create_raster(
+                        block_fn, meta, data_type=data_type, compress=False)
+                    ds.GetRasterBand(1).WriteArray(arr, 0, 0)
+                    ds = None
+                    utils.merge_blocks(
+                        [block_fn], meta, out_fn, data_type=data_type,
+                        compress=codec, predictor=predictor)
+                    elapsed = time.time() - start
+                    results.append({
+                        'label': label_key,
+                        'data_type': gdal.GetDataTypeName(data_type),
+                        'codec': codec,
+                        'predictor': predictor,
+                        'seconds': elapsed,
+                        'bytes': os.path.getsize(out_fn)
+                    })
+                    os.remove(block_fn)
+                    os.remove(out_fn)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark raster writing')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='Width/height of the synthetic rasters')
+    args = parser.parse_args()
+
+    print '%-15s %-8s %-8s %-9s %8s %12s' % (
+        'label', 'type', 'codec', 'predictor', 'seconds', 'bytes')
+    for r in run(args.size):
+        print '%-15s %-8s %-8s %-9s %8.3f %12d' % (
+            r['label'], r['data_type'], r['codec'], r['predictor'],
+            r['seconds'], r['bytes'])
@@ -1,4 +1,15 @@
-class LabelRule:
+import hashlib
+import json
+import math
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LabelRule(object):
     """
     Rules for labeling a trendline.
 
@@ -28,6 +39,8 @@ class LabelRule:
         > - greater than
         < - less than
     """
+    __slots__ = ['name', 'val', 'change_type', 'onset_year', 'duration',
+                 'pre_threshold']
 
     def __init__(self, options):
 
@@ -64,40 +77,52 @@ class LabelRule:
                 setattr(self, param_name, None)
 
 
-class TrendlinePoint:
+# one record per point of a Trendline
+TRENDLINE_DTYPE = np.dtype([
+    ('val_raw', 'f8'),
+    ('val_fit', 'f8'),
+    ('eqn_fit', 'f8', (2,)),
+    ('eqn_right', 'f8', (2,)),
+    ('index_date', 'i4'),
+    ('index_day', 'i4'),
+    ('spike', '?'),
+    ('vertex', '?')
+])
+
+
+class TrendlinePoint(object):
     """
     Represents a single point in a trendline.  Contains lots of data
     about the value of the point, the fitted line going through it,
     and whether or not it's a spike and/or vertex.
+
+    A lightweight view on to one record of a Trendline's array
     """
-    def __init__(self, val_raw, val_fit, eqn_fit, eqn_right, index_date,
-                 index_day, spike, vertex):
-        self.val_raw = val_raw
-        self.val_fit = val_fit
-        self.eqn_fit = eqn_fit
-        self.eqn_right = eqn_right
-        self.index_date = index_date
-        self.index_day = index_day
-        self.spike = spike
-        self.vertex = vertex
+    __slots__ = ['_record']
+
+    def __init__(self, record):
+        self._record = record
+
+    val_raw = property(lambda self: float(self._record['val_raw']))
+    val_fit = property(lambda self: float(self._record['val_fit']))
+    eqn_fit = property(lambda self: tuple(self._record['eqn_fit']))
+    eqn_right = property(lambda self: tuple(self._record['eqn_right']))
+    index_date = property(lambda self: int(self._record['index_date']))
+    index_day = property(lambda self: int(self._record['index_day']))
+    spike = property(lambda self: bool(self._record['spike']))
+    vertex = property(lambda self: bool(self._record['vertex']))
 
     def mr_label_output(self):
         """
-        Returns a dictionary in the format
+        Returns a dictionary of this point's trendline attributes in the format
         {
-            '<date>_<attr>': <val>,
-            ...
-        }
-
-        e.g.
-        {
-            '2014-07-05_spike': True,
+            '<attr>': <val>,
             ...
         }
 
         coerces booleans to False = 0, True = 1
         """
-        d = {
+        return {
             'val_raw': self.val_raw,
             'val_fit': self.val_fit,
             'eqn_fit_slope': self.eqn_fit[0],
@@ -108,72 +133,140 @@ class TrendlinePoint:
             'vertex': 1 if self.vertex else 0
         }
 
-        # prefix all keys by date
-        date = self.index_date
-        return dict([
-            ('%s-%s' % (date, k), v)
-            for k, v in d.iteritems()
-        ])
-
 
-class Trendline:
+class Trendline(object):
     """
-    Represents a processed LandTrendr trendline
+    Represents a processed LandTrendr trendline, backed by a single
+    structured array with one TRENDLINE_DTYPE record per point
     """
-    def __init__(self, points):
-        self.points = points
+    __slots__ = ['array']
+
+    def __init__(self, array):
+        self.array = array
+
+    @property
+    def points(self):
+        return [TrendlinePoint(record) for record in self.array]
+
+    def vertices(self):
+        return self.array[self.array['vertex']]
+
+    def mostly_nodata(self):
+        """
+        Returns True if more than settings.MAX_NODATA_FRACTION of this
+        trendline's raw values are NODATA (such pixels don't get labeled)
+        """
+        import settings as s
+        nodata = (self.array['val_raw'] == s.NODATA)
+        return bool(np.mean(nodata) > s.MAX_NODATA_FRACTION)
 
     def __unicode__(self):
-        vertices = filter(lambda x: x.vertex, self.points)
+        import utils
         return '\n'.join([
-            ' | '.join([v.index_date, str(v.val_fit)]) for v in vertices
+            ' | '.join([
+                utils.code2date(int(v['index_date'])).strftime('%Y-%m-%d'),
+                str(v['val_fit'])
+            ]) for v in self.vertices()
         ])
 
     def __str__(self):
         return unicode(self).encode('utf-8')
 
-    def mr_label_output(self):
+    def columns(self):
+        """
+        Returns this trendline's attributes as arrays in the format
+        {
+            '<attr>': <array with one val per point>,
+            ...
+        }
+
+        coerces booleans to False = 0, True = 1
+        """
+        a = self.array
+        return {
+            'val_raw': a['val_raw'],
+            'val_fit': a['val_fit'],
+            'eqn_fit_slope': a['eqn_fit'][:, 0],
+            'eqn_fit_intercept': a['eqn_fit'][:, 1],
+            'eqn_right_slope': a['eqn_right'][:, 0],
+            'eqn_right_intercept': a['eqn_right'][:, 1],
+            'spike': a['spike'].astype(int),
+            'vertex': a['vertex'].astype(int)
+        }
+
+    def mr_label_output(self, years):
         """
-        Outputs a dictionary in the format:
+        Given the list of years in the job, outputs a dictionary with one
+        list per trendline attribute in the format:
         {
-            '<date>_<attr>': <val>,
+            '<attr>': [<val for years[0]>, <val for years[1]>, ...],
             ...
         }
 
         e.g.
         {
-            '2014-07-05_spike': True,
+            'spike': [0, 1, -99, ...],
             ...
         }
 
-        for all points
+        Years without a point are NODATA
         """
+        import settings as s
+        year_idx = dict([(yr, i) for i, yr in enumerate(years)])
+        idx = [year_idx[yr] for yr in self.array['index_date'] // 1000]
         out = {}
-        for p in self.points:
-            out.update(p.mr_label_output())
+        for attr, vals in self.columns().iteritems():
+            col = np.empty(len(years))
+            col.fill(s.NODATA)
+            col[idx] = vals
+            out[attr] = col.tolist()
         return out
 
+    def vertex_table(self, width):
+        """
+        Returns the vertices of this trendline as a fixed-width list in the
+        format:
+            [<year> * width, <val_fit> * width,
+             <eqn_slope> * width, <eqn_intercept> * width]
+        where the equation is the line to the right of each vertex.
+        Unused slots are padded with NODATA, and mostly NODATA
+        trendlines have no vertices in the table.
+
+        See utils.change_labeling_table for labeling these in bulk
+        """
+        import settings as s
+        vertices = self.vertices()[:width]
+        if self.mostly_nodata():
+            vertices = vertices[:0]
+        table = np.empty((4, width))
+        table.fill(s.NODATA)
+        table[0, :len(vertices)] = vertices['index_date'] // 1000
+        table[1, :len(vertices)] = vertices['val_fit']
+        table[2, :len(vertices)] = vertices['eqn_right'][:, 0]
+        table[3, :len(vertices)] = vertices['eqn_right'][:, 1]
+        return table.ravel().tolist()
+
     def parse_disturbances(self):
         """
         For a given trendline, for each segment between vertices, determine
         the stats for each "disturbance" and return a list of Disturbance
         objects
         """
-        import utils
-        it = iter(self.points)
-        left_vertex = it.next()
-        for p in it:
-            if not p.vertex:
-                continue
-            start_yr = utils.parse_date(left_vertex.index_date).year
-            end_yr = utils.parse_date(p.index_date).year
-            yield Disturbance(
-                start_yr,
-                left_vertex.val_fit,
-                left_vertex.val_fit - p.val_fit,
-                end_yr - start_yr
+        # the first point always starts a segment
+        starts = self.array['vertex'].copy()
+        starts[0] = True
+        points = self.array[starts]
+        yrs = points['index_date'] // 1000
+        vals = points['val_fit']
+        return [
+            Disturbance(start_yr, initial_val, magnitude, duration)
+            for start_yr, initial_val, magnitude, duration in zip(
+                yrs[:-1].tolist(),
+                vals[:-1].tolist(),
+                (vals[:-1] - vals[1:]).tolist(),
+                (yrs[1:] - yrs[:-1]).tolist()
             )
-            left_vertex = p
+        ]
 
     def match_rule(self, rule):
         """
@@ -204,7 +297,7 @@ class Trendline:
                     match = False
 
             if rule.pre_threshold:
-                qualifier, threshold = rule.threshold
+                qualifier, threshold = rule.pre_threshold
                 if qualifier == '>' and d.initial_val <= threshold:
                     match = False
                 elif qualifier == '<' and d.initial_val >= threshold:
@@ -232,13 +325,206 @@ class Trendline:
         return winner
 
 
-class Disturbance:
+class Disturbance(object):
     """
     Represents a disturance with an onset_year, initial_val, magnitude, and
     duration
     """
+    __slots__ = ['onset_year', 'initial_val', 'magnitude', 'duration']
+
     def __init__(self, onset_year, initial_val, magnitude, duration):
         self.onset_year = onset_year
         self.initial_val = initial_val
         self.magnitude = magnitude
         self.duration = duration
+
+
+class LRUCache(object):
+    """
+    A dictionary-like cache that holds at most maxsize items, evicting the
+    least recently used one when it's full.  Counts its hits and misses.
+    """
+    def __init__(self, maxsize):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """
+        Returns the value for key (marking it most recently used),
+        or default if it isn't cached
+        """
+        try:
+            val = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items[key] = val
+        self.hits += 1
+        return val
+
+    def put(self, key, val):
+        self.items.pop(key, None)
+        self.items[key] = val
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)  # least recently used
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+
+class StageProfiler(object):
+    """
+    Times the stages of every Nth call of a function (see utils.analyze),
+    keeping a histogram of each stage's durations.
+
+    Histogram buckets are powers of 2 microseconds, keyed by their upper
+    bound, e.g. {'64': 10} means 10 runs took 32-64us.
+    """
+    def __init__(self, every=1):
+        if every < 1:
+            raise ValueError('every must be at least 1')
+        self.every = every
+        self.calls = 0
+        self.stages = {}
+
+    def sample(self):
+        """
+        Call once per call of the profiled function.
+        Returns True if this call should be timed.
+        """
+        self.calls += 1
+        return self.calls % self.every == 0
+
+    def record(self, stage, seconds):
+        stats = self.stages.setdefault(
+            stage, {'count': 0, 'seconds': 0.0, 'histogram': {}})
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        bucket = str(2 ** int(math.ceil(math.log(max(seconds * 1e6, 1), 2))))
+        stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+
+    def summary(self):
+        """
+        Returns a JSON-friendly summary in the format
+        {
+            'every': <N>,
+            'calls': <total calls>,
+            'stages': {
+                '<stage>': {'count': <timed runs>, 'seconds': <total>,
+                            'mean_ms': <mean>, 'histogram': {...}},
+                ...
+            }
+        }
+        """
+        stages = {}
+        for stage, stats in self.stages.iteritems():
+            stages[stage] = dict(stats)
+            stages[stage]['mean_ms'] = stats['seconds'] * 1000 / stats['count']
+        return {'every': self.every, 'calls': self.calls, 'stages': stages}
+
+
+class TraceLog(object):
+    """
+    Structured events of one task of a job, written as JSON lines
+    (see utils.trace_report).  Every event has the time, stage and task
+    it happened in, plus any extra fields.
+    """
+    def __init__(self, stage, task):
+        self.stage = stage
+        self.task = task
+        self.events = []
+
+    def log(self, event, **fields):
+        fields.update({
+            'time': time.time(),
+            'stage': self.stage,
+            'task': self.task,
+            'event': event
+        })
+        self.events.append(fields)
+        return fields
+
+    def write(self, out_fn):
+        with open(out_fn, 'w') as f:
+            for event in self.events:
+                f.write(json.dumps(event) + '\n')
+        return out_fn
+
+
+class LocalKey(object):
+    """
+    Stands in for a boto S3 key, backed by a file under a LocalBucket's
+    directory (only the parts of the key API that utils uses)
+    """
+    def __init__(self, root, key):
+        self.root = root
+        self.key = key
+
+    @property
+    def path(self):
+        return os.path.join(self.root, self.key)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    @property
+    def etag(self):
+        # S3's ETag of a single-part upload is the quoted MD5 of its contents
+        md5 = hashlib.md5()
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), ''):
+                md5.update(chunk)
+        return '"%s"' % md5.hexdigest()
+
+    def get_contents_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def get_contents_as_string(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def make_dirs(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def set_contents_from_filename(self, filename):
+        self.make_dirs()
+        shutil.copyfile(filename, self.path)
+
+    def set_contents_from_string(self, string):
+        self.make_dirs()
+        with open(self.path, 'w') as f:
+            f.write(string)
+
+
+class LocalBucket(object):
+    """
+    Stands in for the job's S3 bucket with a local directory, so whole
+    jobs can run offline (see settings.LOCAL_STORAGE_ENV).  Keynames are
+    paths relative to the directory.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def list(self, prefix=''):
+        keynames = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for fn in filenames:
+                keyname = os.path.relpath(
+                    os.path.join(dirpath, fn), self.root)
+                if keyname.startswith(prefix):
+                    keynames.append(keyname)
+        return [LocalKey(self.root, k) for k in sorted(keynames)]
+
+    def new_key(self, keyname):
+        return LocalKey(self.root, keyname)
@@ -1,8 +1,15 @@
 import argparse
 import boto
+import json
+import math
+import os
 import tarfile
 
+from osgeo import gdal
+
+import classes
 import settings as s
+import utils
 from mr_land_trendr_job import MRLandTrendrJob
 
 DEPENDENCIES_TARFILE = '/tmp/landtrendr_dependencies.tar.gz'
@@ -64,11 +71,45 @@ def create_input_file(platform, job):
         return local_input
 
 
-def main(platform, job):
+def main(platform, job, restart=False):
     input_file = create_input_file(platform, job)
     args = ['-r', platform, input_file]
 
     job_runner_kwargs = {'cmdenv': {'LT_JOB': job}}
+    for env in [s.PROFILE_ENV, s.LOCAL_STORAGE_ENV]:  # pass through to tasks
+        if os.environ.get(env):
+            job_runner_kwargs['cmdenv'][env] = os.environ[env]
+    if restart:  # don't resume from the job's checkpoints
+        job_runner_kwargs['cmdenv'][s.RESTART_ENV] = '1'
+
+    # size task containers to the memory budget, so as many tasks run on
+    # each instance as fit in its memory
+    settings = utils.read_json(s.IN_SETTINGS % job, cache=False)
+    if settings.get('memory_budget_mb'):
+        container_mb = int(math.ceil(
+            settings['memory_budget_mb'] / s.MEMORY_BUDGET_FRACTION))
+        job_runner_kwargs['jobconf'] = dict([
+            (key, container_mb) for key in s.TASK_MEMORY_JOBCONF.values()
+        ])
+
+    # use the tile size and reducer count the job's plan recommends, unless
+    # settings.json sets them or an earlier run picked the tile size
+    # (previews use the tile size of the job they preview, and the default
+    # reducers - their grid is much smaller)
+    preview = settings.get('preview')
+    in_job = preview['job'] if preview else job
+    tile_size = utils.pinned_tile_size(in_job, settings, restart)
+    reducers = settings.get('reducers')
+    if not tile_size or not (reducers or preview):
+        recommend = job_plan(in_job, settings, False)['recommend']
+        tile_size = tile_size or recommend['tile_size']
+        if not preview:
+            reducers = reducers or recommend['reducers']
+    if not settings.get('tile_size'):
+        job_runner_kwargs['cmdenv'][s.TILE_SIZE_ENV] = str(tile_size)
+    if reducers:
+        job_runner_kwargs.setdefault('jobconf', {})[s.REDUCERS_JOBCONF] = \
+            reducers
 
     if platform == 'emr':
         add_bootstrap_cmds()
@@ -86,18 +127,214 @@ def main(platform, job):
     with j.make_runner() as runner:
         runner.run()
 
+        for line in utils.counter_summary(runner.counters()):
+            print line
+
         if platform != 'emr':
             for line in runner.stream_output():
                 print j.parse_output_line(line)
 
+
+def relabel(job):
+    """
+    Re-run just the change labeling of a finished job on this machine,
+    using the vertex table raster the job wrote and the label_rules
+    currently in its settings.json.
+
+    Uploads the label rasters and returns their S3 keynames
+    """
+    settings = utils.read_json(s.IN_SETTINGS % job, cache=False)
+    label_rules = [classes.LabelRule(lr) for lr in settings['label_rules']]
+
+    table_key = s.OUT_RAST_KEYNAME % (job, s.VERTEX_LABEL)
+    table_keys = list(utils.get_keys(table_key))
+    if not table_keys:
+        raise Exception('No vertex table found for job %s' % job)
+    table_fn = utils.download(table_keys)[0]
+    table = utils.ds2bands(gdal.Open(table_fn))
+
+    labels = utils.change_labeling_table(table, label_rules)
+
+    compress = settings.get('output_compression', s.OUT_COMPRESSION)
+    rast_fns = []
+    for label_name, data in labels.iteritems():
+        for key in s.LABEL_KEYS:
+            label_key = '%s_%s' % (label_name, key)
+            data_type = utils.label_data_type(label_key)
+            predictor = utils.output_predictor(settings, data_type)
+
+            rast_fn = utils.keyname2filename(
+                s.OUT_RAST_KEYNAME % (job, label_key))
+            tmp_fn = utils.array2raster(
+                data[key], table_fn, rast_fn + '.tmp.tif',
+                data_type=data_type, compress=False)
+            utils.raster2cog(tmp_fn, rast_fn, compress, predictor)
+            os.remove(tmp_fn)
+            rast_fns.append(rast_fn)
+
+    return [k.key for k in utils.upload(rast_fns)]
+
+
+def preview(platform, job, step=s.PREVIEW_STEP, num_tiles=s.PREVIEW_TILES,
+            seed=0):
+    """
+    Run a quick, low resolution version of a job with its current
+    settings.json: every step-th pixel of a random sample of num_tiles of
+    its tiles (see utils.preview_grid), as the job <job>-preview
+    (settings.PREVIEW_JOB).  Its prior_job and save_state are ignored,
+    since state is kept on the full resolution grid.
+
+    Uploads a summary of the preview's vertex counts and label statistics
+    (see utils.preview_summary) and returns the lines of a report on it
+    """
+    preview_job = s.PREVIEW_JOB % job
+    settings = utils.read_json(s.IN_SETTINGS % job, cache=False)
+    for key in ['prior_job', 'save_state']:
+        settings.pop(key, None)
+    settings['preview'] = {
+        'job': job, 'step': step, 'tiles': num_tiles, 'seed': seed
+    }
+    settings_fn = utils.keyname2filename(s.IN_SETTINGS % preview_job)
+    with open(settings_fn, 'w') as f:
+        json.dump(settings, f)
+    utils.upload([settings_fn])
+
+    main(platform, preview_job)
+
+    table_key = s.OUT_RAST_KEYNAME % (preview_job, s.VERTEX_LABEL)
+    table_fn = utils.download(list(utils.get_keys(table_key)))[0]
+    table = utils.ds2bands(gdal.Open(table_fn))
+    label_rules = [classes.LabelRule(lr) for lr in settings['label_rules']]
+    summary = utils.preview_summary(table, label_rules)
+
+    summary_fn = utils.keyname2filename(s.OUT_PREVIEW_SUMMARY % preview_job)
+    with open(summary_fn, 'w') as f:
+        json.dump(summary, f)
+    utils.upload([summary_fn])
+    return utils.preview_report(summary)
+
+
+def job_plan(job, settings, calibrate=True):
+    """
+    Given a job and its settings, read its raster listing, archive sizes
+    and the header of its first scene, and return an estimate of its
+    shuffle, memory and CPU time with recommended settings
+    (see utils.plan_job).
+
+    If calibrate, utils.analyze is timed on this machine for the job's
+    number of years instead of using settings.PLAN_ANALYZE_SECONDS.
+    """
+    scenes = [
+        (k.key, k.size) for k in utils.get_keys(s.IN_RASTS % job)
+        if s.RAST_TRIGGER in k.key
+    ]
+    if not scenes:
+        raise Exception('No analysis rasters specified for job %s' % job)
+
+    # read the header straight out of the archive on S3
+    scene_meta = utils.rast2meta(utils.rast_vsi(scenes[0][0], remote=True))
+
+    # same grid as setup_mapper
+    tile_size = utils.job_tile_size(settings)
+    if settings.get('region'):
+        grid_meta = utils.region_meta(settings['region'], tile_size)
+    else:
+        grid_meta = scene_meta
+    pixels = None
+    if settings.get('aoi'):
+        aoi = utils.read_aoi(settings['aoi'], job, grid_meta['projection'])
+        grid_meta, aoi_mask = utils.crop2mask(
+            grid_meta, utils.rasterize_geom(aoi, grid_meta))
+        pixels = int(aoi_mask.sum())
+
+    analyze_seconds = None
+    if calibrate:
+        num_years = len(set(
+            utils.filename2datecode(keyname) // 1000 for keyname, _ in scenes))
+        analyze_seconds = utils.time_analyze(num_years, settings['line_cost'])
+
+    return utils.plan_job(grid_meta, scene_meta, scenes, settings,
+                          pixels, analyze_seconds, tile_size)
+
+
+def plan(job, calibrate=True):
+    """
+    Before running a job, return the lines of a summary of its plan
+    (see job_plan)
+    """
+    settings = utils.read_json(s.IN_SETTINGS % job, cache=False)
+    return utils.plan_summary(job_plan(job, settings, calibrate))
+
+
+def report(job):
+    """
+    Download the trace logs a job's tasks wrote and return the lines of
+    a report on its critical path, stragglers and slowest inputs
+    (see utils.trace_report)
+    """
+    trace_fns = utils.get_files(s.OUT_TRACE % job)
+    if not trace_fns:
+        raise Exception('No trace logs found for job %s' % job)
+    return utils.trace_report(utils.read_traces(trace_fns))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run a LandTrendr job')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Run a LandTrendr job')
+    run_parser.add_argument('-p', '--platform', required=True,
+                            choices=['inline', 'local', 'emr'],
+                            help='Which platform do you want to run on?')
+    run_parser.add_argument('-j', '--job', required=True,
+                            help='Which LandTrendr job do you want to run?')
+    run_parser.add_argument('--restart', action='store_true',
+                            help='Recompute every tile, even ones an earlier '
+                                 'run finished')
+
+    relabel_parser = subparsers.add_parser(
+        'relabel', help='Re-label a finished job with its current label_rules')
+    relabel_parser.add_argument('-j', '--job', required=True,
+                                help='Which LandTrendr job do you want to relabel?')
+
+    plan_parser = subparsers.add_parser(
+        'plan', help='Estimate what a job will take before running it')
+    plan_parser.add_argument('-j', '--job', required=True,
+                             help='Which LandTrendr job do you want to plan?')
+    plan_parser.add_argument('--no-calibrate', action='store_true',
+                             help="Don't time the analysis on this machine")
+
+    preview_parser = subparsers.add_parser(
+        'preview', help='Run a quick, low resolution version of a job')
+    preview_parser.add_argument('-p', '--platform', required=True,
+                                choices=['inline', 'local', 'emr'],
+                                help='Which platform do you want to run on?')
+    preview_parser.add_argument('-j', '--job', required=True,
+                                help='Which LandTrendr job do you want to preview?')
+    preview_parser.add_argument('--step', type=int, default=s.PREVIEW_STEP,
+                                help='Sample every STEP-th pixel')
+    preview_parser.add_argument('--tiles', type=int, default=s.PREVIEW_TILES,
+                                help='Number of tiles to sample (0 - all)')
+    preview_parser.add_argument('--seed', type=int, default=0,
+                                help='Seed of the tile sample')
 
-    parser.add_argument('-p', '--platform', required=True,
-                        choices=['inline', 'local', 'emr'],
-                        help='Which platform do you want to run on?')
-    parser.add_argument('-j', '--job', required=True,
-                        help='Which LandTrendr job do you want to run?')
+    report_parser = subparsers.add_parser(
+        'report', help='Report where the time of a finished job went')
+    report_parser.add_argument('-j', '--job', required=True,
+                               help='Which LandTrendr job do you want a report on?')
 
     args = parser.parse_args()
-    main(args.platform, args.job)
+    if args.command == 'run':
+        main(args.platform, args.job, args.restart)
+    elif args.command == 'relabel':
+        for keyname in relabel(args.job):
+            print keyname
+    elif args.command == 'plan':
+        for line in plan(args.job, not args.no_calibrate):
+            print line
+    elif args.command == 'preview':
+        for line in preview(args.platform, args.job, args.step, args.tiles,
+                            args.seed):
+            print line
+    elif args.command == 'report':
+        for line in report(args.job):
+            print line
@@ -1,6 +1,12 @@
+import itertools
+import json
 import os
-import sys
+import resource
+import time
+from contextlib import contextmanager
+from functools import partial
 
+from mrjob.compat import jobconf_from_env
 from mrjob.job import MRJob
 
 import settings as s
@@ -15,6 +21,125 @@ class MRLandTrendrJob(MRJob):
         super(MRLandTrendrJob, self).__init__(*args, **kwargs)
         self.extra_job_runner_kwargs = extra_job_runner_kwargs
         self.extra_emr_job_runner_kwargs = extra_emr_job_runner_kwargs
+        self.transfer_bytes = dict(utils.TRANSFER_BYTES)
+        self.trace = None
+        self.budget = None  # see window_budget
+        self.task_counters, self.task_stages = {}, {}  # see flush_counters
+        self.scene_fns = {}  # see stack_scene
+
+    def window_budget(self, settings):
+        """
+        Returns the bytes of raster/grid windows this task may hold at
+        once: its memory budget (see utils.memory_budget) less what it
+        used before reading any, shrunk whenever its peak RSS has gone
+        over the budget since (see utils.adapt_budget)
+        """
+        peak = utils.peak_rss()
+        if self.budget is None:
+            task_memory_mb = jobconf_from_env(
+                s.TASK_MEMORY_JOBCONF['mapper'], None)
+            self.budget_total = utils.memory_budget(settings, task_memory_mb)
+            self.budget_base = peak
+            self.budget = max(s.MIN_WINDOW_BUDGET, self.budget_total - peak)
+        elif peak > self.budget_peak:
+            budget = utils.adapt_budget(
+                self.budget, self.budget_total, self.budget_base, peak)
+            if budget < self.budget:
+                self.count('window_budget_shrinks')
+                self.budget = budget
+        self.budget_peak = peak
+        return self.budget
+
+    def task_id(self):
+        return jobconf_from_env('mapreduce.task.id') or str(os.getpid())
+
+    def trace_start(self, stage):
+        """
+        Start this task's trace log (see trace_end)
+        """
+        self.trace = classes.TraceLog(stage, self.task_id())
+        self.trace.log('task_start')
+
+    def trace_end(self):
+        """
+        Log the end of this task (with its counters, stage timers and
+        peak memory use), upload its trace log to
+        settings.OUT_TRACE_KEYNAME and flush its counters
+        """
+        if self.trace is None:
+            self.flush_counters()
+            return
+        job = os.environ.get('LT_JOB')
+        start = self.trace.events[0]['time'] if self.trace.events else None
+        end = self.trace.log(
+            'task_end',
+            counts=dict(self.task_counters.get(s.COUNTER_GROUP, {})),
+            stages=dict(self.task_stages),
+            peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        )
+        if start is not None:
+            end['seconds'] = end['time'] - start
+        trace_fn = utils.keyname2filename(s.OUT_TRACE_KEYNAME % (
+            job, '%s-%s' % (self.trace.stage, self.trace.task)))
+        utils.upload([self.trace.write(trace_fn)])
+        self.trace = None
+        self.flush_counters()
+
+    def count(self, counter, amount=1, group=s.COUNTER_GROUP):
+        """
+        Add amount to one of the job's counters (see settings.COUNTER_GROUP)
+
+        Counts are kept in the task until flush_counters, so counting
+        every pixel doesn't write a Hadoop counter line per pixel
+        """
+        if amount:
+            counters = self.task_counters.setdefault(group, {})
+            counters[counter] = counters.get(counter, 0) + amount
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time the code run in this context, adding the seconds to the
+        task's total for stage (flushed to the <stage>_ms counter - see
+        settings.TIMER_GROUP - by flush_counters)
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.task_stages[stage] = \
+                self.task_stages.get(stage, 0) + time.time() - start
+
+    def flush_counters(self):
+        """
+        Write the counts and stage timers this task has kept since the
+        last flush to the job's counters, once each
+
+        Timers are summed in seconds and only rounded to milliseconds
+        here, so stages much shorter than a millisecond still add up
+        """
+        for group, counters in sorted(self.task_counters.iteritems()):
+            for counter, amount in sorted(counters.iteritems()):
+                self.increment_counter(group, counter, amount)
+        for stage, seconds in sorted(self.task_stages.iteritems()):
+            self.increment_counter(
+                s.TIMER_GROUP, '%s_ms' % stage, int(round(seconds * 1000)))
+        self.task_counters, self.task_stages = {}, {}
+
+    def count_transfers(self):
+        """
+        Add the bytes this task downloaded and uploaded since the last
+        call to the bytes_downloaded and bytes_uploaded counters
+
+        Returns the bytes in the format {'downloaded': X, 'uploaded': X}
+        """
+        transfers = {}
+        for direction, total in utils.TRANSFER_BYTES.iteritems():
+            transfers[direction] = \
+                total - self.transfer_bytes.get(direction, 0)
+            self.count('bytes_%s' % direction, transfers[direction])
+        self.transfer_bytes = dict(utils.TRANSFER_BYTES)
+        return transfers
 
     def setup_mapper(self, _, line):
         """
@@ -23,26 +148,158 @@ class MRLandTrendrJob(MRJob):
         the input S3 dir for that job.
 
         Outputs a list of the S3 keys for each of the input rasters
+
+        Tiles that an earlier run of the job with the same inputs finished
+        (see utils.read_checkpoints) aren't read again: their blocks go
+        straight through to output_reducer.
+
+        Previews (see land_trendr.py preview) read the rasters (and area of
+        interest) of the job they preview, on to a decimated sample of its
+        grid (see utils.preview_grid).
         """
         job = os.environ.get('LT_JOB')
-        print 'Setting up %s' % job
+        self.set_status('Setting up %s' % job)
+        settings = utils.get_settings(job)
+        tile_size = utils.job_tile_size(settings)
+        preview = settings.get('preview')
+        in_job = preview['job'] if preview else job
+        in_keys = list(utils.get_keys(s.IN_RASTS % in_job))
         analysis_rasts = [
-            k.key for k in utils.get_keys(s.IN_RASTS % job)
-            if s.RAST_TRIGGER in k.key
+            k.key for k in in_keys if s.RAST_TRIGGER in k.key
         ]
         if not analysis_rasts:
             raise Exception('No analysis rasters specified for job %s' % job)
 
-        # download template rast for grid
-        rast_fn = utils.rast_dl(analysis_rasts[0])
-
-        # set up grid
+        # region jobs use a fixed grid that every scene is warped on to,
+        # otherwise download template rast for grid
+        region = settings.get('region')
+        if region:
+            meta = utils.region_meta(region, tile_size)
+        elif preview:  # previews never need the whole template rast
+            meta = utils.rast2meta(utils.rast_vsi(analysis_rasts[0]))
+        else:
+            rast_fn = utils.rast_dl(analysis_rasts[0])
+            meta = utils.rast2meta(rast_fn)
+
+        # set up grid (cropped to the area of interest, if any, and
+        # decimated for previews).  Region jobs without either sample every
+        # pixel their scenes cover, so they don't need a grid file.
         grid_fn = utils.keyname2filename(s.OUT_GRID % job)
-        utils.rast2grid(rast_fn, out_csv=grid_fn)
-        utils.upload([grid_fn])
+        aoi_mask = None
+        if settings.get('aoi'):
+            aoi = utils.read_aoi(settings['aoi'], in_job, meta['projection'])
+            meta, aoi_mask = utils.crop2mask(
+                meta, utils.rasterize_geom(aoi, meta))
+        if preview:
+            meta, aoi_mask = utils.preview_grid(
+                meta, aoi_mask, preview['step'], preview['tiles'],
+                tile_size, preview.get('seed', 0))
+            meta['preview'] = {
+                'step': preview['step'],
+                'windows': utils.preview_windows(
+                    aoi_mask, preview['step'], tile_size)
+            }
+        if aoi_mask is not None:
+            utils.meta2grid(meta, aoi_mask, out_csv=grid_fn)
+        elif region:
+            grid_fn = None
+        else:
+            utils.rast2grid(rast_fn, out_csv=grid_fn)
+
+        # years covered by the job (and its prior job, if any)
+        prior_job = settings.get('prior_job')
+        state_keys = []
+        if prior_job:
+            state_keys = list(utils.get_keys(s.OUT_STATE % prior_job))
+        # dates travel through the job as integer codes (see
+        # utils.date2code), the date table formats them for output
+        dates = utils.date_table(
+            [utils.filename2datecode(k) for k in analysis_rasts])
+        if prior_job:
+            prior_dates = utils.read_json(s.OUT_META % prior_job)['dates']
+            dates.update(utils.date_table(map(int, prior_dates)))
+        meta['dates'] = dates
+        meta['years'] = sorted(set(int(c) // 1000 for c in dates))
+        meta['tile_size'] = tile_size  # see utils.pinned_tile_size
+        aoi_keys = []
+        if settings.get('aoi') and utils.aoi_keyname(settings['aoi'], in_job):
+            aoi_keys = list(utils.get_keys(
+                utils.aoi_keyname(settings['aoi'], in_job)))
+        meta['checkpoint'] = utils.input_hash(
+            settings, in_keys + state_keys + aoi_keys, meta, tile_size)
+        meta_fn = utils.keyname2filename(s.OUT_META % job)
+        with open(meta_fn, 'w') as f:
+            json.dump(meta, f)
+
+        # only read the scenes (and tiles) that can win a pixel-year
+        # (masks of region jobs aren't on the grid until they're warped,
+        # and full resolution masks don't line up with a preview's grid)
+        if settings.get('prune_scenes', True) and not (region or preview):
+            ranked = utils.rank_scenes(
+                analysis_rasts, utils.parse_date(settings['target_date']))
+            mask_fns = dict([(k, utils.mask_dl(k)) for k in analysis_rasts])
+            plan = utils.plan_scenes(
+                ranked, mask_fns, meta, tile_size, aoi_mask)
+        else:
+            plan = dict([(k, None) for k in analysis_rasts])
+
+        # skip the tiles (and scenes) an earlier run finished
+        finished = {}
+        if not os.environ.get(s.RESTART_ENV):
+            finished = utils.read_checkpoints(job, meta['checkpoint'])['tiles']
+        if finished:
+            resumed = utils.resume_plan(
+                plan, utils.grid_tiles(meta, tile_size, aoi_mask),
+                finished)
+            self.count('tiles_checkpointed', len(finished))
+            self.count('scenes_checkpointed', len(plan) - len(resumed))
+            plan = resumed
+        plan_fn = utils.keyname2filename(s.OUT_PLAN % job)
+        with open(plan_fn, 'w') as f:
+            json.dump(plan, f)
+
+        # stack jobs read every planned scene a tile at a time
+        # (see parse_tile) instead of a scene at a time
+        analysis_rasts = [k for k in analysis_rasts if k in plan]
+        to_parse = list(analysis_rasts)
+        if settings.get('stack_scenes'):
+            if region:
+                raise Exception('stack_scenes does not support region jobs')
+            stack = {'scenes': [
+                {'key': k, 'date': utils.filename2datecode(k)}
+                for k in analysis_rasts
+            ]}
+            stack_fn = utils.keyname2filename(s.OUT_STACK % job)
+            with open(stack_fn, 'w') as f:
+                json.dump(stack, f)
+            utils.upload([stack_fn])
+            tiles = [
+                tile for tile in utils.grid_tiles(meta, tile_size, aoi_mask)
+                if tuple(tile) not in finished
+            ]
+            to_parse = [
+                {'tiles': tiles[i:i + s.STACK_TILES_PER_TASK]}
+                for i in xrange(0, len(tiles), s.STACK_TILES_PER_TASK)
+            ]
+
+        utils.upload([fn for fn in [grid_fn, meta_fn, plan_fn] if fn])
+
+        self.count_transfers()
+
+        # fitting state from the prior run gets parsed alongside the rasters
+        # (state files are named by tile, see settings.OUT_STATE_KEYNAME)
+        for k in state_keys:
+            tile_name = os.path.splitext(os.path.basename(k.key))[0]
+            if tuple(int(t) for t in tile_name.split('_')) not in finished:
+                to_parse.append(k.key)
+
+        # as do the blocks of finished tiles
+        for (tile_x, tile_y), blocks in finished.iteritems():
+            for label_key, block in blocks.iteritems():
+                to_parse.append(dict(block, block=[label_key, tile_x, tile_y]))
 
         # note - must yield at end to ensure grid is created
-        for i, keyname in enumerate(analysis_rasts):
+        for i, keyname in enumerate(to_parse):
             yield i, keyname
 
     def parse_mapper(self, _, rast_s3key):
@@ -54,108 +311,557 @@ class MRLandTrendrJob(MRJob):
         (where the point_wkt is the centroid of the pixel)
         """
         job = os.environ.get('LT_JOB')
+        settings = utils.get_settings(job)
 
-        rast_fn = utils.rast_dl(rast_s3key)
-
-        mask_key = rast_s3key.replace(s.RAST_TRIGGER, s.MASK_TRIGGER)
-        try:
-            mask_fn = utils.rast_dl(mask_key)
-        except Exception:
-            mask_fn = None  # don't worry about mask
+        if isinstance(rast_s3key, dict) and 'block' in rast_s3key:
+            # a block of a finished tile, keyed like analysis_reducer's
+            yield rast_s3key['block'], {'checkpoint': rast_s3key}
+            return
+
+        if isinstance(rast_s3key, dict):  # neighboring tiles of a stack job
+            for tile in rast_s3key['tiles']:
+                for point_wkt, pix_data in self.parse_tile(tile):
+                    yield point_wkt, pix_data
+            return
+
+        prior_job = settings.get('prior_job')
+        if prior_job and rast_s3key.startswith(s.OUT_STATE % prior_job):
+            state_fn = utils.get_file(rast_s3key)
+            for point_wkt, state in utils.read_states(state_fn):
+                self.count('states_read')
+                yield point_wkt, {'state': state}
+            self.count_transfers()
+            return
+
+        scene_start = time.time()
+        region = settings.get('region')
+        # previews read their windows straight out of the archives
+        preview = bool(settings.get('preview')) and not region
+        rast_fn = (utils.rast_vsi if preview else utils.rast_dl)(rast_s3key)
+        mask_fn = utils.mask_dl(rast_s3key, vsi=preview)
+        meta = utils.read_json(s.OUT_META % job)
+
+        # figure out date code from filename
+        datecode = utils.filename2datecode(rast_fn)
+
+        # previews only read the scene's pixels at the centers of their
+        # own pixels, in the tiles they sample (see utils.preview_raster)
+        if preview:
+            rast_fn = utils.preview_raster(rast_fn, meta, os.path.join(
+                s.WORK_DIR, os.path.basename(rast_fn) + '.preview.tif'))
+            if rast_fn is None:
+                return  # scene is outside the preview
+            if mask_fn:
+                mask_fn = utils.preview_raster(mask_fn, meta, os.path.join(
+                    s.WORK_DIR, os.path.basename(mask_fn) + '.preview.tif'))
+        # only read the window of the scene that covers the (cropped) grid
+        elif settings.get('aoi') and not region:
+            rast_fn = utils.clip_raster(rast_fn, meta, rast_fn + '.aoi.tif')
+            if rast_fn is None:
+                return  # scene is outside the area of interest
+            if mask_fn:
+                mask_fn = utils.clip_raster(
+                    mask_fn, meta, mask_fn + '.aoi.tif')
+
+        # calculate index (a window of the scene at a time)
+        index_eqn = settings['index_eqn']
+        budget = self.window_budget(settings)
+        with self.timer('rast_algebra'):
+            index_rast = utils.rast_algebra(rast_fn, index_eqn, budget=budget)
+
+        # warp region scenes (and their masks) on to the job's grid
+        if region:
+            warped = utils.warp2grid(index_rast, meta, index_rast + '.warp.tif')
+            if warped is None:
+                return  # scene is outside the region
+            index_rast, offset = warped
+            if mask_fn:
+                warped_mask = utils.warp2grid(
+                    mask_fn, meta, mask_fn + '.warp.tif')
+                mask_fn = warped_mask[0] if warped_mask else None
+
+        self.set_status('Serializing %s...' % os.path.basename(rast_fn))
+        stats = {}
+        # which of the grid's tiles this scene can win in
+        tiles = utils.read_json(s.OUT_PLAN % job)[rast_s3key]
+        tile_size = utils.job_tile_size(settings)
+        if region and not (settings.get('aoi') or settings.get('preview')):
+            pix_generator = utils.apply_window(
+                index_rast, meta, offset, {'date': datecode}, mask_fn=mask_fn,
+                stats=stats, tiles=tiles, tile_size=tile_size)
+        else:
+            grid_fn = utils.get_file(s.OUT_GRID % job)
+            pix_generator = utils.apply_grid(
+                index_rast, grid_fn, {'date': datecode}, mask_fn=mask_fn,
+                tiles=tiles, geotransform=meta['geotransform'], stats=stats,
+                budget=budget, tile_size=tile_size)
+
+        # (includes the time spent emitting the samples)
+        with self.timer('apply_grid'):
+            for point_wkt, pix_data in pix_generator:
+                yield point_wkt, pix_data
+
+        self.count('scenes_parsed')
+        for stat, amount in stats.iteritems():
+            self.count('pixels_%s' % stat, amount)
+        transfers = self.count_transfers()
+        if self.trace is not None:
+            self.trace.log(
+                'scene', key=rast_s3key, rows=stats.get('sampled', 0),
+                bytes=transfers['downloaded'],
+                seconds=time.time() - scene_start
+            )
 
-        # calculate index
-        index_eqn = utils.get_settings(job)['index_eqn']
-        index_rast = utils.rast_algebra(rast_fn, index_eqn)
+    def stack_scene(self, keyname):
+        """
+        Returns the (raster, mask) filenames of a scene of a stack job
+        (see parse_tile), only downloading and decompressing it (or even
+        listing it) the first time this task reads it
+        """
+        if keyname not in self.scene_fns:
+            self.scene_fns[keyname] = (
+                utils.rast_dl(keyname), utils.mask_dl(keyname))
+        return self.scene_fns[keyname]
 
-        # figure out date from filename
-        datestring = utils.filename2date(rast_fn)
+    def parse_tile(self, tile):
+        """
+        Given a [<tile x>, <tile y>] tile of a stack job, download every
+        scene that can win a pixel in the tile (unless this task already
+        did, see stack_scene), stack the bands of the
+        index equation (and the masks) on to the grid in VRTs, and read
+        the tile out of each stack in a single call.
+
+        Yields the winning observation of each year for every grid point
+        in the tile, in the format:
+            point_wkt, {'val': <val>, 'date': <date>}
+        with the spikes of each point's series found a strip of the tile
+        at a time and marked with 'spike': True (see utils.mark_spikes),
+        unless the job keeps fitting state (which finds them itself).
+        """
+        tile_start = time.time()
+        job = os.environ.get('LT_JOB')
+        settings = utils.get_settings(job)
+        tile_size = utils.job_tile_size(settings)
+        meta = utils.read_json(s.OUT_META % job)
+        plan = utils.read_json(s.OUT_PLAN % job)
+        scenes = [
+            scene for scene in utils.read_json(s.OUT_STACK % job)['scenes']
+            if plan[scene['key']] is None or tile in plan[scene['key']]
+        ]
+        if not scenes:
+            return
+
+        rast_fns, mask_fns = zip(*[
+            self.stack_scene(scene['key']) for scene in scenes])
+        vrt_fn = os.path.join(s.WORK_DIR, 'stack_%s_%s_%%s.vrt' % tuple(tile))
+
+        index_eqn = settings['index_eqn']
+        band_vrts = dict([
+            (b, utils.build_stack_vrt(rast_fns, b, meta, vrt_fn % ('B%s' % b)))
+            for b in set(utils.parse_eqn_bands(index_eqn))
+        ])
+        footprints = [utils.grid_footprint(fn, meta) for fn in rast_fns]
+        has_mask = [i for i, fn in enumerate(mask_fns) if fn]
+        if has_mask:
+            mask_vrt = utils.build_stack_vrt(
+                [mask_fns[i] for i in has_mask], 1, meta, vrt_fn % 'mask')
+
+        # read the tile in strips of rows that fit in the task's budget
+        # (each pixel holds every scene's bands, index and mask)
+        budget = self.window_budget(settings)
+        size_x, size_y = utils.tile_meta(meta, tile, tile_size)['size']
+        rows = utils.window_rows(
+            size_x * len(scenes) * 8 * (len(band_vrts) + 3), budget, size_y)
 
-        # pull down grid
         grid_fn = utils.get_file(s.OUT_GRID % job)
+        wkts, (x_offs, y_offs) = utils.grid_tile_points(
+            grid_fn, meta, tile, tile_size, budget)
+        target_date = utils.parse_date(settings['target_date'])
+        dates = [scene['date'] for scene in scenes]
+        mark_spikes = not (settings.get('save_state') or
+                           settings.get('prior_job'))
+
+        self.set_status('Serializing tile %s_%s...' % tuple(tile))
+        for row_start in xrange(0, size_y, rows):
+            in_strip = (y_offs >= row_start) & (y_offs < row_start + rows)
+            if not in_strip.any():
+                continue
+            strip = (row_start, rows)
+
+            # calculate index on the [scene, y, x] cube of each band
+            bands = dict([
+                (b, utils.read_stack(vrt, meta, tile, tile_size, strip))
+                for b, vrt in band_vrts.iteritems()
+            ])
+            covered = utils.stack_coverage(
+                footprints, meta, tile, tile_size, strip)
+            with self.timer('rast_algebra'):
+                index_cube = utils.stack_algebra(bands, index_eqn, covered)
+            del bands
+
+            mask_cube = None
+            if has_mask:
+                mask_cube = utils.nodata_array(index_cube.shape)
+                mask_cube[has_mask] = utils.read_stack(
+                    mask_vrt, meta, tile, tile_size, strip)
+
+            offsets = [x_offs[in_strip], y_offs[in_strip] - row_start]
+            points, strip_winners = [], []
+            with self.timer('apply_grid'):
+                for point_wkt, pix_datas in utils.stack2pix_datas(
+                        index_cube, covered, dates, wkts[in_strip], offsets,
+                        mask_cube):
+                    self.count('pixels_sampled', len(pix_datas))
+                    points.append(point_wkt)
+                    strip_winners.append(
+                        utils.pick_winners(pix_datas, target_date))
+            del index_cube, covered, mask_cube
+
+            if mark_spikes:
+                with self.timer('despike'):
+                    utils.mark_spikes(strip_winners)
+            for point_wkt, winners in zip(points, strip_winners):
+                for winner in winners:
+                    yield point_wkt, winner
+
+        self.count('tiles_parsed')
+        transfers = self.count_transfers()
+        if self.trace is not None:
+            self.trace.log(
+                'tile', tile=tile, scenes=len(scenes),
+                bytes=transfers['downloaded'],
+                seconds=time.time() - tile_start
+            )
 
-        print 'Serializing %s...' % os.path.basename(rast_fn)
-        pix_generator = utils.apply_grid(
-            index_rast, grid_fn, {'date': datestring}, mask_fn=mask_fn)
+    def analysis_combiner_init(self):
+        job = os.environ.get('LT_JOB')
+        self.target_date = utils.parse_date(
+            utils.get_settings(job)['target_date'])
 
-        for point_wkt, pix_data in pix_generator:
-            yield point_wkt, pix_data
+    def analysis_combiner(self, point_wkt, pix_datas):
+        """
+        Given a point wkt and the pix datas that one mapper produced for it,
+        drop the observations that can't be picked by utils.pick_winners
+        before they're shuffled (only the one closest to target_date in each
+        year can win).
+
+        Masked pixels are never emitted by parse_mapper, so the closest
+        unmasked observation still wins, just as it would without the
+        combiner.  Fitting state from a prior job and checkpointed blocks
+        pass through untouched.
+        """
+        observations = []
+        for pix_data in pix_datas:
+            if 'state' in pix_data or 'checkpoint' in pix_data:
+                yield point_wkt, pix_data
+            else:
+                observations.append(pix_data)
+
+        for winner in utils.pick_winners(observations, self.target_date):
+            yield point_wkt, winner
+
+    def analysis_reducer_init(self):
+        self.trace_start('analysis_reducer')
+        job = os.environ.get('LT_JOB')
+        cache_size = utils.get_settings(job).get(
+            'analysis_cache_size', s.ANALYSIS_CACHE_SIZE)
+        self.analysis_cache = (
+            classes.LRUCache(cache_size) if cache_size else None
+        )
+        self.profiler = utils.env_profiler()
+        self.tile_labels = {}
+
+    def analysis_reducer_final(self):
+        """
+        Uploads this task's profile summary (see settings.PROFILE_ENV)
+        and trace log
+
+        Yields the labels this task wrote in each tile, keyed by
+        [settings.CHECKPOINT_LABEL, <tile x>, <tile y>] (see block_reducer)
+        """
+        if self.profiler is not None:
+            job = os.environ.get('LT_JOB')
+            profile_fn = utils.keyname2filename(
+                s.OUT_PROFILE_KEYNAME % (job, self.task_id()))
+            with open(profile_fn, 'w') as f:
+                json.dump(self.profiler.summary(), f)
+            utils.upload([profile_fn])
+            self.count_transfers()
+        self.trace_end()
+
+        for (tile_x, tile_y), labels in self.tile_labels.iteritems():
+            yield [s.CHECKPOINT_LABEL, tile_x, tile_y], sorted(labels)
 
     def analysis_reducer(self, point_wkt, pix_datas):
         """
         Given a point wkt and a list of pix datas in the format:
         [
-            {'date': '2011-09-01', 'val': 160.0},
-            {'date': '2012-09-01', 'val': 180.0},
+            {'date': 2011244, 'val': 160.0},
+            {'date': 2012245, 'val': 180.0},
             ...
         ]
+        (dates are date codes - see utils.date2code)
         perform the landtrendr analysis and change labeling.
 
-        Yields out the change labels and trendline data for the given point
+        Yields out the change labels and trendline data for the given point,
+        keyed by [<label>, <tile x>, <tile y>] of the output block it's in
         """
-        sys.stdout.write('.')  # for viewing progress
-        sys.stdout.flush()
+        if isinstance(point_wkt, list):  # a checkpointed block
+            for pix_data in pix_datas:
+                yield point_wkt, pix_data
+            return
 
         job = os.environ.get('LT_JOB')
         settings = utils.get_settings(job)
+        meta = utils.read_json(s.OUT_META % job)
+        tile_x, tile_y = utils.point2tile(
+            point_wkt, meta['geotransform'], utils.job_tile_size(settings))
+        labels = self.tile_labels.setdefault((tile_x, tile_y), set())
 
         pix_datas = list(pix_datas)  # save iterator to a list
-        pix_trendline = utils.analyze(
-            pix_datas,
-            settings['line_cost'],
-            utils.parse_date(settings['target_date'])
-        )
+        line_cost = settings['line_cost']
+        target_date = utils.parse_date(settings['target_date'])
+        label_rules = [
+            classes.LabelRule(lr) for lr in settings['label_rules']
+        ]
+        change_labels, state = None, None
+        # parse_tile already found the spikes of stack jobs (see
+        # utils.mark_spikes)
+        spikes_marked = bool(settings.get('stack_scenes'))
+
+        self.count('pixels_analyzed')
+        with self.timer('analyze'):
+            if settings.get('save_state') or settings.get('prior_job'):
+                # state from the prior run (if any) came through the shuffle
+                states = [d['state'] for d in pix_datas if 'state' in d]
+                pix_datas = [d for d in pix_datas if 'state' not in d]
+                pix_trendline, state = utils.analyze_incremental(
+                    pix_datas,
+                    line_cost,
+                    target_date,
+                    states[0] if states else None
+                )
+            elif self.analysis_cache is not None:
+                cache = self.analysis_cache
+                hits = cache.hits
+                pix_trendline, change_labels = utils.analyze_cached(
+                    pix_datas, line_cost, target_date, label_rules, cache,
+                    self.profiler, spikes_marked)
+                self.count('hits' if cache.hits > hits else 'misses',
+                           group='analysis_cache')
+            else:
+                pix_trendline = utils.analyze(
+                    pix_datas, line_cost, target_date, self.profiler,
+                    spikes_marked)
+
+        if state is not None:
+            labels.add(s.STATE_LABEL)
+            yield (
+                [s.STATE_LABEL, tile_x, tile_y],
+                {'pix_ctr_wkt': point_wkt, 'value': state}
+            )
 
-        # write out pix trendline
-        for label, val in pix_trendline.mr_label_output().iteritems():
-            # prepend 'aux/' to label name so written to sub folder
+        # write out pix trendline, one list of yearly values per attribute
+        years = meta['years']
+        for attr, vals in pix_trendline.mr_label_output(years).iteritems():
+            labels.add(s.TRENDLINE_LABEL % attr)
             yield (
-                'trendline/%s' % label,
-                {'pix_ctr_wkt': point_wkt, 'value': val}
+                [s.TRENDLINE_LABEL % attr, tile_x, tile_y],
+                {'pix_ctr_wkt': point_wkt, 'value': vals}
             )
 
-        label_rules = [
-            classes.LabelRule(lr) for lr in settings['label_rules']
-        ]
+        # write out vertex table (used by land_trendr.py relabel)
+        labels.add(s.VERTEX_LABEL)
+        yield (
+            [s.VERTEX_LABEL, tile_x, tile_y],
+            {
+                'pix_ctr_wkt': point_wkt,
+                'value': pix_trendline.vertex_table(len(years))
+            }
+        )
 
-        change_labels = utils.change_labeling(pix_trendline, label_rules)
+        if change_labels is None:
+            with self.timer('change_labeling'):
+                change_labels = utils.change_labeling(
+                    pix_trendline, label_rules)
 
         # write out change labels
         for label_name, data in change_labels.iteritems():
-            for key in ['class_val', 'onset_year', 'magnitude', 'duration']:
+            for key in s.LABEL_KEYS:
                 label_key = '%s_%s' % (label_name, key)
-                yield label_key, {'pix_ctr_wkt': point_wkt, 'value': data[key]}
+                labels.add(label_key)
+                yield (
+                    [label_key, tile_x, tile_y],
+                    {'pix_ctr_wkt': point_wkt, 'value': data[key]}
+                )
+
+    def block_reducer(self, block_key, pix_datas):
+        """
+        Given a [<label>, <tile x>, <tile y>] key and the pixel data
+        for that label in that tile, fill the data in to a raster block
+        (or a fitting state file), upload it, mark it finished (see
+        utils.read_checkpoints) and yield its keyname keyed by label.
+
+        Blocks of tiles that were finished in an earlier run come through
+        as a single {'checkpoint': {'key': X, 'md5': X}} and are passed on.
+        The labels analysis_reducer wrote in each tile come through keyed
+        by settings.CHECKPOINT_LABEL, and mark the tile finished.
+        """
+        job = os.environ.get('LT_JOB')
+        label_key, tile_x, tile_y = block_key
+        meta = utils.read_json(s.OUT_META % job)
+        checkpoint = meta['checkpoint']
+
+        if label_key == s.CHECKPOINT_LABEL:
+            labels = set()
+            for task_labels in pix_datas:
+                labels.update(task_labels)
+            utils.write_checkpoint(
+                job, checkpoint, s.CHECKPOINT_TILE_UNIT % (tile_x, tile_y),
+                utils.labels_md5(labels))
+            return
+
+        pix_datas = iter(pix_datas)
+        first = next(pix_datas)
+        if 'checkpoint' in first:
+            self.count('blocks_checkpointed')
+            yield label_key, {
+                'tile': [tile_x, tile_y],
+                'key': first['checkpoint']['key'],
+                'checkpointed': True
+            }
+            return
+        pix_datas = itertools.chain([first], pix_datas)
+        unit = s.CHECKPOINT_BLOCK_UNIT % (tile_x, tile_y, label_key)
+
+        if label_key == s.STATE_LABEL:
+            state_key = utils.block_keyname(job, label_key, (tile_x, tile_y))
+            state_fn = utils.keyname2filename(state_key)
+            utils.write_states(pix_datas, out_fn=state_fn)
+            utils.upload([state_fn])
+            utils.write_checkpoint(
+                job, checkpoint, unit, utils.md5sum(state_fn))
+            self.count_transfers()
+            yield label_key, {'tile': [tile_x, tile_y], 'key': state_key}
+            return
+
+        block_start = time.time()
+        tile_size = utils.job_tile_size(utils.get_settings(job))
+
+        # name block so it uploads to correct location
+        block_key = utils.block_keyname(job, label_key, (tile_x, tile_y))
+        block_fn = utils.keyname2filename(block_key)
+
+        with self.timer('data2block'):
+            utils.data2block(
+                pix_datas, meta, (tile_x, tile_y), tile_size,
+                out_fn=block_fn, data_type=utils.label_data_type(label_key)
+            )
 
-    def output_reducer(self, label_key, pix_datas):
+        utils.upload([block_fn])
+        utils.write_checkpoint(job, checkpoint, unit, utils.md5sum(block_fn))
+        self.count('blocks_written')
+        transfers = self.count_transfers()
+        if self.trace is not None:
+            self.trace.log(
+                'block', label=label_key, tile=[tile_x, tile_y],
+                bytes=transfers['uploaded'],
+                seconds=time.time() - block_start
+            )
+        yield label_key, {'tile': [tile_x, tile_y], 'key': block_key}
+
+    def output_reducer(self, label_key, blocks):
         """
-        fill the data in to a raster image and return the
-        names of the generated images
+        Given a label and the keynames of all its raster blocks,
+        merge the blocks in to a single raster, upload it and return
+        the name of the generated image
+
+        If every block was finished in an earlier run that also finished
+        the raster, the raster is left as it is.
         """
-        # download a template raster
         job = os.environ.get('LT_JOB')
+        blocks = list(blocks)
 
-        rast_keys = utils.get_keys(s.IN_RASTS % job)
-        tmplt_key = [
-            k.key for k in rast_keys
-            if s.RAST_TRIGGER in k.key
-        ][0].key
-        tmplt_rast = utils.rast_dl(tmplt_key)
+        if label_key == s.STATE_LABEL:  # state stays split up by tile
+            yield label_key, [b['key'] for b in blocks]
+            return
+
+        raster_start = time.time()
+        meta = utils.read_json(s.OUT_META % job)
+        settings = utils.get_settings(job)
+
+        checkpoint = meta['checkpoint']
+        if all(b.get('checkpointed') for b in blocks) and \
+                utils.raster_checkpointed(job, checkpoint, label_key):
+            self.count('rasters_checkpointed')
+            yield label_key, [s.OUT_RAST_KEYNAME % (job, label_key)]
+            return
+
+        # trendline rasters have one band per year, described by date
+        band_names = None
+        if label_key.startswith(s.TRENDLINE_LABEL % ''):
+            target_date = settings['target_date']
+            band_names = [
+                '%s%s' % (yr, target_date[4:]) for yr in meta['years']
+            ]
+
+        data_type = utils.label_data_type(label_key)
+        compress = settings.get('output_compression', s.OUT_COMPRESSION)
+        predictor = utils.output_predictor(settings, data_type)
 
         # name raster so it uploads to correct location
         rast_key = s.OUT_RAST_KEYNAME % (job, label_key)
         rast_fn = utils.keyname2filename(rast_key)
 
-        # write data to raster
-        utils.data2raster(pix_datas, tmplt_rast, out_fn=rast_fn)
+        block_fns = [utils.get_file(b['key']) for b in blocks]
+        with self.timer('merge_blocks'):
+            utils.merge_blocks(
+                block_fns, meta, out_fn=rast_fn, data_type=data_type,
+                compress=compress, band_names=band_names, predictor=predictor
+            )
 
         # upload raster
         rast_key = utils.upload([rast_fn])[0]
+        utils.write_checkpoint(
+            job, checkpoint, s.CHECKPOINT_RASTER_UNIT % label_key,
+            utils.md5sum(rast_fn))
+        self.count('rasters_written')
+        transfers = self.count_transfers()
+        if self.trace is not None:
+            self.trace.log(
+                'raster', label=label_key, blocks=len(blocks),
+                bytes=transfers['uploaded'] + transfers['downloaded'],
+                seconds=time.time() - raster_start
+            )
         yield label_key, [rast_key.key]
 
     def steps(self):
         return [
-            self.mr(mapper=self.setup_mapper),
-            self.mr(mapper=self.parse_mapper, reducer=self.analysis_reducer),
-            self.mr(reducer=self.output_reducer)
+            self.mr(
+                mapper_init=partial(self.trace_start, 'setup_mapper'),
+                mapper=self.setup_mapper,
+                mapper_final=self.trace_end
+            ),
+            self.mr(
+                mapper_init=partial(self.trace_start, 'parse_mapper'),
+                mapper=self.parse_mapper,
+                mapper_final=self.trace_end,
+                combiner_init=self.analysis_combiner_init,
+                combiner=self.analysis_combiner,
+                reducer_init=self.analysis_reducer_init,
+                reducer=self.analysis_reducer,
+                reducer_final=self.analysis_reducer_final
+            ),
+            self.mr(
+                reducer_init=partial(self.trace_start, 'block_reducer'),
+                reducer=self.block_reducer,
+                reducer_final=self.trace_end
+            ),
+            self.mr(
+                reducer_init=partial(self.trace_start, 'output_reducer'),
+                reducer=self.output_reducer,
+                reducer_final=self.trace_end
+            )
         ]
 
     def job_runner_kwargs(self):
@@ -15,10 +15,137 @@ MASK_TRIGGER = 'cloudmask'  # to be used for masking
 
 NODATA = -99  # nodata value for rasters
 
+# pixels with more NODATA than this get no change labels
+# (see classes.Trendline.mostly_nodata)
+MAX_NODATA_FRACTION = 0.5
+MIN_SERIES_LENGTH = 3  # shorter series can't have a vertex in the middle
+
+# mrjob counter groups for job stats and stage timers
+COUNTER_GROUP = 'landtrendr'
+TIMER_GROUP = 'landtrendr_ms'
+
+# set this environment variable to N to time the stages of every Nth
+# utils.analyze call (summaries are uploaded to OUT_PROFILE_KEYNAME)
+PROFILE_ENV = 'LT_PROFILE'
+
+# set this environment variable to a directory to use it instead of
+# S3_BUCKET (see classes.LocalBucket), e.g. for offline scale tests
+LOCAL_STORAGE_ENV = 'LT_LOCAL_STORAGE'
+
+# set this environment variable (see land_trendr.py run --restart) to
+# recompute every tile of a job instead of resuming from its checkpoints
+RESTART_ENV = 'LT_RESTART'
+# tile size land_trendr.py run picked from the job's plan, for jobs whose
+# settings.json has no "tile_size" (see utils.job_tile_size)
+TILE_SIZE_ENV = 'LT_TILE_SIZE'
+
+# settings.json fields that don't change a job's output, so changing them
+# doesn't make its checkpoints stale (see utils.input_hash)
+CHECKPOINT_IGNORE = [
+    'memory_budget_mb', 'analysis_cache_size', 'prune_scenes', 'stack_scenes',
+    'reducers'
+]
+
+# max number of results kept by analysis_reducer's cache (0 - no cache),
+# override with "analysis_cache_size" in settings.json
+ANALYSIS_CACHE_SIZE = 0
+
+# memory each task may use (see utils.memory_budget).  Override with
+# "memory_budget_mb" in settings.json, otherwise tasks use
+# MEMORY_BUDGET_FRACTION of their container's memory (from the jobconf
+# keys below) or MEMORY_BUDGET when there's none.
+MEMORY_BUDGET = 1536 * 2 ** 20
+MEMORY_BUDGET_FRACTION = 0.8  # the rest is left for the JVM/streaming
+MIN_WINDOW_BUDGET = 16 * 2 ** 20  # windows never get smaller than this
+TASK_MEMORY_JOBCONF = {
+    'mapper': 'mapreduce.map.memory.mb',
+    'reducer': 'mapreduce.reduce.memory.mb'
+}
+REDUCERS_JOBCONF = 'mapreduce.job.reduces'
+
 IN_EMR_KEYNAME = '%s/input/emr_input.txt'  # % job
 IN_SETTINGS = '%s/input/settings.json'  # % job
 IN_RASTS = '%s/input/rasters/'  # % job
+IN_AOI = '%s/input/%s'  # % (job, aoi filename)
 
 
 OUT_GRID = '%s/output/pix_grid.csv'  # % job
+OUT_META = '%s/output/meta.json'  # % job
+OUT_PLAN = '%s/output/scene_plan.json'  # % job
+OUT_STACK = '%s/output/stack.json'  # % job - scenes read by stack jobs
 OUT_RAST_KEYNAME = '%s/output/rasters/%s.tif'  # % (job, label)
+OUT_BLOCK_KEYNAME = '%s/output/blocks/%s/%s_%s.tif'  # % (job, label, tx, ty)
+OUT_STATE = '%s/output/state/'  # % job
+OUT_STATE_KEYNAME = '%s/output/state/%s_%s.json'  # % (job, tx, ty)
+OUT_PROFILE_KEYNAME = '%s/output/profile/%s.json'  # % (job, task)
+OUT_TRACE = '%s/output/trace/'  # % job
+OUT_TRACE_KEYNAME = '%s/output/trace/%s.jsonl'  # % (job, '<stage>-<task>')
+# completion markers of each tile, block and raster, named by their
+# content hashes (see utils.read_checkpoints), under a prefix per hash of
+# the job's inputs so changing them makes every marker stale
+OUT_CHECKPOINT = '%s/output/checkpoint/%s/'  # % (job, input hash)
+CHECKPOINT_TILE_UNIT = 'tiles/%s_%s'  # % (tx, ty)
+CHECKPOINT_BLOCK_UNIT = 'tiles/%s_%s/%s'  # % (tx, ty, label)
+CHECKPOINT_RASTER_UNIT = 'rasters/%s'  # % label
+
+OUT_TILE_SIZE = 512  # default width/height in pixels of output blocks
+
+# tiles of a stack_scenes job each parse_mapper line covers, so their task
+# downloads and decompresses the scenes they share once
+# (see MRLandTrendrJob.parse_tile)
+STACK_TILES_PER_TASK = 4
+
+STATE_LABEL = 'state'  # output key for per-pixel fitting state
+VERTEX_LABEL = 'vertices'  # output key for per-pixel vertex table
+CHECKPOINT_LABEL = 'checkpoint'  # output key for the labels of each tile
+TRENDLINE_LABEL = 'trendline/%s'  # % attr - one band per year
+
+# vertex table bands, each repeated once per year of the job
+VERTEX_TABLE_FIELDS = ['year', 'val_fit', 'eqn_slope', 'eqn_intercept']
+
+LABEL_KEYS = ['class_val', 'onset_year', 'magnitude', 'duration']
+
+# smallest gdal data type that holds each kind of output (matched by the
+# end of the label key).  All of them must be able to hold NODATA.
+LABEL_DATA_TYPES = [
+    ('class_val', 'Int16'),
+    ('onset_year', 'Int16'),
+    ('duration', 'Int16'),
+    ('/spike', 'Int16'),
+    ('/vertex', 'Int16')
+]
+DEFAULT_DATA_TYPE = 'Float32'
+
+# output rasters are Cloud-Optimized GeoTIFFs
+OUT_COMPRESSION = 'DEFLATE'  # override with "output_compression" in settings.json
+COG_BLOCK_SIZE = 512  # internal tile size of output rasters
+
+# pre-flight planner estimates (see utils.plan_job)
+PLAN_TASK_OVERHEAD = 200 * 2 ** 20  # bytes of python/numpy/pandas/gdal per task
+PLAN_GRID_ROW_BYTES = 120  # bytes per grid point held by parse_mapper
+PLAN_PIXEL_BYTES = 500  # bytes per pixel of label data held by block_reducer
+PLAN_SAMPLE_SECONDS = 2e-5  # parse_mapper CPU seconds per sampled pixel
+PLAN_ANALYZE_SECONDS = 3e-4  # utils.analyze seconds per pixel per year**2
+PLAN_REDUCER_BYTES = 256 * 2 ** 20  # shuffle bytes to aim for per reducer
+PLAN_REDUCER_HOURS = 1.0  # analysis CPU hours to aim for per reducer
+PLAN_TILE_SIZES = [128, 256, 512, 1024, 2048]  # tile_size candidates
+
+# EMR instance types the planner picks from (name, memory GB, vCPUs),
+# cheapest first.  One task runs per vCPU.
+EMR_INSTANCE_TYPES = [
+    ('m3.xlarge', 15, 4),
+    ('r3.xlarge', 30.5, 4),
+    ('c3.2xlarge', 15, 8),
+    ('m3.2xlarge', 30, 8),
+    ('r3.2xlarge', 61, 8),
+    ('r3.4xlarge', 122, 16)
+]
+
+# previews (see land_trendr.py preview) run as their own job, on every
+# PREVIEW_STEP-th pixel of a random sample of PREVIEW_TILES tiles (of
+# the job's tile_size pixels) of the job's grid
+PREVIEW_JOB = '%s-preview'  # % job
+PREVIEW_STEP = 8
+PREVIEW_TILES = 16
+PREVIEW_PERCENTILES = [5, 25, 50, 75, 95]  # of the preview's label stats
+OUT_PREVIEW_SUMMARY = '%s/output/preview_summary.json'  # % preview job
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 from nose.tools import raises
@@ -32,10 +35,8 @@ class LabelRuleTestCase(unittest.TestCase):
 
 class TrendLineTestCase(unittest.TestCase):
 
-    def test_match(self):
-        line_cost = 2
-        target_date = utils.parse_date('2014-07-01')
-        values = [
+    def setUp(self):
+        self.values = [
             {'date': '2010-12-31', 'val': 10},
             {'date': '2011-12-31', 'val': 10},
             {'date': '2012-12-31', 'val': 10},
@@ -47,6 +48,11 @@ class TrendLineTestCase(unittest.TestCase):
             {'date': '2018-12-31', 'val': 10},
             {'date': '2019-12-31', 'val': 10}
         ]
+
+    def test_match(self):
+        line_cost = 2
+        target_date = utils.parse_date('2014-07-01')
+        values = self.values
         rule = classes.LabelRule({
             'name': 'fast_dist',
             'val': 2,
@@ -60,3 +66,112 @@ class TrendLineTestCase(unittest.TestCase):
         self.assertAlmostEqual(match.initial_val, 10.999999999)
         self.assertAlmostEqual(match.magnitude, 6.3999999999999)
         self.assertEqual(match.duration, 3)
+
+    def test_vertex_table(self):
+        target_date = utils.parse_date('2014-07-01')
+        trendline = utils.analyze(self.values, 2, target_date)
+        vertices = [p for p in trendline.points if p.vertex]
+        table = trendline.vertex_table(10)
+        self.assertEqual(len(table), 40)
+        self.assertEqual(table[:len(vertices)], [2010, 2013, 2016, 2019])
+        self.assertEqual(table[len(vertices):10], [-99] * 6)
+        self.assertAlmostEqual(table[10], vertices[0].val_fit)
+        self.assertAlmostEqual(table[20], vertices[0].eqn_right[0])
+
+    def test_mr_label_output(self):
+        target_date = utils.parse_date('2014-07-01')
+        trendline = utils.analyze(self.values[1:], 2, target_date)
+        out = trendline.mr_label_output(range(2010, 2020))
+        self.assertEqual(len(out), 8)
+        self.assertEqual(out['val_raw'], [-99] + [v['val'] for v in self.values[1:]])
+        self.assertEqual(out['vertex'][:2], [-99, 1])
+
+    def test_parse_disturbances(self):
+        target_date = utils.parse_date('2014-07-01')
+        trendline = utils.analyze(self.values, 2, target_date)
+        self.assertEqual(trendline.array.dtype, classes.TRENDLINE_DTYPE)
+        disturbances = trendline.parse_disturbances()
+        self.assertEqual([d.onset_year for d in disturbances], [2010, 2013, 2016])
+        self.assertEqual([d.duration for d in disturbances], [3, 3, 3])
+        self.assertAlmostEqual(
+            disturbances[0].magnitude,
+            trendline.points[0].val_fit - trendline.points[3].val_fit
+        )
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_evict(self):
+        cache = classes.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)  # b is now least recently used
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertAlmostEqual(cache.hit_rate(), 2 / 3.0)
+
+    @raises(ValueError)
+    def test_invalid_size(self):
+        classes.LRUCache(0)
+
+
+class StageProfilerTestCase(unittest.TestCase):
+
+    def test_sample(self):
+        profiler = classes.StageProfiler(3)
+        self.assertEqual([profiler.sample() for i in range(6)],
+                         [False, False, True, False, False, True])
+
+    def test_summary(self):
+        profiler = classes.StageProfiler()
+        profiler.record('despike', 0.00005)
+        profiler.record('despike', 0.00015)
+        summary = profiler.summary()['stages']['despike']
+        self.assertEqual(summary['count'], 2)
+        self.assertAlmostEqual(summary['mean_ms'], 0.1)
+        self.assertEqual(summary['histogram'], {'64': 1, '256': 1})
+
+
+class TraceLogTestCase(unittest.TestCase):
+
+    def test_write(self):
+        trace = classes.TraceLog('parse_mapper', 'task_0')
+        trace.log('task_start')
+        trace.log('scene', key='a.tif', rows=10)
+        trace_fn = trace.write('/tmp/test_trace.jsonl')
+        events = utils.read_traces([trace_fn])
+        self.assertEqual([e['event'] for e in events], ['task_start', 'scene'])
+        self.assertEqual(events[1]['stage'], 'parse_mapper')
+        self.assertEqual(events[1]['task'], 'task_0')
+        self.assertEqual(events[1]['rows'], 10)
+
+
+class LocalBucketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+        bucket = classes.LocalBucket(self.root)
+        bucket.new_key('job/input/settings.json').set_contents_from_string('{}')
+        bucket.new_key('job/output/meta.json').set_contents_from_string('[]')
+        self.assertEqual(
+            [k.key for k in bucket.list(prefix='job/input/')],
+            ['job/input/settings.json']
+        )
+        key = bucket.list(prefix='job/output/meta')[0]
+        self.assertEqual(key.get_contents_as_string(), '[]')
+        self.assertEqual(key.size, 2)
+        self.assertEqual(key.etag, '"d751713988987e9331980363e24189ce"')
+
+        fn = os.path.join(self.root, 'downloaded.json')
+        key.get_contents_to_filename(fn)
+        copy = bucket.new_key('job/output/copy.json')
+        copy.set_contents_from_filename(fn)
+        self.assertEqual(copy.get_contents_as_string(), '[]')
@@ -0,0 +1,289 @@
+"""
+Differential tests of the analysis engines.
+
+utils.analyze is the reference: every other engine (a function taking
+(pix_datas, line_cost, target_date) and returning a Trendline, see
+ENGINES) must find the same vertices, fitted values (within TOLERANCE)
+and change labels on the same pixel series - randomized ones (see
+random_pix_datas) and the recorded ones in tests/files/recorded_series.json.
+Divergent series are minimized (see minimize) before they're reported.
+Different vertices aren't a divergence when both segmentations cost the
+same (see segmentation_cost) - e.g. runs of identical values can be split
+in more than one optimal way.
+
+Runs with the rest of the tests.  For a deeper run:
+
+    PYTHONPATH=. python tests/differential_test.py --cases 2000 --seed 7
+"""
+import argparse
+import json
+import os
+import unittest
+
+import numpy as np
+
+import classes
+import settings as s
+import utils
+
+TOLERANCE = 1e-6
+LINE_COST = 10
+TARGET_DATE = utils.parse_date('2000-07-01')
+RECORDED_FN = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'files', 'recorded_series.json')
+LABEL_RULES = [
+    classes.LabelRule({'name': 'fd', 'val': 1, 'change_type': 'FD'}),
+    classes.LabelRule({'name': 'gd', 'val': 2, 'change_type': 'GD',
+                       'duration': ['<', 4]}),
+    classes.LabelRule({'name': 'ld', 'val': 3, 'change_type': 'LD',
+                       'pre_threshold': ['>', 100]})
+]
+# number of randomized cases in the test run (override with LT_DIFF_CASES)
+CASES = int(os.environ.get('LT_DIFF_CASES', 50))
+
+
+def incremental_engine(pix_datas, line_cost, target_date):
+    return utils.analyze_incremental(pix_datas, line_cost, target_date)[0]
+
+
+def extended_engine(pix_datas, line_cost, target_date):
+    """
+    analyze_incremental on the first half of the years, then extended
+    with the rest (the way a job with a prior_job runs).  Prior jobs
+    need at least settings.MIN_SERIES_LENGTH years to be fit on their own.
+    """
+    years = sorted(set(utils.as_datecode(d['date']) // 1000
+                       for d in pix_datas))
+    if len(years) // 2 < s.MIN_SERIES_LENGTH:
+        return incremental_engine(pix_datas, line_cost, target_date)
+    split = years[len(years) // 2]
+    old = [d for d in pix_datas if utils.as_datecode(d['date']) // 1000 < split]
+    new = [d for d in pix_datas if utils.as_datecode(d['date']) // 1000 >= split]
+    _, state = utils.analyze_incremental(old, line_cost, target_date)
+    return utils.analyze_incremental(new, line_cost, target_date, state)[0]
+
+
+def cached_engine(pix_datas, line_cost, target_date):
+    cache = classes.LRUCache(1)
+    return utils.analyze_cached(
+        pix_datas, line_cost, target_date, LABEL_RULES, cache)[0]
+
+
+REFERENCE = utils.analyze
+ENGINES = {
+    'incremental': incremental_engine,
+    'extended': extended_engine,
+    'cached': cached_engine
+}
+
+
+def random_pix_datas(rand):
+    """
+    Given a numpy RandomState, return a random pixel series (see
+    utils.analyze): 3-30 years of 1-3 scenes each, with steps, trends,
+    spikes, constant runs and NODATA mixed in
+    """
+    num_years = rand.randint(3, 31)
+    first_year = rand.randint(1984, 2000)
+    vals = np.cumsum(rand.normal(0, 20, num_years)) + rand.uniform(-500, 500)
+    for i in range(rand.randint(0, 3)):  # steps (disturbances/recoveries)
+        vals[rand.randint(0, num_years):] += rand.uniform(-800, 800)
+    if rand.random_sample() < 0.1:
+        vals[:] = rand.randint(-100, 100)  # constant
+    vals = np.round(vals, rand.choice([0, 2]))
+
+    pix_datas = []
+    for i, val in enumerate(vals):
+        for j in range(rand.randint(1, 4)):
+            v = val + rand.normal(0, 10) if j else val
+            if rand.random_sample() < 0.05:
+                v += rand.choice([-1, 1]) * 2000  # spike
+            if rand.random_sample() < 0.1:
+                v = s.NODATA
+            pix_datas.append({
+                'date': (first_year + i) * 1000 + rand.randint(150, 220),
+                'val': float(v)
+            })
+    return pix_datas
+
+
+def recorded_pix_datas():
+    """
+    Returns the recorded pixel series, in the format:
+    [{'name': X, 'pix_datas': [...]}, ...]
+    """
+    with open(RECORDED_FN) as f:
+        return json.load(f)
+
+
+def run_engine(engine, pix_datas):
+    """
+    Given an engine and a pixel series, return its Trendline and labels
+    (or the exception it raised, as the result)
+    """
+    try:
+        trendline = engine(pix_datas, LINE_COST, TARGET_DATE)
+    except Exception as e:
+        return '%s: %s' % (type(e).__name__, e), None
+    return trendline, utils.change_labeling(trendline, LABEL_RULES)
+
+
+def segmentation_cost(trendline, line_cost):
+    """
+    Given a Trendline, return the cost segmented_least_squares minimizes
+    for its vertices: the sum of the squared residuals of each segment's
+    least squares line, plus line_cost per segment
+    """
+    arr = trendline.array[~trendline.array['spike']]
+    xs, ys = arr['index_day'].astype(float), arr['val_raw']
+    starts = np.flatnonzero(arr['vertex'])[:-1]
+    ends = list(starts[1:]) + [len(arr)]
+    cost = 0.0
+    for start, end in zip(starts, ends):
+        x, y = xs[start:end], ys[start:end]
+        if len(x) > 2:
+            fit = np.polyval(np.polyfit(x, y, 1), x)
+            cost += ((fit - y) ** 2).sum()
+        cost += line_cost
+    return cost
+
+
+def divergence(pix_datas, engine):
+    """
+    Given a pixel series and an engine, return a description of how its
+    result differs from the reference's, or None if it doesn't
+    """
+    ref, ref_labels = run_engine(REFERENCE, pix_datas)
+    alt, alt_labels = run_engine(engine, pix_datas)
+    if isinstance(ref, str) or isinstance(alt, str):
+        if isinstance(ref, str) and isinstance(alt, str):
+            return None  # both reject the series
+        return 'reference: %s, engine: %s' % (
+            ref if isinstance(ref, str) else 'ok',
+            alt if isinstance(alt, str) else 'ok')
+
+    if ref.array['index_date'].tolist() != alt.array['index_date'].tolist():
+        return 'dates: %s != %s' % (
+            ref.array['index_date'].tolist(), alt.array['index_date'].tolist())
+
+    ref_vertices = ref.array['index_date'][ref.array['vertex']].tolist()
+    alt_vertices = alt.array['index_date'][alt.array['vertex']].tolist()
+    if ref_vertices != alt_vertices:
+        ref_cost = segmentation_cost(ref, LINE_COST)
+        alt_cost = segmentation_cost(alt, LINE_COST)
+        same_points = np.allclose(ref.array['val_raw'], alt.array['val_raw'],
+                                  rtol=TOLERANCE, atol=TOLERANCE,
+                                  equal_nan=True)
+        if same_points and np.isclose(ref_cost, alt_cost,
+                                      rtol=TOLERANCE, atol=TOLERANCE):
+            return None  # equally optimal
+        return 'vertices: %s != %s (cost %s != %s)' % (
+            ref_vertices, alt_vertices, ref_cost, alt_cost)
+
+    if not np.allclose(ref.array['val_fit'], alt.array['val_fit'],
+                       rtol=TOLERANCE, atol=TOLERANCE, equal_nan=True):
+        return 'val_fit: %s != %s' % (
+            ref.array['val_fit'].tolist(), alt.array['val_fit'].tolist())
+
+    if sorted(ref_labels) != sorted(alt_labels):
+        return 'labels: %s != %s' % (sorted(ref_labels), sorted(alt_labels))
+    for name, label in ref_labels.iteritems():
+        for key, val in label.iteritems():
+            if not np.isclose(val, alt_labels[name][key],
+                              rtol=TOLERANCE, atol=TOLERANCE):
+                return '%s %s: %s != %s' % (
+                    name, key, val, alt_labels[name][key])
+    return None
+
+
+def minimize(pix_datas, engine):
+    """
+    Given a pixel series an engine diverges on, greedily drop
+    observations (and round values) as long as it still diverges, and
+    return the smallest diverging series found
+    """
+    current = list(pix_datas)
+    shrunk = True
+    while shrunk:
+        shrunk = False
+        for i in range(len(current)):
+            candidate = current[:i] + current[i + 1:]
+            if candidate and divergence(candidate, engine):
+                current = candidate
+                shrunk = True
+                break
+    rounded = [dict(d, val=float(round(d['val']))) for d in current]
+    if divergence(rounded, engine):
+        current = rounded
+    return current
+
+
+def find_divergences(cases, seed=0):
+    """
+    Run every engine against the reference on the recorded series and
+    on the given number of randomized ones, and return a list of:
+    {'engine': X, 'case': X, 'divergence': X, 'minimized': [...]}
+    """
+    rand = np.random.RandomState(seed)
+    series = [(r['name'], r['pix_datas']) for r in recorded_pix_datas()]
+    series += [('random-%s-%s' % (seed, i), random_pix_datas(rand))
+               for i in range(cases)]
+
+    found = []
+    for name, engine in sorted(ENGINES.iteritems()):
+        for case, pix_datas in series:
+            diff = divergence(pix_datas, engine)
+            if diff is None:
+                continue
+            minimized = minimize(pix_datas, engine)
+            found.append({
+                'engine': name,
+                'case': case,
+                'divergence': divergence(minimized, engine),
+                'minimized': minimized
+            })
+    return found
+
+
+def report(found):
+    return '\n'.join(
+        '%(engine)s diverged on %(case)s: %(divergence)s\n'
+        '    minimized: %(minimized)s' % f for f in found
+    )
+
+
+class DifferentialTestCase(unittest.TestCase):
+
+    def test_reference_agrees_with_itself(self):
+        rand = np.random.RandomState(1)
+        for i in range(5):
+            self.assertEqual(divergence(random_pix_datas(rand), REFERENCE),
+                             None)
+
+    def test_minimize(self):
+        # an engine that drops the last observation diverges on anything
+        # with a vertex at the end - minimize keeps it small
+        def dropping_engine(pix_datas, line_cost, target_date):
+            return utils.analyze(pix_datas[:-1], line_cost, target_date)
+        pix_datas = [{'date': (1990 + i) * 1000 + 182, 'val': float(v)}
+                     for i, v in enumerate([10, 10, 10, 500, 500, 600, 100])]
+        self.assertTrue(divergence(pix_datas, dropping_engine))
+        minimized = minimize(pix_datas, dropping_engine)
+        self.assertTrue(len(minimized) < len(pix_datas))
+        self.assertTrue(divergence(minimized, dropping_engine))
+
+    def test_engines(self):
+        found = find_divergences(CASES)
+        self.assertEqual(found, [], report(found))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the analysis engines against utils.analyze')
+    parser.add_argument('--cases', type=int, default=1000,
+                        help='Number of randomized series')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    found = find_divergences(args.cases, args.seed)
+    print report(found) or 'No divergences in %s randomized cases' % args.cases
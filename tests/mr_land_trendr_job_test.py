@@ -1,5 +1,6 @@
 import unittest
 
+import utils
 from mr_land_trendr_job import MRLandTrendrJob
 
 
@@ -15,4 +16,55 @@ class MRLandTrendrJobTestCase(unittest.TestCase):
 
     def test_steps(self):
         job = MRLandTrendrJob('')
-        self.assertEquals(len(job.steps()), 3)
+        self.assertEquals(len(job.steps()), 4)
+
+    def test_analysis_combiner(self):
+        job = MRLandTrendrJob('')
+        job.target_date = utils.parse_date('2014-07-01')
+        pix_datas = [
+            {'date': '2011-09-01', 'val': 1.0},
+            {'date': '2011-07-05', 'val': 2.0},
+            {'date': '2012-05-01', 'val': 3.0},
+            {'state': {'winners': []}}
+        ]
+        out = [d for _, d in job.analysis_combiner('POINT(1 1)', pix_datas)]
+        self.assertEquals(len(out), 3)
+        self.assertTrue({'state': {'winners': []}} in out)
+        self.assertTrue({'date': '2011-07-05', 'val': 2.0} in out)
+        self.assertTrue({'date': '2012-05-01', 'val': 3.0} in out)
+
+    def test_flush_counters(self):
+        job = MRLandTrendrJob('')
+        written = []
+        job.increment_counter = lambda *args: written.append(args)
+        for _ in range(1000):
+            job.count('pixels_analyzed')
+            with job.timer('analyze'):
+                pass
+        job.count('hits', group='analysis_cache')
+        job.task_stages['analyze'] = 0.0004 * 1000  # sub-ms per call
+        self.assertEquals(written, [])
+
+        job.flush_counters()
+        self.assertEquals(sorted(written), [
+            ('analysis_cache', 'hits', 1),
+            ('landtrendr', 'pixels_analyzed', 1000),
+            ('landtrendr_ms', 'analyze_ms', 400)
+        ])
+        job.flush_counters()
+        self.assertEquals(len(written), 3)
+
+    def test_stack_scene(self):
+        job = MRLandTrendrJob('')
+        downloads = []
+        rast_dl, mask_dl = utils.rast_dl, utils.mask_dl
+        utils.rast_dl = lambda k: downloads.append(k) or k + '.tif'
+        utils.mask_dl = lambda k: None
+        try:
+            for _ in range(3):  # e.g. 3 tiles sharing the scene
+                self.assertEquals(
+                    job.stack_scene('a_ledaps.tar.gz'),
+                    ('a_ledaps.tar.gz.tif', None))
+        finally:
+            utils.rast_dl, utils.mask_dl = rast_dl, mask_dl
+        self.assertEquals(downloads, ['a_ledaps.tar.gz'])
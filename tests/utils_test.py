@@ -1,6 +1,8 @@
 from datetime import datetime
+import json
 import os
 import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 import unittest
@@ -8,6 +10,8 @@ import unittest
 from nose.tools import raises
 from osgeo import gdal
 
+import classes
+import settings as s
 import utils
 
 class UtilsDecompressTestCase(unittest.TestCase):
@@ -40,6 +44,16 @@ class DateTestCase(unittest.TestCase):
     def test_filename2date(self):
         self.assertEquals(utils.filename2date('/tmp/4529_2012_222_ledaps.tif'), '2012-08-09')
 
+    def test_filename2datecode(self):
+        self.assertEquals(utils.filename2datecode('/tmp/4529_2012_222_ledaps.tif'), 2012222)
+
+    def test_datecodes(self):
+        self.assertEquals(utils.date2code(datetime(2012,8,9)), 2012222)
+        self.assertEquals(utils.code2date(2012222), datetime(2012,8,9))
+        self.assertEquals(utils.as_datecode('2012-08-09'), 2012222)
+        self.assertEquals(utils.as_datecode(2012222), 2012222)
+        self.assertEquals(utils.date_table([2012222, 2012222]), {2012222: '2012-08-09'})
+
 class ParseEqnTestCase(unittest.TestCase):
 
     def test_no_match(self):
@@ -124,6 +138,79 @@ class RastUtilsTestCase(unittest.TestCase):
         )
         os.remove(alg_fn)
 
+    def test_blocks(self):
+        meta = utils.rast2meta(self.template_fn)
+        self.assertEquals(meta['size'], [54, 45])
+        grid = utils.rast2grid(self.template_fn)
+        data = [
+            {'pix_ctr_wkt': wkt, 'value': [pix['val'], 1]}
+            for wkt, pix in utils.apply_grid(self.template_fn, grid)
+        ]
+        tiles = {}
+        for d in data:
+            tile = tuple(utils.point2tile(d['pix_ctr_wkt'], meta['geotransform'], 32))
+            tiles.setdefault(tile, []).append(d)
+        self.assertEquals(sorted(tiles), [(0, 0), (0, 1), (1, 0), (1, 1)])
+
+        block_fns = [
+            utils.data2block(d, meta, tile, 32, out_fn='/tmp/block_%s_%s.tif' % tile)
+            for tile, d in tiles.iteritems()
+        ]
+        out_fn = utils.merge_blocks(block_fns, meta, out_fn='/tmp/merged.tif')
+        merged = utils.ds2bands(gdal.Open(out_fn))
+        np.testing.assert_array_equal(
+            merged[0], utils.ds2array(gdal.Open(self.template_fn)))
+        self.assertTrue(np.all(merged[1] == 1))
+        for fn in block_fns + [out_fn, grid]:
+            os.remove(fn)
+
+    def test_output_predictor(self):
+        self.assertEqual(utils.output_predictor({}, gdal.GDT_Int16), 2)
+        self.assertEqual(utils.output_predictor({}, gdal.GDT_Float32), 3)
+        settings = {'output_predictor': 3}
+        self.assertEqual(utils.output_predictor(settings, gdal.GDT_Byte), 2)
+        self.assertEqual(utils.output_predictor(settings, gdal.GDT_Float32), 3)
+        settings = {'output_predictor': 1}
+        self.assertEqual(utils.output_predictor(settings, gdal.GDT_Int16), 1)
+        settings = {'output_predictor': {'int': 1, 'float': 2}}
+        self.assertEqual(utils.output_predictor(settings, gdal.GDT_Int16), 1)
+        self.assertEqual(utils.output_predictor(settings, gdal.GDT_Float64), 2)
+        settings = {'output_predictor': {'float': 2}}
+        self.assertEqual(utils.output_predictor(settings, gdal.GDT_Int16), 2)
+
+    def test_cog_integer_predictor(self):
+        # a floating point predictor override still writes integer labels
+        meta = utils.rast2meta(self.template_fn)
+        ds = utils.create_raster('/tmp/test_block.tif', meta, data_type=gdal.GDT_Int16)
+        ds.GetRasterBand(1).WriteArray(utils.ds2array(gdal.Open(self.template_fn)))
+        ds = None
+        predictor = utils.output_predictor(
+            {'output_predictor': 3}, gdal.GDT_Int16)
+        out_fn = utils.merge_blocks(
+            ['/tmp/test_block.tif'], meta, '/tmp/test_cog.tif',
+            data_type=gdal.GDT_Int16, compress='DEFLATE', predictor=predictor)
+        out_ds = gdal.Open(out_fn)
+        self.assertEquals(out_ds.GetRasterBand(1).DataType, gdal.GDT_Int16)
+        np.testing.assert_array_equal(
+            utils.ds2array(out_ds), utils.ds2array(gdal.Open(self.template_fn)))
+        os.remove('/tmp/test_block.tif')
+        os.remove(out_fn)
+
+    def test_cog(self):
+        meta = utils.rast2meta(self.template_fn)
+        ds = utils.create_raster('/tmp/test_block.tif', meta, data_type=gdal.GDT_Int16)
+        ds.GetRasterBand(1).WriteArray(utils.ds2array(gdal.Open(self.template_fn)))
+        ds = None
+        out_fn = utils.merge_blocks(
+            ['/tmp/test_block.tif'], meta, '/tmp/test_cog.tif',
+            data_type=gdal.GDT_Int16, compress='DEFLATE', predictor=2)
+        out_ds = gdal.Open(out_fn)
+        self.assertEquals(out_ds.GetRasterBand(1).DataType, gdal.GDT_Int16)
+        self.assertEquals(out_ds.GetRasterBand(1).GetNoDataValue(), -99)
+        self.assertFalse(os.path.exists('/tmp/test_cog.tif.merge.tif'))
+        os.remove('/tmp/test_block.tif')
+        os.remove(out_fn)
+
     def test_grid(self):
         grid = utils.rast2grid(self.template_fn)
         pix_data = list(utils.apply_grid(self.template_fn, grid, {'x': 'y'}))
@@ -131,6 +218,380 @@ class RastUtilsTestCase(unittest.TestCase):
         os.remove(grid)
 
 
+class JobStatsTestCase(unittest.TestCase):
+
+    def test_counter_summary(self):
+        counters = [
+            {'landtrendr': {'pixels_sampled': 300}, 'landtrendr_ms': {'apply_grid_ms': 1000}},
+            {'landtrendr': {'pixels_sampled': 100, 'pixels_analyzed': 50}, 'landtrendr_ms': {'analyze_ms': 500}}
+        ]
+        self.assertEqual(
+            utils.merge_counters(counters)['landtrendr'],
+            {'pixels_sampled': 400, 'pixels_analyzed': 50}
+        )
+        summary = utils.counter_summary(counters)
+        self.assertTrue('landtrendr.pixels_sampled: 400' in summary)
+        self.assertTrue('pixels_sampled per second: 400.0' in summary)
+        self.assertTrue('pixels_analyzed per second: 100.0' in summary)
+
+    def test_trace_report(self):
+        def end(stage, task, t, seconds, rows=0):
+            return {'event': 'task_end', 'stage': stage, 'task': task,
+                    'time': t, 'seconds': seconds, 'peak_rss_kb': 100,
+                    'stages': {'analyze': seconds / 2.0},
+                    'counts': {'pixels_analyzed': rows}}
+        events = [
+            end('parse_mapper', 'm0', 10, 10),
+            end('parse_mapper', 'm1', 11, 11),
+            {'event': 'scene', 'stage': 'parse_mapper', 'task': 'm1',
+             'time': 5, 'key': 'slow.tif', 'seconds': 4, 'bytes': 10},
+            end('analysis_reducer', 'r0', 20, 2, rows=100),
+            end('analysis_reducer', 'r1', 21, 3, rows=100),
+            end('analysis_reducer', 'r2', 30, 12, rows=400),
+        ]
+        report = utils.trace_report(events)
+        self.assertEqual(
+            report[0],
+            'parse_mapper: 2 tasks, span 11.0s, median 10.5s, max 11.0s, '
+            'peak rss 100KB'
+        )
+        self.assertTrue('critical path: 23.0s' in report)
+        self.assertTrue('straggler: analysis_reducer r2 took 12.0s' in report)
+        self.assertTrue(
+            'slow scene: slow.tif in parse_mapper m1: 4.0s, 10 bytes' in report)
+        self.assertEqual(
+            report[-1],
+            'analysis_reducer skew: max 400 rows, median 100 rows (4.0x)'
+        )
+
+
+class MemoryBudgetTestCase(unittest.TestCase):
+
+    def test_memory_budget(self):
+        self.assertEqual(utils.memory_budget({}), s.MEMORY_BUDGET)
+        self.assertEqual(utils.memory_budget({}, '1000'), 800 * 2 ** 20)
+        self.assertEqual(
+            utils.memory_budget({'memory_budget_mb': 512}, '1000'), 512 * 2 ** 20)
+
+    def test_job_tile_size(self):
+        self.assertEqual(utils.job_tile_size({}), s.OUT_TILE_SIZE)
+        self.assertEqual(utils.job_tile_size({'tile_size': 256}), 256)
+        os.environ[s.TILE_SIZE_ENV] = '1024'
+        try:
+            self.assertEqual(utils.job_tile_size({}), 1024)
+            self.assertEqual(utils.job_tile_size({'tile_size': 256}), 256)
+        finally:
+            del os.environ[s.TILE_SIZE_ENV]
+
+    def test_window_rows(self):
+        self.assertEqual(utils.window_rows(100, None, 50), 50)
+        self.assertEqual(utils.window_rows(100, 1050, 50), 10)
+        self.assertEqual(utils.window_rows(100, 10, 50), 1)
+
+    def test_adapt_budget(self):
+        mb = 2 ** 20
+        # within budget - unchanged
+        self.assertEqual(utils.adapt_budget(500 * mb, 1000 * mb, 200 * mb, 900 * mb), 500 * mb)
+        # windows took 1200MB instead of 800MB - scale them down
+        self.assertEqual(utils.adapt_budget(800 * mb, 1000 * mb, 200 * mb, 1400 * mb), int(800 * mb * 2 / 3.0))
+        # never below the minimum
+        self.assertEqual(utils.adapt_budget(20 * mb, 300 * mb, 200 * mb, 2000 * mb), s.MIN_WINDOW_BUDGET)
+
+    def test_read_grid(self):
+        meta = {'geotransform': [0, 30, 0, 0, 0, -30], 'size': [3, 4]}
+        grid_fn = utils.meta2grid(meta, out_csv='/tmp/test_read_grid.csv')
+        chunks = list(utils.read_grid(grid_fn))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(len(chunks[0]), 12)
+        small_chunks = list(utils.read_grid(grid_fn, s.PLAN_GRID_ROW_BYTES * 5))
+        self.assertEqual([len(c) for c in small_chunks], [5, 5, 2])
+        self.assertEqual(np.concatenate(small_chunks).tolist(), chunks[0].tolist())
+
+
+class CheckpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.environ[s.LOCAL_STORAGE_ENV] = self.root
+        self.bucket = utils.get_bucket()
+
+    def tearDown(self):
+        del os.environ[s.LOCAL_STORAGE_ENV]
+        shutil.rmtree(self.root)
+
+    def put(self, keyname, contents):
+        key = self.bucket.new_key(keyname)
+        key.set_contents_from_string(contents)
+        return key
+
+    def finish_block(self, label_key, tile, contents):
+        keyname = utils.block_keyname('job', label_key, tile)
+        self.put(keyname, contents)
+        utils.write_checkpoint(
+            'job', 'abc', s.CHECKPOINT_BLOCK_UNIT % (tile + (label_key,)),
+            utils.key_md5s(keyname)[keyname])
+        return keyname
+
+    def test_input_hash(self):
+        keys = [self.put('job/input/rasters/a.tar.gz', 'a')]
+        settings = {'line_cost': 10}
+        meta = {
+            'geotransform': [0, 30, 0, 0, 0, -30],
+            'size': [20, 10],
+            'projection': ''
+        }
+        h = utils.input_hash(settings, keys, meta, 512)
+        self.assertEqual(utils.input_hash(
+            dict(settings, memory_budget_mb=512), keys, meta, 512), h)
+        self.assertNotEqual(utils.input_hash(
+            dict(settings, line_cost=5), keys, meta, 512), h)
+        self.assertNotEqual(utils.input_hash(settings, keys, meta, 256), h)
+        self.assertNotEqual(utils.input_hash(
+            settings, keys, dict(meta, size=[20, 11]), 512), h)
+
+        # a replaced aoi file under the same name
+        aoi_keys = [self.put('job/input/aoi.geojson', '{}')]
+        h = utils.input_hash(settings, keys + aoi_keys, meta, 512)
+        aoi_keys = [self.put('job/input/aoi.geojson', '{"type": 1}')]
+        self.assertNotEqual(
+            utils.input_hash(settings, keys + aoi_keys, meta, 512), h)
+
+        keys = [self.put('job/input/rasters/a.tar.gz', 'b')]
+        self.assertNotEqual(
+            utils.input_hash(settings, keys + aoi_keys, meta, 512), h)
+
+    def test_s3_vsi_path(self):
+        # local storage is read in place, without a copy in the download dir
+        self.put('job/scene.tar.gz', 'x')
+        self.assertEqual(
+            utils.s3_vsi_path('job/scene.tar.gz'),
+            os.path.join(self.root, 'job/scene.tar.gz')
+        )
+
+    def test_aoi_keyname(self):
+        self.assertEqual(utils.aoi_keyname('POLYGON((0 0, 1 0, 0 0))', 'job'),
+                         None)
+        self.assertEqual(utils.aoi_keyname('aoi.zip', 'job'), 'job/input/aoi.zip')
+
+    def test_read_checkpoints(self):
+        self.assertEqual(utils.read_checkpoints('job', 'abc'),
+                         {'tiles': {}, 'rasters': {}})
+
+        # tile (0, 0) is finished, (1, 0) is missing a block and (0, 1)
+        # was never marked finished
+        vertices_key = self.finish_block(s.VERTEX_LABEL, (0, 0), 'v')
+        state_key = self.finish_block(s.STATE_LABEL, (0, 0), 's')
+        utils.write_checkpoint(
+            'job', 'abc', s.CHECKPOINT_TILE_UNIT % (0, 0),
+            utils.labels_md5([s.VERTEX_LABEL, s.STATE_LABEL]))
+        self.finish_block(s.VERTEX_LABEL, (1, 0), 'v')
+        utils.write_checkpoint(
+            'job', 'abc', s.CHECKPOINT_TILE_UNIT % (1, 0),
+            utils.labels_md5([s.VERTEX_LABEL, 'gd_class_val']))
+        self.finish_block(s.VERTEX_LABEL, (0, 1), 'v')
+
+        rast_key = s.OUT_RAST_KEYNAME % ('job', 'gd_class_val')
+        self.put(rast_key, 'r')
+        utils.write_checkpoint(
+            'job', 'abc', s.CHECKPOINT_RASTER_UNIT % 'gd_class_val',
+            utils.key_md5s(rast_key)[rast_key])
+
+        checkpoints = utils.read_checkpoints('job', 'abc')
+        self.assertEqual(checkpoints['tiles'].keys(), [(0, 0)])
+        self.assertEqual(
+            checkpoints['tiles'][(0, 0)][s.STATE_LABEL]['key'], state_key)
+        self.assertEqual(checkpoints['rasters'].keys(), ['gd_class_val'])
+        self.assertTrue(utils.raster_checkpointed('job', 'abc', 'gd_class_val'))
+        self.assertFalse(utils.raster_checkpointed('job', 'abc', 'gd_magnitude'))
+
+        # changed outputs aren't finished, and neither are their tiles
+        self.put(vertices_key, 'changed')
+        self.put(rast_key, 'changed')
+        self.assertEqual(utils.read_checkpoints('job', 'abc'),
+                         {'tiles': {}, 'rasters': {}})
+        self.assertFalse(utils.raster_checkpointed('job', 'abc', 'gd_class_val'))
+
+        # markers of other inputs don't count
+        self.assertEqual(utils.read_checkpoints('job', 'def'),
+                         {'tiles': {}, 'rasters': {}})
+
+    def test_pinned_tile_size(self):
+        self.assertEqual(utils.pinned_tile_size('job', {}), None)
+        self.assertEqual(utils.pinned_tile_size('job', {'tile_size': 256}), 256)
+
+        # a run picked 1024 and finished a tile
+        keys = [self.put('job/input/rasters/a.tar.gz', 'a')]
+        settings = {'line_cost': 10, 'memory_budget_mb': 1536}
+        meta = {
+            'geotransform': [0, 30, 0, 0, 0, -30],
+            'size': [2000, 1000],
+            'projection': '',
+            'tile_size': 1024
+        }
+        self.put(s.OUT_META % 'job', json.dumps(meta))
+        checkpoint = utils.input_hash(settings, keys, meta, 1024)
+        keyname = utils.block_keyname('job', s.VERTEX_LABEL, (1, 0))
+        self.put(keyname, 'v')
+        utils.write_checkpoint(
+            'job', checkpoint, s.CHECKPOINT_BLOCK_UNIT % (1, 0, s.VERTEX_LABEL),
+            utils.key_md5s(keyname)[keyname])
+        utils.write_checkpoint(
+            'job', checkpoint, s.CHECKPOINT_TILE_UNIT % (1, 0),
+            utils.labels_md5([s.VERTEX_LABEL]))
+
+        # raising the budget (which could change the plan's tile size)
+        # keeps the tile size, and so the finished tile
+        settings['memory_budget_mb'] = 100000
+        tile_size = utils.pinned_tile_size('job', settings)
+        self.assertEqual(tile_size, 1024)
+        finished = utils.read_checkpoints(
+            'job', utils.input_hash(settings, keys, meta, tile_size))['tiles']
+        self.assertEqual(finished.keys(), [(1, 0)])
+
+        self.assertEqual(utils.pinned_tile_size('job', settings, True), None)
+        del meta['tile_size']  # a run from before tile sizes were picked
+        self.put(s.OUT_META % 'job', json.dumps(meta))
+        self.assertEqual(
+            utils.pinned_tile_size('job', settings), s.OUT_TILE_SIZE)
+
+    def test_resume_plan(self):
+        plan = {'a': None, 'b': [[1, 0]], 'c': [[0, 0], [1, 1]]}
+        tiles = [[0, 0], [1, 0], [0, 1], [1, 1]]
+        self.assertEqual(utils.resume_plan(plan, tiles, {}), plan)
+        self.assertEqual(
+            utils.resume_plan(plan, tiles, {(1, 0): {}, (1, 1): {}}),
+            {'a': [[0, 0], [0, 1]], 'c': [[0, 0]]}
+        )
+
+
+class PreviewTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.meta = {
+            'geotransform': [0, 30, 0, 0, 0, -30],
+            'size': [40, 20],
+            'projection': ''
+        }
+
+    def test_preview_grid(self):
+        meta, mask = utils.preview_grid(self.meta, None, 4, None, 8)
+        self.assertEqual(meta['size'], [10, 5])
+        self.assertEqual(meta['geotransform'], [0, 120, 0, 0, 0, -120])
+        self.assertTrue(mask.all())
+
+        # preview pixels sample the grid pixel at their centers
+        aoi_mask = np.zeros((20, 40), dtype=bool)
+        aoi_mask[6, 10] = True
+        aoi_mask[7, 11] = True
+        meta, mask = utils.preview_grid(self.meta, aoi_mask, 4, None, 8)
+        self.assertEqual(zip(*np.where(mask)), [(1, 2)])
+
+    def test_preview_grid_tiles(self):
+        # 5 x 3 tiles of 8 pixels, 2 of them sampled
+        meta, mask = utils.preview_grid(self.meta, None, 2, 2, 8, seed=1)
+        self.assertEqual(mask.shape, (10, 20))
+        self.assertEqual(mask.sum(), 2 * 4 * 4)
+        self.assertEqual(len(utils.tiles_with(mask, 4)), 2)
+        meta, same_mask = utils.preview_grid(self.meta, None, 2, 2, 8, seed=1)
+        self.assertEqual(mask.tolist(), same_mask.tolist())
+
+    def test_preview_windows(self):
+        meta, mask = utils.preview_grid(self.meta, None, 2, 2, 8, seed=1)
+        windows = utils.preview_windows(mask, 2, 8)
+        self.assertEqual(len(windows), 2)
+        covered = np.zeros(mask.shape, dtype=bool)
+        for x0, y0, x1, y1 in windows:
+            self.assertEqual((x1 - x0, y1 - y0), (4, 4))
+            covered[y0:y1, x0:x1] = True
+        self.assertEqual(covered.tolist(), mask.tolist())
+
+    def test_preview_summary(self):
+        nd = s.NODATA
+        # 3 pixels - 5 year segments, a 10 year one and no vertices
+        table = np.array([
+            [1990, 1990, nd], [1995, 2000, nd], [2000, nd, nd],
+            [500, 100, nd], [100, 300, nd], [400, nd, nd],
+            [nd] * 3, [nd] * 3, [nd] * 3,
+            [nd] * 3, [nd] * 3, [nd] * 3
+        ], dtype=float)
+        label_rules = [classes.LabelRule(
+            {'name': 'gd', 'val': 1, 'change_type': 'GD',
+             'duration': ['<', 8]})]
+        summary = utils.preview_summary(table, label_rules)
+        self.assertEqual(summary['pixels'], 2)
+        self.assertEqual(summary['vertices'], {2: 1, 3: 1})
+        gd = summary['labels']['gd']
+        self.assertEqual(gd['pixels'], 1)
+        self.assertEqual(gd['fraction'], 0.5)
+        self.assertEqual(gd['magnitude'][50], 400)
+        self.assertEqual(gd['onset_year'][50], 1990)
+
+        lines = utils.preview_report(json.loads(json.dumps(summary)))
+        self.assertEqual(lines[:3], [
+            'fitted pixels: 2',
+            '2 vertices: 1 pixels (50.0%)',
+            '3 vertices: 1 pixels (50.0%)'
+        ])
+        self.assertEqual(lines[3], 'label gd: 1 pixels (50.0% of fitted)')
+        self.assertEqual(
+            lines[4], '    magnitude p5 / p25 / p50 / p75 / p95: '
+                      '400 / 400 / 400 / 400 / 400')
+
+
+class JobPlanningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.meta = {
+            'geotransform': [500000, 30, 0, 5000000, 0, -30],
+            'size': [1000, 1000],
+            'projection': ''
+        }
+        self.scenes = [
+            ('job/input/rasters/LE7045029_%s_%s_20140101_000000_ledaps.tif.tar.gz' % (yr, doy), 100)
+            for yr in range(2000, 2010) for doy in [166, 182, 198]
+        ]
+        self.settings = {'index_eqn': 'B4 - B3', 'line_cost': 10}
+
+    def test_plan_job(self):
+        plan = utils.plan_job(self.meta, self.meta, self.scenes, self.settings,
+                              analyze_seconds=0.036)
+        self.assertEqual(plan['pixels'], 1000000)
+        self.assertEqual((plan['scenes'], plan['years']), (30, 10))
+        self.assertEqual(plan['scenes_per_year'], {'min': 3, 'mean': 3.0, 'max': 3})
+        self.assertEqual(plan['archive_bytes'], 3000)
+        self.assertEqual(plan['shuffle_records'], 30000000)
+        self.assertAlmostEqual(plan['cpu_hours']['analyze'], 10.0)
+        self.assertEqual(plan['peak_memory'], max(plan['memory'].values()))
+        self.assertTrue(plan['recommend']['stack_scenes'])
+        self.assertEqual(plan['recommend']['reducers'], 10)
+        self.assertEqual(plan['recommend']['instance_type'], 'm3.xlarge')
+
+        # stacking only shuffles each year's winner
+        self.settings['stack_scenes'] = True
+        plan = utils.plan_job(self.meta, self.meta, self.scenes, self.settings,
+                              pixels=1000)
+        self.assertEqual(plan['shuffle_records'], 10000)
+        self.assertEqual(plan['recommend']['reducers'], 1)
+
+    def test_plan_tile_size(self):
+        # tiles of 300 scenes are read in strips that fit the budget, so
+        # the biggest tile whose blocks fit in it is picked
+        scenes = self.scenes * 10
+        settings = dict(self.settings, stack_scenes=True)
+        plan = utils.plan_job(self.meta, self.meta, scenes, settings)
+        self.assertEqual(plan['memory']['parse_mapper'], s.MEMORY_BUDGET)
+        self.assertEqual(plan['recommend']['tile_size'], 1024)
+        self.assertTrue('recommended tile_size: 1024' in utils.plan_summary(plan))
+
+        # a bigger budget never recommends a smaller tile
+        tile_sizes = []
+        for budget_mb in [64, 256, 1536, 100000]:
+            settings['memory_budget_mb'] = budget_mb
+            plan = utils.plan_job(self.meta, self.meta, scenes, settings)
+            tile_sizes.append(plan['recommend']['tile_size'])
+        self.assertEqual(tile_sizes, [256, 512, 1024, 2048])
+
+
 class AnalysisTestCase(unittest.TestCase):
 
     def spike_helper(self, l1, l2):
@@ -157,6 +618,17 @@ class AnalysisTestCase(unittest.TestCase):
         ]
         series = utils.dicts2timeseries(data)
         self.assertTrue(np.array_equal(series.values, [5.0, 10.0]))
+        self.assertTrue(np.array_equal(series.index, [2011244, 2012245]))
+
+    def test_pick_winners(self):
+        data = [
+            {'date': 2011182, 'val': 1.0},
+            {'date': 2011244, 'val': 2.0},
+            {'date': '2012-09-01', 'val': 3.0}
+        ]
+        winners = utils.pick_winners(data, utils.parse_date('2014-07-01'))
+        self.assertEqual(
+            sorted(w['val'] for w in winners), [1.0, 3.0])
 
     def test_despike(self):
         self.spike_helper( 
@@ -169,6 +641,47 @@ class AnalysisTestCase(unittest.TestCase):
             [1, None, 1, None, 1, 1, 1]
         )
 
+    def test_despike_stack(self):
+        stack = np.array([
+            [1, 1, 1, 5, 1, 1, 1],
+            [1, 3, 1, 5, 1, 1, 1],
+            [1, 3, 3, 1, 3, 3, 3]
+        ], dtype=float).T
+        is_spike = utils.despike_stack(stack)
+        self.assertEqual(is_spike.shape, stack.shape)
+        for i in range(stack.shape[1]):
+            np.testing.assert_array_equal(
+                is_spike[:, i], utils.despike_stack(stack[:, i]))
+            np.testing.assert_array_equal(
+                is_spike[:, i], pd.isnull(utils.despike(pd.Series(stack[:, i]))))
+        np.testing.assert_array_equal(
+            is_spike[:, 1], [False, True, False, True, False, False, False])
+
+    def test_mark_spikes(self):
+        series = [[1, 1, 1, 5, 1, 1, 1], [1, 3, 1, 5, 1, 1, 1], [1, 5, 1, 1]]
+        winner_lists = [
+            [{'date': (2000 + i) * 1000 + 182, 'val': float(v)}
+             for i, v in reversed(list(enumerate(vals)))]
+            for vals in series
+        ]
+        utils.mark_spikes(winner_lists)
+        for vals, winners in zip(series, winner_lists):
+            ts = utils.dicts2timeseries(winners)
+            self.assertEqual([d['val'] for d in winners], vals)
+            np.testing.assert_array_equal(
+                pd.isnull(utils.despike_marked(ts, winners)),
+                pd.isnull(utils.despike(ts)))
+        self.assertEqual(
+            [bool(d.get('spike')) for d in winner_lists[1]],
+            [False, True, False, True, False, False, False])
+
+        target_date = utils.parse_date('2014-07-01')
+        self.assertEqual(
+            utils.analyze(winner_lists[1], 1, target_date,
+                          spikes_marked=True).mr_label_output(range(2000, 2007)),
+            utils.analyze(winner_lists[1], 1, target_date)
+                .mr_label_output(range(2000, 2007)))
+
     def test_least_squares(self):
         (m, c), sum_residuals = utils.least_squares(pd.Series([1, 2.1, 3, 4.4, 4.7]))
 
@@ -188,6 +701,102 @@ class AnalysisTestCase(unittest.TestCase):
             [0, 3, 6, 7]
         )
 
+    def test_analyze_profiler(self):
+        from classes import StageProfiler
+        values = [
+            {'date': '%s-07-01' % (2010 + i), 'val': v}
+            for i, v in enumerate([10, 10, 10, 5, 5, 5, 7, 9, 10, 10])
+        ]
+        target_date = utils.parse_date('2014-07-01')
+        profiler = StageProfiler(2)
+        for i in range(4):
+            utils.analyze(values, 2, target_date, profiler)
+        stages = profiler.summary()['stages']
+        self.assertEqual(stages['pick_winners']['count'], 2)
+        self.assertEqual(stages['segmented_least_squares']['count'], 2)
+        self.assertEqual(stages['eqns2fitted_points']['count'], 2)
+
+    def test_classify_series(self):
+        self.assertEqual(utils.classify_series(pd.Series([1, 5]), 1), 'short')
+        self.assertEqual(
+            utils.classify_series(pd.Series([4, 4, 4, 4]), 1), 'constant')
+        self.assertEqual(
+            utils.classify_series(pd.Series([0, 1.1, 2, 3]), 1), 'stable')
+        self.assertEqual(
+            utils.classify_series(pd.Series([0, 0, 0, 1, 2, 3]), 0.0001), None)
+
+    def test_mostly_nodata_series(self):
+        # mostly NODATA series still get the full search, so their
+        # vertices (and labels) are the same as without classify_series
+        nd = s.NODATA
+        vals = [nd, 100] * 6 + [nd, nd, 300, 300]
+        series = pd.Series(vals)
+        self.assertEqual(utils.classify_series(series, 10), None)
+
+        pix_datas = [{'date': (1990 + i) * 1000 + 182, 'val': float(v)}
+                     for i, v in enumerate(vals)]
+        trendline = utils.analyze(pix_datas, 10, utils.parse_date('2000-07-01'))
+        ts = utils.dicts2timeseries(pix_datas)
+        int_series = utils.timeseries2int_series(utils.despike(ts))
+        self.assertEqual(
+            trendline.array['index_day'][trendline.array['vertex']].tolist(),
+            utils.segmented_least_squares(int_series, 10)
+        )
+
+    def test_single_segment(self):
+        for s, line_cost in [
+                (pd.Series([4, 4, 4, 4]), 1),
+                (pd.Series([0, 1.1, 2, 3.2, 3.9]), 1),
+                (pd.Series([0, 1, 5, 3, 0, 2]), 100)]:
+            self.assertTrue(utils.classify_series(s, line_cost))
+            self.assertEquals(
+                utils.single_segment(s),
+                utils.segmented_least_squares(s, line_cost)
+            )
+
+    def test_sls_state(self):
+        s1 = pd.Series([0, 0, 0, 1, 2, 3])
+        s2 = pd.Series([0, 0, 0, 1, 1, 1, 3, 3])
+        for s in [s1, s2]:
+            state = utils.sls_state(s, 0.0001)
+            self.assertEquals(
+                utils.sls_vertices(state),
+                utils.segmented_least_squares(s, 0.0001)
+            )
+
+    def test_extend_sls_state(self):
+        s = pd.Series([0, 0, 0, 1, 1, 1, 3, 3])
+        full = utils.sls_state(s, 0.0001)
+        extended = utils.extend_sls_state(utils.sls_state(s[:5], 0.0001), s[5:])
+        self.assertEquals(utils.sls_vertices(extended), [0, 3, 6, 7])
+        np.testing.assert_almost_equal(extended['opt'], full['opt'])
+
+    @raises(ValueError)
+    def test_extend_sls_state_out_of_order(self):
+        s = pd.Series([0, 0, 0, 1, 1, 1])
+        utils.extend_sls_state(utils.sls_state(s, 0.0001), s[:2])
+
+    def test_analyze_incremental(self):
+        values = [
+            {'date': '%s-07-01' % yr, 'val': val}
+            for yr, val in zip(range(2000, 2012), [10, 10, 11, 10, 4, 5, 6, 7, 8, 9, 10, 10])
+        ]
+        target_date = utils.parse_date('2014-07-01')
+        full = utils.analyze(values, 2, target_date)
+        _, state = utils.analyze_incremental(values[:-2], 2, target_date)
+        state = json.loads(json.dumps(state))  # must survive the shuffle
+        trendline, state = utils.analyze_incremental(
+            values[-2:], 2, target_date, state)
+        self.assertEquals(len(state['winners']), 12)
+        self.assertEquals(
+            [p.vertex for p in trendline.points],
+            [p.vertex for p in full.points]
+        )
+        np.testing.assert_almost_equal(
+            [p.val_fit for p in trendline.points],
+            [p.val_fit for p in full.points]
+        )
+
     def test_vertices2eqns(self):
         s = pd.Series([0, 0, 0, 1, 2, 3])
         v = pd.Series([True, False, True, False, False, True])
@@ -224,6 +833,117 @@ class AnalysisTestCase(unittest.TestCase):
         self.assertTrue(np.all(fit_series == expected_series))
         self.assertTrue(np.all(fit_eqn == expected_eqns))
 
+    def test_creation_options(self):
+        self.assertEquals(utils.creation_options(False), [])
+        self.assertEquals(utils.creation_options(True), ['COMPRESS=LZW'])
+        self.assertEquals(
+            utils.creation_options('DEFLATE', 2, tiled=True),
+            ['COMPRESS=DEFLATE', 'PREDICTOR=2', 'TILED=YES',
+             'BLOCKXSIZE=512', 'BLOCKYSIZE=512']
+        )
+
+    def test_overview_levels(self):
+        self.assertEquals(utils.overview_levels(500, 300), [])
+        self.assertEquals(utils.overview_levels(8000, 7000), [2, 4, 8, 16])
+
+    def test_wkts2offsets(self):
+        x_offs, y_offs = utils.wkts2offsets(
+            ['POINT(15 -45)', 'POINT(105.5 -15)'], [0, 30, 0, 0, 0, -30])
+        np.testing.assert_array_equal(x_offs, [0, 3])
+        np.testing.assert_array_equal(y_offs, [1, 0])
+
+    def test_tile_meta(self):
+        meta = {'size': [1000, 700], 'geotransform': [0, 30, 0, 0, 0, -30]}
+        out = utils.tile_meta(meta, (1, 1), 512)
+        self.assertEquals(out['size'], [488, 188])
+        self.assertEquals(out['geotransform'], [15360, 30, 0, -15360, 0, -30])
+
+    def test_region_meta(self):
+        meta = utils.region_meta({
+            'projection': 'EPSG:5070',
+            'bounds': [1000, -500, 40000, 20000],
+            'pixel_size': 30
+        }, 512)
+        self.assertEquals(meta['geotransform'], [0, 30, 0, 30720, 0, -30])
+        self.assertEquals(meta['size'], [1334, 1041])
+        self.assertTrue('Albers' in meta['projection'])
+
+    def test_crop2mask(self):
+        meta = {'size': [20, 10], 'geotransform': [0, 30, 0, 0, 0, -30]}
+        mask = np.zeros((10, 20), dtype=bool)
+        mask[2:4, 5] = True
+        mask[3, 7] = True
+        out, out_mask = utils.crop2mask(meta, mask)
+        self.assertEquals(out['size'], [3, 2])
+        self.assertEquals(out['geotransform'], [150, 30, 0, -60, 0, -30])
+        self.assertEquals(out_mask.tolist(), [[True, False, False], [True, False, True]])
+
+    def test_meta2grid(self):
+        meta = {'size': [3, 2], 'geotransform': [150, 30, 0, -60, 0, -30]}
+        mask = np.array([[True, False, False], [True, False, True]])
+        out_fn = utils.meta2grid(meta, mask, '/tmp/test_meta2grid.csv')
+        self.assertEquals(
+            list(pd.read_csv(out_fn)['pix_ctr_wkt']),
+            ['POINT(165.0 -75.0)', 'POINT(165.0 -105.0)', 'POINT(225.0 -105.0)']
+        )
+        os.remove(out_fn)
+
+    def test_stack_algebra(self):
+        bands = {
+            1: np.array([[[4.0, -99]], [[6.0, 8.0]]]),
+            2: np.array([[[1.0, 1.0]], [[2.0, -99]]])
+        }
+        covered = np.array([[[True, True]], [[True, False]]])
+        np.testing.assert_array_equal(
+            utils.band_algebra(bands, 'B1 - B2'), [[[3, -100]], [[4, 107]]])
+        # a covered reflectance of -99 is a value like any other
+        np.testing.assert_array_equal(
+            utils.stack_algebra(bands, 'B1 - B2', covered),
+            [[[3, -100]], [[4, -99]]])
+
+    def test_stack2pix_datas(self):
+        cube = np.array([[[1.0, -99]], [[2.0, 3.0]]])  # [scene, y, x]
+        covered = np.array([[[True, False]], [[True, True]]])
+        mask_cube = np.array([[[1, 1]], [[0, 1]]])
+        out = list(utils.stack2pix_datas(
+            cube, covered, [2011182, 2012182], ['a', 'b'],
+            [np.array([0, 1]), np.array([0, 0])], mask_cube))
+        self.assertEqual(out, [
+            ('a', [{'val': 1.0, 'date': 2011182}]),
+            ('b', [{'val': 3.0, 'date': 2012182}])
+        ])
+
+        # an index of -99 where a scene covers the point is sampled
+        covered[0, 0, 1] = True
+        out = list(utils.stack2pix_datas(
+            cube, covered, [2011182, 2012182], ['a', 'b'],
+            [np.array([0, 1]), np.array([0, 0])]))
+        self.assertEqual(out[1], ('b', [
+            {'val': -99.0, 'date': 2011182}, {'val': 3.0, 'date': 2012182}]))
+
+    def test_stack_coverage(self):
+        # a 3 x 2 tile, one raster covering its left 1.5 columns and
+        # another shifted down past the centers of its first row
+        meta = {'size': [3, 2], 'geotransform': [0, 30, 0, 0, 0, -30]}
+        covered = utils.stack_coverage(
+            [[0, 0, 1.5, 2], [0, 0.6, 3, 2.6]], meta, [0, 0], 4)
+        self.assertEqual(covered.tolist(), [
+            [[True, False, False], [True, False, False]],
+            [[False, False, False], [True, True, True]]
+        ])
+        self.assertEqual(utils.stack_coverage(
+            [[0, 0, 1.5, 2]], meta, [0, 0], 4, (1, 5)).shape, (1, 1, 3))
+
+    def test_grid_tile_points(self):
+        meta = {'size': [3, 2], 'geotransform': [150, 30, 0, -60, 0, -30]}
+        grid_fn = utils.meta2grid(meta, out_csv='/tmp/test_tile_grid.csv')
+        self.assertEqual(utils.grid_tiles(meta, 2), [[0, 0], [1, 0]])
+        wkts, (x_offs, y_offs) = utils.grid_tile_points(grid_fn, meta, [1, 0], 2)
+        self.assertEqual(list(wkts), ['POINT(225.0 -75.0)', 'POINT(225.0 -105.0)'])
+        self.assertEqual(list(x_offs), [0, 0])
+        self.assertEqual(list(y_offs), [0, 1])
+        os.remove(grid_fn)
+
     def test_get_idx(self):
         self.assertEquals(utils.get_idx(['a','b','c'], 1), 'b')
         self.assertEquals(utils.get_idx(pd.Series(['a','b','c']), 1), 'b')
@@ -299,3 +1019,119 @@ class AnalysisTestCase(unittest.TestCase):
         ]
 
         #self.assertAnalyzeEqual(line_cost, values, expected_out)
+
+
+class ChangeLabelingTestCase(unittest.TestCase):
+
+    def test_analyze_cached(self):
+        from classes import LabelRule, LRUCache
+        target_date = utils.parse_date('2014-07-01')
+        rules = [LabelRule({'name': 'gd', 'val': 1, 'change_type': 'GD'})]
+        values = [
+            {'date': '%s-07-01' % (2010 + i), 'val': v}
+            for i, v in enumerate([10, 10, 10, 5, 5, 5, 7, 9, 10, 10])
+        ]
+        cache = LRUCache(10)
+        trendline, labels = utils.analyze_cached(
+            values, 2, target_date, rules, cache)
+        self.assertEqual(labels, utils.change_labeling(trendline, rules))
+        again = utils.analyze_cached(
+            list(reversed(values)), 2, target_date, rules, cache)
+        self.assertTrue(again[0] is trendline)
+        utils.analyze_cached(values, 3, target_date, rules, cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_change_labeling_table(self):
+        from classes import LabelRule
+        target_date = utils.parse_date('2014-07-01')
+        series = [
+            [10, 10, 10, 5, 5, 5, 7, 9, 10, 10],
+            [10, 10, 11, 10, 4, 5, 6, 7, 8, 9],
+            [5, 5, 5, 5, 5, 5, 5, 5, 5, 5],
+            [-99, -99, -99, -99, -99, -99, 5, -99, -99, 10]
+        ]
+        rules = [
+            LabelRule({'name': 'gd', 'val': 1, 'change_type': 'GD'}),
+            LabelRule({'name': 'fd', 'val': 2, 'change_type': 'FD',
+                       'onset_year': ['>=', 2012]}),
+            LabelRule({'name': 'ld', 'val': 3, 'change_type': 'LD',
+                       'duration': ['<', 4], 'pre_threshold': ['>', 9]})
+        ]
+
+        trendlines, tables = [], []
+        for vals in series:
+            values = [
+                {'date': '%s-12-31' % (2010 + i), 'val': v}
+                for i, v in enumerate(vals)
+            ]
+            trendline = utils.analyze(values, 2, target_date)
+            trendlines.append(trendline)
+            tables.append(trendline.vertex_table(len(vals)))
+
+        table = np.array(tables).T  # format [band, pixel]
+        labels = utils.change_labeling_table(table, rules)
+
+        for i, trendline in enumerate(trendlines):
+            expected = utils.change_labeling(trendline, rules)
+            for rule in rules:
+                if rule.name not in expected:
+                    self.assertEqual(labels[rule.name]['class_val'][i], -99)
+                    continue
+                for key, val in expected[rule.name].iteritems():
+                    self.assertAlmostEqual(labels[rule.name][key][i], val)
+        self.assertEqual(utils.change_labeling(trendlines[-1], rules), {})
+
+
+class ScenePlanningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = [
+            'job/input/rasters/LE7045029_2000_200_ledaps.tif.tar.gz',
+            'job/input/rasters/LE7045029_2000_150_ledaps.tif.tar.gz',
+            'job/input/rasters/LE7045029_2000_181_ledaps.tif.tar.gz',
+            'job/input/rasters/LE7045029_2001_100_ledaps.tif.tar.gz'
+        ]
+        self.meta = {
+            'geotransform': [0, 30, 0, 0, 0, -30],
+            'size': [20, 10],
+            'projection': ''
+        }
+
+    def test_rank_scenes(self):
+        ranked = utils.rank_scenes(self.keys, utils.parse_date('2014-07-01'))
+        self.assertEquals(ranked[2000], [self.keys[2], self.keys[0], self.keys[1]])
+        self.assertEquals(ranked[2001], [self.keys[3]])
+
+    def test_tiles_with(self):
+        arr = np.zeros((10, 20), dtype=bool)
+        arr[9, 12] = True
+        self.assertEquals(utils.tiles_with(arr, 8), [[1, 1]])
+
+    def test_plan_scenes_without_masks(self):
+        ranked = utils.rank_scenes(self.keys, utils.parse_date('2014-07-01'))
+        plan = utils.plan_scenes(ranked, {}, self.meta, 8)
+        self.assertEquals(plan, dict([(k, None) for k in self.keys]))
+
+    def test_plan_scenes_with_aoi(self):
+        ranked = utils.rank_scenes(self.keys, utils.parse_date('2014-07-01'))
+        aoi_mask = np.zeros((10, 20), dtype=bool)
+        aoi_mask[9, 12] = True
+        plan = utils.plan_scenes(ranked, {}, self.meta, 8, aoi_mask)
+        self.assertEquals(plan, dict([(k, [[1, 1]]) for k in self.keys]))
+
+    def test_plan_scenes(self):
+        ranked = utils.rank_scenes(self.keys, utils.parse_date('2014-07-01'))
+
+        # best scene is masked in the right-most column only
+        mask_ds = utils.create_raster('/tmp/test_mask.tif', self.meta, data_type=gdal.GDT_Byte)
+        mask_arr = np.ones((10, 20))
+        mask_arr[:, 19] = 0
+        mask_ds.GetRasterBand(1).WriteArray(mask_arr)
+        mask_ds = None
+
+        plan = utils.plan_scenes(
+            ranked, {self.keys[2]: '/tmp/test_mask.tif'}, self.meta, 8)
+        self.assertEquals(plan[self.keys[2]], None)
+        self.assertEquals(plan[self.keys[0]], [[2, 0], [2, 1]])
+        self.assertEquals(plan[self.keys[1]], [[2, 0], [2, 1]])
+        os.remove('/tmp/test_mask.tif')
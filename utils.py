@@ -26,26 +26,39 @@ def decompress(filename, out_dir='/tmp/decompressed'):
     files inside that dir.  
     Otherwise it will be created from scratch and
     filled with the files from the compressed file
+
+    The contents are extracted to a temporary dir that's renamed to out_dir
+    when it's complete, so tasks sharing a node (and its out_dirs) never
+    see a partly decompressed file.
     """
     if os.path.exists(out_dir):
         return glob.glob(os.path.join(out_dir, '*'))
-    os.makedirs(out_dir)
+    tmp_dir = '%s.part-%s' % (out_dir, os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
     del_dir = False
 
     fn = filename #alias
     try:
         if zipfile.is_zipfile(fn):
-            zipfile.ZipFile(fn, 'r').extractall(out_dir)
+            zipfile.ZipFile(fn, 'r').extractall(tmp_dir)
         elif tarfile.is_tarfile(fn):
-            tarfile.open(fn, 'r').extractall(out_dir)
+            tarfile.open(fn, 'r').extractall(tmp_dir)
         else:
             raise ValueError('Invalid file type - must be tar.gz or zip')
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            del_dir = True  # another task finished out_dir first
+            if not os.path.exists(out_dir):
+                raise
     except Exception as e:
-        del_dir = True #delete the partially created out_dir
+        del_dir = True #delete the partially created tmp_dir
         raise e #pass exception through
     finally:
         if del_dir:
-            shutil.rmtree(out_dir)
+            shutil.rmtree(tmp_dir)
     
     return [os.path.join(out_dir, f) for f in os.listdir(out_dir)]
 
@@ -56,6 +69,18 @@ def decompress(filename, out_dir='/tmp/decompressed'):
 import boto
 import json
 
+from classes import LocalBucket
+
+def get_bucket():
+    """
+    Returns the job bucket (settings.S3_BUCKET), or a local directory
+    standing in for it if settings.LOCAL_STORAGE_ENV is set
+    """
+    local_dir = os.environ.get(s.LOCAL_STORAGE_ENV)
+    if local_dir:
+        return LocalBucket(local_dir)
+    return boto.connect_s3().get_bucket(s.S3_BUCKET)
+
 def keyname2filename(keyname):
     """
     Given a keyname, convert it to a filename on the local machine.
@@ -71,19 +96,27 @@ def get_keys(prefix):
     returns the keys of all S3 objects with that prefix
     or [] if there are no such S3 objects
     """
-    conn = boto.connect_s3()
-    bucket = conn.get_bucket(s.S3_BUCKET)
+    bucket = get_bucket()
     for k in bucket.list(prefix=prefix):
         if k.key.endswith('/'):
             continue  # skip directories
         yield k
 
+# running totals of bytes moved to/from S3 by this process
+# (see MRLandTrendrJob.count_transfers)
+TRANSFER_BYTES = {'downloaded': 0, 'uploaded': 0}
+
 def download(keys):
     filenames = []
 
     for key in keys:
         filename = keyname2filename(key.key)
-        key.get_contents_to_filename(filename)
+        # renamed once complete, so tasks sharing a node never read a
+        # partial download (see get_file)
+        tmp_filename = '%s.part-%s' % (filename, os.getpid())
+        key.get_contents_to_filename(tmp_filename)
+        os.rename(tmp_filename, filename)
+        TRANSFER_BYTES['downloaded'] += os.path.getsize(filename)
         filenames.append(filename)
 
     return filenames
@@ -136,6 +169,64 @@ def rast_dl(keyname):
     decompress_dir = os.path.join(s.WORK_DIR, name)
     return decompress(rast_zip_fn, decompress_dir)[0]
 
+def s3_vsi_path(keyname):
+    """
+    Given a keyname, return a GDAL path that reads it in place: through
+    /vsis3/ (with the boto credentials) or, for local storage (see
+    settings.LOCAL_STORAGE_ENV), the file under the local directory
+    """
+    bucket = get_bucket()
+    if isinstance(bucket, LocalBucket):
+        return os.path.join(bucket.root, keyname)
+    gdal.SetConfigOption('AWS_ACCESS_KEY_ID', bucket.connection.access_key)
+    gdal.SetConfigOption(
+        'AWS_SECRET_ACCESS_KEY', bucket.connection.secret_key)
+    return '/vsis3/%s/%s' % (bucket.name, keyname)
+
+def rast_vsi(keyname, remote=False):
+    """
+    Given the keyname of a compressed raster, download it and return a
+    GDAL path to the raster inside the archive (through /vsitar/ or
+    /vsizip/), so it can be read without decompressing the archive
+
+    If remote, the archive isn't downloaded either: GDAL reads just the
+    parts of it that it needs from S3 (see s3_vsi_path)
+    """
+    if remote:
+        rast_zip_fn = s3_vsi_path(keyname)
+        is_zip = keyname.endswith('.zip')
+    else:
+        rast_zip_fn = get_file(keyname)
+        is_zip = zipfile.is_zipfile(rast_zip_fn)
+    if is_zip:
+        archive = '/vsizip/' + rast_zip_fn
+    else:
+        archive = '/vsitar/' + rast_zip_fn
+    names = sorted(
+        name for name in (gdal.ReadDir(archive) or [])
+        if not name.endswith('/')
+    )
+    if not names:
+        raise ValueError('No raster found in %s' % keyname)
+    return '%s/%s' % (archive, names[0])
+
+def mask_dl(rast_keyname, vsi=False):
+    """
+    Given the keyname of a compressed analysis raster, download and
+    decompress its mask (see settings.MASK_TRIGGER) and return the
+    name of the decompressed file, or None if it has no mask
+
+    If vsi, the mask isn't decompressed and its GDAL path inside the
+    archive is returned instead (see rast_vsi)
+    """
+    mask_keyname = rast_keyname.replace(s.RAST_TRIGGER, s.MASK_TRIGGER)
+    try:
+        if vsi:
+            return rast_vsi(mask_keyname)
+        return rast_dl(mask_keyname)
+    except Exception:
+        return None  # don't worry about mask
+
 def read_json(keyname, cache=True):
     """
     Read a JSON file from S3 and return the python object
@@ -168,8 +259,7 @@ def upload(filenames, replacements={}):
     Uploads a list of files to S3.  Converts "__" into "/"
     """
     keys = []
-    conn = boto.connect_s3()
-    bucket = conn.get_bucket(s.S3_BUCKET)
+    bucket = get_bucket()
 
     replacements.update({
         '__': '/',
@@ -180,6 +270,7 @@ def upload(filenames, replacements={}):
         keyname = multiple_replace(filename, replacements)
         key = bucket.new_key(keyname)
         key.set_contents_from_filename(filename)
+        TRANSFER_BYTES['uploaded'] += os.path.getsize(filename)
         keys.append(key)
 
     return keys
@@ -201,9 +292,44 @@ def parse_date(date_string):
     except Exception:
         raise ValueError('date_string must be in "YYYY-MM-DD" format')
 
-def filename2date(fn):
+def date2code(d):
     """
-    Given a filename, returns a datestring in the format YYYY-MM-DD
+    Given a date, return its integer date code in the format YYYYDDD
+    (year * 1000 + day of year), e.g. 2012-08-09 -> 2012222
+
+    Date codes sort like dates, and the year is just code // 1000,
+    so they're cheap to carry through the analysis
+    """
+    return d.year * 1000 + d.timetuple().tm_yday
+
+def code2date(code):
+    """
+    Given an integer date code (see date2code), return the date
+    """
+    return datetime(year=code // 1000, month=1, day=1) + \
+        timedelta(days=code % 1000 - 1)
+
+def as_datecode(date):
+    """
+    Given either a date code or a date string in the format YYYY-MM-DD,
+    return the date code
+    """
+    if isinstance(date, basestring):
+        return date2code(parse_date(date))
+    return int(date)
+
+def date_table(codes):
+    """
+    Given a list of date codes, return a dict for formatting them
+    in the format {<code>: 'YYYY-MM-DD', ...}
+    """
+    return dict([
+        (code, code2date(code).strftime('%Y-%m-%d')) for code in set(codes)
+    ])
+
+def filename2datecode(fn):
+    """
+    Given a filename, returns its date code (see date2code)
 
     names look like:
     LE7045029_1999_211_20120124_104859_cloudmask.tif.tar.gz
@@ -212,9 +338,14 @@ def filename2date(fn):
     fn = os.path.basename(fn)
     chunks = fn.split('_')
     yr, days = int(chunks[1]), int(chunks[2])
-    d = datetime(year=yr, month=1, day=1)
-    d += timedelta(days=days-1)
-    return d.strftime('%Y-%m-%d')
+    return yr * 1000 + days
+
+def filename2date(fn):
+    """
+    Given a filename, returns a datestring in the format YYYY-MM-DD
+    (see filename2datecode)
+    """
+    return code2date(filename2datecode(fn)).strftime('%Y-%m-%d')
 
 def parse_eqn_bands(eqn):
     """
@@ -241,11 +372,396 @@ def multiple_replace(string, replacements):
 def get_settings(job):
     return read_json(s.IN_SETTINGS % job)
 
+def write_states(data, out_fn='/tmp/state.json'):
+    """
+    Given an iterable (list) in the format:
+        {'pix_ctr_wkt': wkt, 'value': <state>}
+    write one JSON list per line in the format:
+        [<wkt>, <state>]
+
+    Returns the filename
+    """
+    with open(out_fn, 'w') as f:
+        for d in data:
+            f.write(json.dumps([d['pix_ctr_wkt'], d['value']]) + '\n')
+    return out_fn
+
+def read_states(fn):
+    """
+    Given a file written by write_states,
+    returns an iterator that generates (<wkt>, <state>) tuples
+    """
+    with open(fn) as f:
+        for line in f:
+            wkt, state = json.loads(line)
+            yield wkt, state
+
+####################
+# Checkpoints
+####################
+import hashlib
+
+def md5sum(fn):
+    """
+    Returns the hex MD5 of a file's contents (the ETag S3 gives it
+    when it's uploaded in a single part)
+    """
+    md5 = hashlib.md5()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def input_hash(settings, keys, meta, tile_size):
+    """
+    Given a job's settings, the S3 keys of its inputs (scenes, masks,
+    its aoi file, a prior job's state), its grid metadata and its tile
+    size, return a hash of everything that determines the job's output
+    and which pixels make up each tile: its settings (except
+    settings.CHECKPOINT_IGNORE), the grid's geotransform, size and
+    projection, the tile size and the keyname and ETag of each key
+    """
+    md5 = hashlib.md5(json.dumps([
+        dict([(k, v) for k, v in settings.iteritems()
+              if k not in s.CHECKPOINT_IGNORE]),
+        [meta['geotransform'], meta['size'], meta['projection']],
+        tile_size
+    ], sort_keys=True))
+    for key in sorted(keys, key=lambda k: k.key):
+        md5.update('%s %s\n' % (key.key, key.etag.strip('"')))
+    return md5.hexdigest()
+
+def key_md5s(prefix):
+    """
+    Returns the MD5s (from the ETags) of the keys with that prefix,
+    in the format {<keyname>: <md5>, ...}
+    """
+    return dict([(k.key, k.etag.strip('"')) for k in get_keys(prefix)])
+
+def block_keyname(job, label_key, tile):
+    """
+    Returns the keyname of a job's output block (or fitting state file,
+    for settings.STATE_LABEL) of a label in a [<tile x>, <tile y>] tile
+    """
+    if label_key == s.STATE_LABEL:
+        return s.OUT_STATE_KEYNAME % (job, tile[0], tile[1])
+    return s.OUT_BLOCK_KEYNAME % (job, label_key, tile[0], tile[1])
+
+def labels_md5(labels):
+    """
+    Returns the hash of a tile's list of labels that marks it finished
+    """
+    return hashlib.md5(json.dumps(sorted(labels))).hexdigest()
+
+def write_checkpoint(job, checkpoint, unit, md5):
+    """
+    Given a job, its input hash (see input_hash), a unit of work
+    (settings.CHECKPOINT_*_UNIT) and the MD5 of the unit's output,
+    mark the unit finished.  Returns the marker's keyname.
+    """
+    keyname = '%s%s.%s' % (s.OUT_CHECKPOINT % (job, checkpoint), unit, md5)
+    get_bucket().new_key(keyname).set_contents_from_string('')
+    return keyname
+
+def read_checkpoints(job, checkpoint):
+    """
+    Given a job and its input hash (see input_hash), return the tiles
+    and rasters that earlier runs with the same inputs finished, in the
+    format:
+    {
+        'tiles': {
+            (<tile x>, <tile y>): {<label>: {'key': X, 'md5': X}, ...},
+            ...
+        },
+        'rasters': {<label>: {'key': X, 'md5': X}, ...}
+    }
+    A block or raster only counts as finished if it's still there with
+    the MD5 it was marked with, and a tile only if every block it had
+    (see labels_md5) is.
+    """
+    prefix = s.OUT_CHECKPOINT % (job, checkpoint)
+    markers = [k.key[len(prefix):].rsplit('.', 1) for k in get_keys(prefix)]
+    if not markers:
+        return {'tiles': {}, 'rasters': {}}
+
+    # list every output once (the prefix the output keynames share)
+    outputs = key_md5s(os.path.commonprefix([
+        s.OUT_RAST_KEYNAME % (job, ''), s.OUT_STATE % job,
+        s.OUT_BLOCK_KEYNAME % (job, '', '', '')
+    ]))
+
+    blocks, tile_md5s, rasters = {}, {}, {}
+    for unit, md5 in markers:
+        kind, name = unit.split('/', 1)
+        if kind == 'rasters':
+            keyname = s.OUT_RAST_KEYNAME % (job, name)
+            if outputs.get(keyname) == md5:
+                rasters[name] = {'key': keyname, 'md5': md5}
+            continue
+        tile_name, _, label_key = name.partition('/')
+        tile = tuple(int(t) for t in tile_name.split('_'))
+        if not label_key:  # the tile itself
+            tile_md5s.setdefault(tile, set()).add(md5)
+            continue
+        keyname = block_keyname(job, label_key, tile)
+        if outputs.get(keyname) == md5:
+            blocks.setdefault(tile, {})[label_key] = {
+                'key': keyname, 'md5': md5}
+
+    tiles = dict([
+        (tile, blocks.get(tile, {}))
+        for tile, md5s in tile_md5s.iteritems()
+        if labels_md5(blocks.get(tile, {}).keys()) in md5s
+    ])
+    return {'tiles': tiles, 'rasters': rasters}
+
+def raster_checkpointed(job, checkpoint, label_key):
+    """
+    Given a job, its input hash (see input_hash) and a label, return
+    True if an earlier run with the same inputs finished the label's
+    raster and it's still there unchanged
+    """
+    keyname = s.OUT_RAST_KEYNAME % (job, label_key)
+    prefix = '%s%s.' % (
+        s.OUT_CHECKPOINT % (job, checkpoint),
+        s.CHECKPOINT_RASTER_UNIT % label_key
+    )
+    md5s = set(k.key[len(prefix):] for k in get_keys(prefix))
+    return key_md5s(keyname).get(keyname) in md5s
+
+def resume_plan(plan, tiles, finished):
+    """
+    Given a scene plan (see plan_scenes), every [<tile x>, <tile y>]
+    tile of the grid and the finished tiles (see read_checkpoints),
+    return the plan for just the unfinished tiles.  Scenes with none
+    left are left out.
+    """
+    if not finished:
+        return plan
+    resumed = {}
+    for keyname, scene_tiles in plan.iteritems():
+        left = [
+            tile for tile in (tiles if scene_tiles is None else scene_tiles)
+            if tuple(tile) not in finished
+        ]
+        if left:
+            resumed[keyname] = left
+    return resumed
+
+def last_run_meta(job):
+    """
+    Given a job, return the metadata its last run wrote (see
+    MRLandTrendrJob.setup_mapper), or None if it hasn't run
+    """
+    if not list(get_keys(s.OUT_META % job)):
+        return None
+    return read_json(s.OUT_META % job, cache=False)
+
+def pinned_tile_size(job, settings, restart=False):
+    """
+    Given a job, its settings and whether it's being restarted, return
+    the tile size it has to run with: the tile_size setting, else the
+    one its last run used (unless restart), so changing settings that
+    don't change the output (see settings.CHECKPOINT_IGNORE) keeps its
+    checkpoints.  Returns None if the job is free to pick one.
+    """
+    if settings.get('tile_size'):
+        return int(settings['tile_size'])
+    meta = None if restart else last_run_meta(job)
+    if meta is None:
+        return None
+    return meta.get('tile_size', s.OUT_TILE_SIZE)
+
+####################
+# Job Stats
+####################
+def merge_counters(counters):
+    """
+    Given mrjob counters (a list with one dict per step in the format
+    {<group>: {<counter>: <amount>, ...}, ...}), return the totals over
+    all the steps in the same format
+    """
+    totals = {}
+    for step in counters:
+        for group, step_counters in step.iteritems():
+            group_totals = totals.setdefault(group, {})
+            for counter, amount in step_counters.iteritems():
+                group_totals[counter] = group_totals.get(counter, 0) + amount
+    return totals
+
+def counter_summary(counters):
+    """
+    Given mrjob counters (see merge_counters), return the lines of a
+    summary of the job's stats, stage timers and throughput
+    """
+    totals = merge_counters(counters)
+    stats = totals.get(s.COUNTER_GROUP, {})
+    timers = totals.get(s.TIMER_GROUP, {})
+
+    lines = []
+    for group in [s.COUNTER_GROUP, s.TIMER_GROUP]:
+        for counter, amount in sorted(totals.get(group, {}).iteritems()):
+            lines.append('%s.%s: %s' % (group, counter, amount))
+
+    # throughput (summed over tasks, so per task-second)
+    for counter, timer in [('pixels_sampled', 'apply_grid_ms'),
+                           ('pixels_analyzed', 'analyze_ms')]:
+        if stats.get(counter) and timers.get(timer):
+            lines.append('%s per second: %.1f' % (
+                counter, stats[counter] * 1000.0 / timers[timer]))
+    return lines
+
+def read_traces(fns):
+    """
+    Given the filenames of task trace logs (see classes.TraceLog),
+    return a list of all of their events
+    """
+    events = []
+    for fn in fns:
+        with open(fn) as f:
+            events += [json.loads(line) for line in f if line.strip()]
+    return events
+
+def trace_report(events, straggler_factor=2.0, top=5):
+    """
+    Given the events of a job's trace logs (see read_traces), return the
+    lines of a report on where the job's time went:
+     * per stage - task count, wall-clock span and median/max task seconds
+     * stragglers - tasks that took over straggler_factor times their
+       stage's median
+     * critical path - the slowest task of each stage, in stage order
+     * the top slowest scenes/tiles/blocks/rasters
+     * skew - rows per analysis_reducer task (max vs. median)
+    """
+    def median(vals):
+        vals = sorted(vals)
+        mid = len(vals) // 2
+        return vals[mid] if len(vals) % 2 else (vals[mid - 1] + vals[mid]) / 2.0
+
+    tasks = {}  # (stage, task) -> task_end event
+    stage_order = []
+    items = []
+    for e in sorted(events, key=lambda e: e['time']):
+        if e['stage'] not in stage_order:
+            stage_order.append(e['stage'])
+        if e['event'] == 'task_end':
+            tasks[(e['stage'], e['task'])] = e
+        elif 'seconds' in e and e['event'] != 'task_start':
+            items.append(e)
+
+    lines = []
+    critical_path = []
+    stragglers = []
+    for stage in stage_order:
+        ends = [e for (st, _), e in tasks.iteritems() if st == stage]
+        if not ends:
+            continue
+        secs = [e.get('seconds', 0) for e in ends]
+        starts = [e['time'] - e.get('seconds', 0) for e in ends]
+        span = max(e['time'] for e in ends) - min(starts)
+        med = median(secs)
+        lines.append(
+            '%s: %d tasks, span %.1fs, median %.1fs, max %.1fs, '
+            'peak rss %dKB' % (
+                stage, len(ends), span, med, max(secs),
+                max(e.get('peak_rss_kb', 0) for e in ends)
+            )
+        )
+        slowest = max(ends, key=lambda e: e.get('seconds', 0))
+        critical_path.append(slowest)
+        stragglers += [
+            e for e in ends
+            if med and e.get('seconds', 0) > straggler_factor * med
+        ]
+
+    if critical_path:
+        lines.append('critical path: %.1fs' % sum(
+            e.get('seconds', 0) for e in critical_path))
+        for e in critical_path:
+            top_stage = sorted(
+                e.get('stages', {}).iteritems(), key=lambda kv: -kv[1])[:1]
+            lines.append('  %s %s: %.1fs%s' % (
+                e['stage'], e['task'], e.get('seconds', 0),
+                ''.join(' (mostly %s: %.1fs)' % kv for kv in top_stage)
+            ))
+
+    for e in stragglers:
+        lines.append('straggler: %s %s took %.1fs' % (
+            e['stage'], e['task'], e.get('seconds', 0)))
+
+    for e in sorted(items, key=lambda e: -e['seconds'])[:top]:
+        what = e.get('key', e.get('label', e.get('tile')))
+        lines.append('slow %s: %s in %s %s: %.1fs, %d bytes' % (
+            e['event'], what, e['stage'], e['task'], e['seconds'],
+            e.get('bytes', 0)))
+
+    rows = [e.get('counts', {}).get('pixels_analyzed', 0)
+            for (st, _), e in tasks.iteritems() if st == 'analysis_reducer']
+    if rows and median(rows):
+        lines.append('analysis_reducer skew: max %d rows, median %d rows '
+                     '(%.1fx)' % (max(rows), median(rows),
+                                  max(rows) / float(median(rows))))
+    return lines
+
+####################
+# Memory budget
+####################
+import resource
+
+def memory_budget(settings, task_memory_mb=None):
+    """
+    Given the job's settings and optionally the memory of the task's
+    container (in MB, from its jobconf), return the bytes the task may use
+    (see settings.MEMORY_BUDGET)
+    """
+    if settings.get('memory_budget_mb'):
+        return int(settings['memory_budget_mb'] * 2 ** 20)
+    if task_memory_mb:
+        return int(float(task_memory_mb) * 2 ** 20 * s.MEMORY_BUDGET_FRACTION)
+    return s.MEMORY_BUDGET
+
+def job_tile_size(settings):
+    """
+    Given the job's settings, return the width/height in pixels of its
+    output tiles: the tile_size setting, else the one the job was launched
+    with (see settings.TILE_SIZE_ENV), else settings.OUT_TILE_SIZE
+    """
+    return int(settings.get('tile_size') or os.environ.get(s.TILE_SIZE_ENV)
+               or s.OUT_TILE_SIZE)
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process so far, in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def window_rows(row_bytes, budget, max_rows):
+    """
+    Given the bytes one row of a window takes, a budget in bytes (or None
+    for no limit) and the most rows there are, return how many rows to
+    read at a time (at least 1)
+    """
+    if not budget:
+        return max_rows
+    return max(1, min(max_rows, int(budget // max(row_bytes, 1))))
+
+def adapt_budget(budget, total, base, peak):
+    """
+    Given the window budget a task's been using, its total memory budget,
+    its peak RSS before it read any windows and its peak RSS since,
+    return the window budget scaled down so the same work would have
+    peaked within total (unchanged if it did)
+    """
+    if peak <= total or peak <= base:
+        return budget
+    scaled = int(budget * float(max(total - base, 0)) / (peak - base))
+    return max(s.MIN_WINDOW_BUDGET, scaled)
+
 ####################
 # Raster Read/Write
 ####################
 import numpy as np  
-from osgeo import gdal, ogr
+from osgeo import gdal, ogr, osr
 
 ### READ ###
 
@@ -282,6 +798,14 @@ def ds2array(ds, band=1):
     return ds.GetRasterBand(band).ReadAsArray(0, 0, num_pix_wide, num_pix_high)
 
 
+def ds2bands(ds):
+    """
+    Given a datasource, return the values of all its bands
+    as an array in the format [band, y, x]
+    """
+    return np.array([ds2array(ds, b) for b in range(1, ds.RasterCount + 1)])
+
+
 def pt2val(ds, pt_wkt, raster_array=None):
     """
     Given a raster datasource and a point WKT
@@ -293,7 +817,11 @@ def pt2val(ds, pt_wkt, raster_array=None):
     pt.Destroy()
     x_off, y_off = get_pix_offsets_for_point(ds, lng, lat)
     if raster_array is None:
-        raster_array = raster_ds_to_array(ds)
+        raster_array = ds2array(ds)
+    num_pix_high, num_pix_wide = raster_array.shape
+    if not (0 <= x_off < num_pix_wide and 0 <= y_off < num_pix_high):
+        # (negative offsets would silently wrap around)
+        raise IndexError('Point %s is off the raster' % pt_wkt)
     return raster_array[y_off, x_off]  # careful!  math matrix uses yoff, xoff
 
 
@@ -325,7 +853,43 @@ def serialize_rast(rast_fn, extra_data={}):
 
 
 import pandas as pd
-def apply_grid(rast_fn, grid_fn, extra_data={}, mask_fn=None):
+def read_grid(grid_fn, budget=None):
+    """
+    Given a "grid" filename (CSV with 'pix_ctr_wkt' column) and optionally
+    a budget in bytes, returns an iterator over arrays of the grid's point
+    WKTs, as many at a time as fit in the budget (all of them if None)
+    """
+    if not budget:
+        yield pd.read_csv(grid_fn)['pix_ctr_wkt'].values
+        return
+    chunk_size = max(1, int(budget // s.PLAN_GRID_ROW_BYTES))
+    for chunk in pd.read_csv(grid_fn, chunksize=chunk_size):
+        yield chunk['pix_ctr_wkt'].values
+
+
+def window_vals(ds, wkts, band=1):
+    """
+    Given a raster datasource and a list of point WKTs, read just the
+    window of the raster that covers the points, and return an array of
+    the value at each point and a boolean array of which points are on
+    the raster (like pt2val, for many points at once)
+    """
+    x_offs, y_offs = wkts2offsets(wkts, ds.GetGeoTransform())
+    on_raster = ((x_offs >= 0) & (x_offs < ds.RasterXSize) &
+                 (y_offs >= 0) & (y_offs < ds.RasterYSize))
+    vals = np.zeros(len(wkts))
+    if on_raster.any():
+        x_offs, y_offs = x_offs[on_raster], y_offs[on_raster]
+        x_start, y_start = int(x_offs.min()), int(y_offs.min())
+        window = ds.GetRasterBand(band).ReadAsArray(
+            x_start, y_start,
+            int(x_offs.max()) - x_start + 1, int(y_offs.max()) - y_start + 1)
+        vals[on_raster] = window[y_offs - y_start, x_offs - x_start]
+    return vals, on_raster
+
+
+def apply_grid(rast_fn, grid_fn, extra_data={}, mask_fn=None, tiles=None,
+               geotransform=None, stats=None, budget=None, tile_size=None):
     """
     Given a georeferenced raster filename,
     a "grid" filename (CSV with 'pix_ctr_wkt' column)
@@ -335,28 +899,48 @@ def apply_grid(rast_fn, grid_fn, extra_data={}, mask_fn=None):
 
     The optional mask_fn input is for a raster mask.  For pixels that have
     mask==0, this function skips the pixel.
+
+    The optional tiles input is a list of [x, y] grid tile indices (of
+    tile_size pixels - defaults to settings.OUT_TILE_SIZE, see point2tile).
+    If given, only grid points in those tiles are sampled.  Requires the
+    grid's geotransform.
+
+    If a stats dict is given, the number of grid points that were
+    'sampled', 'masked' and 'off_raster' are added to it as they're read.
+
+    If a budget (in bytes) is given, the grid is read that much at a time
+    (see read_grid), otherwise all at once.  Only the window of the
+    raster (and mask) that covers each chunk of points is read.
     """
-    ds = gdal.Open(rast_fn)
-    arr = ds2array(ds)
-    if mask_fn:
-        mask_ds = gdal.Open(mask_fn)
-        mask_arr = ds2array(mask_ds)
+    stats = stats if stats is not None else {}
+    for key in ['sampled', 'masked', 'off_raster']:
+        stats.setdefault(key, 0)
 
-    for wkt in pd.read_csv(grid_fn)['pix_ctr_wkt']:
-        try:
-            val = pt2val(ds, wkt, arr)
-        except Exception:  # swallow exceptions - grid pts off raster
-            continue  # skip this grid pt
-        if mask_fn:
-            try:
-                mask_val = pt2val(mask_ds, wkt, mask_arr)
-                if mask_val == 0:
-                    continue  # skip masked pixel
-            except Exception:
-                pass  # ignore invalid mask
-        pt_data = {'val': float(val)}
-        pt_data.update(extra_data)
-        yield wkt, pt_data
+    ds = gdal.Open(rast_fn)
+    mask_ds = gdal.Open(mask_fn) if mask_fn else None
+
+    for wkts in read_grid(grid_fn, budget):
+        if tiles is not None:
+            wkts = wkts[in_tiles(wkts, geotransform, tiles, tile_size)]
+        if not len(wkts):
+            continue
+        vals, on_raster = window_vals(ds, wkts)
+        if mask_ds is not None:
+            # points off the mask aren't masked
+            mask_vals, on_mask = window_vals(mask_ds, wkts)
+            masked = on_mask & (mask_vals == 0)
+
+        for i, wkt in enumerate(wkts):
+            if not on_raster[i]:  # skip grid pts off raster
+                stats['off_raster'] += 1
+                continue
+            if mask_ds is not None and masked[i]:
+                stats['masked'] += 1
+                continue  # skip masked pixel
+            stats['sampled'] += 1
+            pt_data = {'val': float(vals[i])}
+            pt_data.update(extra_data)
+            yield wkt, pt_data
 
 
 def rast2grid(rast_fn, out_csv='/tmp/grid.csv'):
@@ -369,88 +953,877 @@ def rast2grid(rast_fn, out_csv='/tmp/grid.csv'):
     df.to_csv(out_csv, index=False)
     return out_csv
 
+
+def meta2grid(meta, mask=None, out_csv='/tmp/grid.csv'):
+    """
+    Given grid metadata (see rast2meta) and optionally a boolean array
+    in the shape of the grid, return a CSV with the WKT of the pixel
+    centers (only where mask is True) on each line, in the same format
+    as rast2grid
+    """
+    num_pix_wide, num_pix_high = meta['size']
+    top_left_x, pix_width, _, top_left_y, _, pix_height = meta['geotransform']
+    wkts = []
+    for xoff in xrange(num_pix_wide):
+        x = top_left_x + (xoff + 0.5) * pix_width # +0.5 to get center x
+        for yoff in xrange(num_pix_high):
+            if mask is not None and not mask[yoff, xoff]:
+                continue
+            y = top_left_y + (yoff + 0.5) * pix_height # +0.5 to get center y
+            wkts.append({'pix_ctr_wkt': 'POINT(%s %s)' % (x, y)})
+    df = pd.DataFrame(wkts, columns=['pix_ctr_wkt'])
+    df.to_csv(out_csv, index=False)
+    return out_csv
+
+
+def aoi_keyname(aoi, job):
+    """
+    Given the "aoi" from a job's settings, return the keyname of its
+    vector file (see read_aoi), or None if it's a polygon WKT
+    """
+    if aoi.lstrip().upper().startswith(('POLYGON', 'MULTIPOLYGON')):
+        return None
+    return s.IN_AOI % (job, aoi)
+
+def read_aoi(aoi, job, projection=None):
+    """
+    Given the "aoi" from a job's settings - either a polygon WKT or the
+    filename of a vector file (or zipped shapefile) in the job's input
+    folder (see settings.IN_AOI) - return its area as an OGR geometry.
+
+    Features of a vector file are unioned, and reprojected to the
+    optional projection (WKT) if the file has a spatial reference.
+    A WKT is assumed to already be in the grid's projection.
+    """
+    keyname = aoi_keyname(aoi, job)
+    if keyname is None:
+        return ogr.CreateGeometryFromWkt(aoi)
+
+    aoi_fn = get_file(keyname)
+    if aoi_fn.endswith('.zip'):
+        aoi_fn = '/vsizip/' + aoi_fn
+    ds = ogr.Open(aoi_fn)
+    if ds is None:
+        raise Exception('Could not read AOI %s' % aoi)
+    layer = ds.GetLayer()
+
+    geom = None
+    for feature in layer:
+        feature_geom = feature.GetGeometryRef().Clone()
+        geom = feature_geom if geom is None else geom.Union(feature_geom)
+    if geom is None:
+        raise Exception('AOI %s has no features' % aoi)
+
+    if projection and layer.GetSpatialRef() is not None:
+        geom.AssignSpatialReference(layer.GetSpatialRef())
+        geom.TransformTo(osr.SpatialReference(wkt=projection))
+    return geom
+
+
+def rasterize_geom(geom, meta):
+    """
+    Given an OGR geometry and grid metadata (see rast2meta), return a
+    boolean array in the shape of the grid that's True for the pixels
+    whose centers are inside the geometry
+    """
+    num_pix_wide, num_pix_high = meta['size']
+    ds = gdal.GetDriverByName('MEM').Create(
+        '', num_pix_wide, num_pix_high, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform(meta['geotransform'])
+    ds.SetProjection(meta['projection'])
+
+    layer_ds = ogr.GetDriverByName('Memory').CreateDataSource('aoi')
+    layer = layer_ds.CreateLayer('aoi')
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geom)
+    layer.CreateFeature(feature)
+
+    gdal.RasterizeLayer(ds, [1], layer, burn_values=[1])
+    return ds2array(ds) == 1
+
+
+def crop2mask(meta, mask):
+    """
+    Given grid metadata (see rast2meta) and a boolean array in the shape
+    of the grid, crop both to the bounding box of the True pixels.
+
+    Returns (meta, mask)
+    """
+    rows, cols = np.where(mask.any(axis=1))[0], np.where(mask.any(axis=0))[0]
+    if not len(rows):
+        raise ValueError('Mask is empty - nothing to crop to')
+    x_start, y_start = cols[0], rows[0]
+    x_end, y_end = cols[-1] + 1, rows[-1] + 1
+    top_left_x, pix_width, x_rot, top_left_y, y_rot, pix_height = \
+        meta['geotransform']
+
+    out = dict(meta)
+    out['size'] = [int(x_end - x_start), int(y_end - y_start)]
+    out['geotransform'] = [
+        top_left_x + x_start * pix_width, pix_width, x_rot,
+        top_left_y + y_start * pix_height, y_rot, pix_height
+    ]
+    return out, mask[y_start:y_end, x_start:x_end]
+
+
+def projection2wkt(projection):
+    """
+    Given a projection as either "EPSG:<code>" or WKT, return its WKT
+    """
+    srs = osr.SpatialReference()
+    projection = str(projection)
+    if projection.upper().startswith('EPSG:'):
+        srs.ImportFromEPSG(int(projection.split(':')[1]))
+    else:
+        srs.ImportFromWkt(projection)
+    return srs.ExportToWkt()
+
+
+def region_meta(region, tile_size):
+    """
+    Given a "region" from a job's settings in the format
+    {
+        'projection': <"EPSG:<code>" or WKT>,
+        'bounds': [<min_x>, <min_y>, <max_x>, <max_y>],
+        'pixel_size': <pixel width/height in projection units>
+    }
+    and the output tile size (in pixels), return the metadata of a grid
+    covering the bounds (see rast2meta).
+
+    The grid's origin is snapped to a multiple of the tile width, so
+    every job in the same projection and pixel size shares the same tiles
+    """
+    min_x, min_y, max_x, max_y = [float(b) for b in region['bounds']]
+    pix_size = float(region['pixel_size'])
+    tile_width = pix_size * tile_size
+    top_left_x = np.floor(min_x / tile_width) * tile_width
+    top_left_y = np.ceil(max_y / tile_width) * tile_width
+    return {
+        'geotransform': [
+            float(top_left_x), pix_size, 0.0,
+            float(top_left_y), 0.0, -pix_size
+        ],
+        'size': [
+            int(np.ceil((max_x - top_left_x) / pix_size)),
+            int(np.ceil((top_left_y - min_y) / pix_size))
+        ],
+        'projection': projection2wkt(region['projection'])
+    }
+
+
+def apply_window(rast_fn, meta, offset, extra_data={}, mask_fn=None,
+                 stats=None, tiles=None, tile_size=None):
+    """
+    Given a raster that covers a window of a grid (see warp2grid), the
+    grid's metadata and the [x, y] pixel offset of the window in the grid,
+    and optionally a dictionary of extra data to include in each output,
+    returns an iterator that generates lines in the format:
+        "<pt_wkt>", {'val':<val>, <extra_key1>:<extra_val1>, ...}
+    for every pixel of the window that has data, where pt_wkt is the
+    center of the grid pixel (in the same format as meta2grid).
+
+    The optional mask_fn is a raster mask on the same window.  For pixels
+    that have mask==0, this function skips the pixel.
+
+    If a stats dict is given, the number of pixels that were 'sampled'
+    and 'masked' are added to it.
+
+    The optional tiles input is a list of [x, y] grid tile indices (of
+    tile_size pixels - defaults to settings.OUT_TILE_SIZE, see point2tile).
+    If given, only pixels in those tiles are sampled.
+    """
+    arr = ds2array(gdal.Open(rast_fn))
+    has_data = (arr != s.NODATA)
+    if tiles is not None:
+        tile_size = tile_size or s.OUT_TILE_SIZE
+        x_start, y_start = offset
+        num_rows, num_cols = arr.shape
+        tile_xs = (x_start + np.arange(num_cols)) // tile_size
+        tile_ys = (y_start + np.arange(num_rows)) // tile_size
+        tile_ids = tile_xs[np.newaxis, :] * 1000000 + tile_ys[:, np.newaxis]
+        keep_ids = [tx * 1000000 + ty for tx, ty in tiles]
+        has_data &= np.in1d(tile_ids, keep_ids).reshape(arr.shape)
+    stats = stats if stats is not None else {}
+    if mask_fn:
+        unmasked = (ds2array(gdal.Open(mask_fn)) != 0)
+        stats['masked'] = stats.get('masked', 0) + int(np.sum(has_data & ~unmasked))
+        has_data &= unmasked
+    stats['sampled'] = stats.get('sampled', 0) + int(np.sum(has_data))
+
+    top_left_x, pix_width, _, top_left_y, _, pix_height = meta['geotransform']
+    x_start, y_start = offset
+    for yoff, xoff in zip(*np.where(has_data)):
+        xoff, yoff = x_start + int(xoff), y_start + int(yoff)
+        x = top_left_x + (xoff + 0.5) * pix_width # +0.5 to get center x
+        y = top_left_y + (yoff + 0.5) * pix_height # +0.5 to get center y
+        pt_data = {'val': float(arr[yoff - y_start, xoff - x_start])}
+        pt_data.update(extra_data)
+        yield 'POINT(%s %s)' % (x, y), pt_data
+
+
+def rast2meta(rast_fn):
+    """
+    Given a georeferenced raster, return the metadata needed to
+    recreate its grid in the format:
+    {
+        'geotransform': [<top_left_x>, <pix_width>, <x_rot>,
+                         <top_left_y>, <y_rot>, <pix_height>],
+        'size': [<num_pix_wide>, <num_pix_high>],
+        'projection': <projection wkt>
+    }
+    """
+    ds = gdal.Open(rast_fn)
+    return {
+        'geotransform': list(ds.GetGeoTransform()),
+        'size': [ds.RasterXSize, ds.RasterYSize],
+        'projection': ds.GetProjection()
+    }
+
+
+def wkts2offsets(wkts, geotransform):
+    """
+    Vectorized version of get_pix_offsets_for_point.
+    Given a list of point WKTs and a geotransform,
+    return arrays of the x and y pixel offsets of each point
+    """
+    coords = np.array([
+        wkt.replace('POINT(', '').replace(')', '').split() for wkt in wkts
+    ], dtype=float).reshape(-1, 2)
+    top_left_x, pix_width, _, top_left_y, _, pix_height = geotransform
+    x_offs = ((coords[:, 0] - top_left_x) / pix_width).astype(int)
+    y_offs = ((coords[:, 1] - top_left_y) / pix_height).astype(int)
+    return x_offs, y_offs
+
+
+def point2tile(pt_wkt, geotransform, tile_size):
+    """
+    Given a point WKT, a geotransform and a tile size (in pixels),
+    return the [x, y] index of the tile the point is in
+    """
+    x_offs, y_offs = wkts2offsets([pt_wkt], geotransform)
+    return [int(x_offs[0]) // tile_size, int(y_offs[0]) // tile_size]
+
+
+def in_tiles(wkts, geotransform, tiles, tile_size=None):
+    """
+    Given a list of point WKTs, a geotransform and a list of [x, y]
+    tile indices, return a boolean array of which points are in the tiles
+    """
+    tile_size = tile_size or s.OUT_TILE_SIZE
+    x_offs, y_offs = wkts2offsets(wkts, geotransform)
+    tile_ids = (x_offs // tile_size) * 1000000 + (y_offs // tile_size)
+    keep_ids = [tx * 1000000 + ty for tx, ty in tiles]
+    return np.in1d(tile_ids, keep_ids)
+
+
+def tile_meta(meta, tile, tile_size):
+    """
+    Given grid metadata (see rast2meta), a tile index (x, y) and a
+    tile size, return the metadata for just that tile of the grid
+    (tiles on the right/bottom edges may be smaller than tile_size)
+    """
+    tile_x, tile_y = tile
+    x_start, y_start = tile_x * tile_size, tile_y * tile_size
+    num_pix_wide, num_pix_high = meta['size']
+    top_left_x, pix_width, x_rot, top_left_y, y_rot, pix_height = \
+        meta['geotransform']
+
+    out = dict(meta)
+    out['size'] = [
+        min(tile_size, num_pix_wide - x_start),
+        min(tile_size, num_pix_high - y_start)
+    ]
+    out['geotransform'] = [
+        top_left_x + x_start * pix_width, pix_width, x_rot,
+        top_left_y + y_start * pix_height, y_rot, pix_height
+    ]
+    return out
+
+def read_stack(vrt_fn, meta, tile, tile_size, rows=None):
+    """
+    Given a stack VRT on the grid (see build_stack_vrt), the grid metadata
+    and a tile index (x, y), read the tile out of every band of the VRT in
+    a single call.  If rows is given, in the format (<first row>, <number
+    of rows>), only those rows of the tile are read.
+
+    Returns an array in the format [band, y, x]
+    """
+    tile_x, tile_y = tile
+    size_x, size_y = tile_meta(meta, tile, tile_size)['size']
+    row_start, num_rows = rows or (0, size_y)
+    num_rows = min(num_rows, size_y - row_start)
+    cube = gdal.Open(vrt_fn).ReadAsArray(
+        tile_x * tile_size, tile_y * tile_size + row_start, size_x, num_rows)
+    return cube.reshape((-1, num_rows, size_x))  # single band VRTs are 2D
+
+
+def grid_footprint(rast_fn, meta):
+    """
+    Given a georeferenced raster in the grid's projection and the grid
+    metadata (see rast2meta), return where the raster's edges fall on
+    the grid (in grid pixels, not rounded) in the format
+    [<left x>, <top y>, <right x>, <bottom y>]
+    """
+    ds = gdal.Open(rast_fn)
+    left_x, pix_width, _, top_y, _, pix_height = ds.GetGeoTransform()
+    grid_left_x, grid_width, _, grid_top_y, _, grid_height = \
+        meta['geotransform']
+    x_edges = [
+        (left_x - grid_left_x) / grid_width,
+        (left_x + ds.RasterXSize * pix_width - grid_left_x) / grid_width
+    ]
+    y_edges = [
+        (top_y - grid_top_y) / grid_height,
+        (top_y + ds.RasterYSize * pix_height - grid_top_y) / grid_height
+    ]
+    return [min(x_edges), min(y_edges), max(x_edges), max(y_edges)]
+
+def stack_coverage(footprints, meta, tile, tile_size, rows=None):
+    """
+    Given the footprints of the rasters in a stack VRT (see grid_footprint)
+    and the same grid metadata, tile and rows as read_stack, return a
+    boolean array in the format [raster, y, x] that's True where the
+    raster covers the center of the grid pixel
+    """
+    tile_x, tile_y = tile
+    size_x, size_y = tile_meta(meta, tile, tile_size)['size']
+    row_start, num_rows = rows or (0, size_y)
+    num_rows = min(num_rows, size_y - row_start)
+    xs = tile_x * tile_size + np.arange(size_x) + 0.5
+    ys = tile_y * tile_size + row_start + np.arange(num_rows) + 0.5
+
+    covered = np.zeros((len(footprints), num_rows, size_x), dtype=bool)
+    for i, (x0, y0, x1, y1) in enumerate(footprints):
+        covered[i] = (((ys >= y0) & (ys < y1))[:, np.newaxis] &
+                      ((xs >= x0) & (xs < x1))[np.newaxis, :])
+    return covered
+
+def grid_tile_points(grid_fn, meta, tile, tile_size, budget=None):
+    """
+    Given a "grid" filename (CSV with 'pix_ctr_wkt' column), the grid
+    metadata, a tile index (x, y) and a tile size, return the WKTs of
+    the grid points in the tile and their [x offsets, y offsets]
+    within the tile
+
+    (budget limits how much of the grid is read at a time, see read_grid)
+    """
+    wkts = np.concatenate([
+        chunk[in_tiles(chunk, meta['geotransform'], [tile], tile_size)]
+        for chunk in read_grid(grid_fn, budget)
+    ] or [np.array([], dtype=object)])
+    x_offs, y_offs = wkts2offsets(wkts, meta['geotransform'])
+    return wkts, [x_offs - tile[0] * tile_size, y_offs - tile[1] * tile_size]
+
+
+def stack_algebra(bands, eqn, covered):
+    """
+    Same as band_algebra, for cubes read by read_stack.  Pixels that
+    aren't covered by their scene (see stack_coverage) are NODATA.
+    """
+    return np.where(covered, band_algebra(bands, eqn), s.NODATA)
+
+
+def stack2pix_datas(cube, covered, dates, wkts, offsets, mask_cube=None):
+    """
+    Given an index cube in the format [scene, y, x] (see read_stack),
+    the boolean cube of where each scene covers the grid (see
+    stack_coverage), the date code of each scene, the grid point WKTs in
+    the cube and their [x offsets, y offsets] within it, and optionally a
+    mask cube of the same shape, returns an iterator that generates lines
+    in the format:
+        "<pt_wkt>", [{'val': <val>, 'date': <date>}, ...]
+    with one observation per scene that covers the point (and has
+    mask != 0 there).  Values are kept whatever they are, like apply_grid
+    does, even when they equal NODATA.
+    """
+    x_offs, y_offs = offsets
+    vals = cube[:, y_offs, x_offs]  # format [scene, point]
+    has_data = covered[:, y_offs, x_offs].copy()
+    if mask_cube is not None:
+        has_data &= (mask_cube[:, y_offs, x_offs] != 0)
+
+    for i, wkt in enumerate(wkts):
+        yield wkt, [
+            {'val': float(vals[j, i]), 'date': dates[j]}
+            for j in np.where(has_data[:, i])[0]
+        ]
+
+
 ### WRITE ###
 
+# numpy equivalents of the gdal data types we write
+NUMPY_DATA_TYPES = {
+    gdal.GDT_Byte: np.uint8,
+    gdal.GDT_Int16: np.int16,
+    gdal.GDT_Int32: np.int32,
+    gdal.GDT_Float32: np.float32,
+    gdal.GDT_Float64: np.float64
+}
+
+def nodata_array(shape, data_type=None):
+    """
+    Given a shape and a gdal data type, return an array of that shape
+    (with the matching numpy type) filled with NODATA
+    """
+    holder = np.empty(shape, NUMPY_DATA_TYPES.get(data_type, np.float64))
+    holder.fill(s.NODATA)
+    return holder
+
+def label_data_type(label_key):
+    """
+    Given an output label key, return the smallest gdal data type that
+    holds its values (see settings.LABEL_DATA_TYPES)
+    """
+    for suffix, type_name in s.LABEL_DATA_TYPES:
+        if label_key.endswith(suffix):
+            return gdal.GetDataTypeByName(type_name)
+    return gdal.GetDataTypeByName(s.DEFAULT_DATA_TYPE)
+
+def default_predictor(data_type):
+    """
+    Given a gdal data type, return the TIFF predictor that suits it:
+    2 (horizontal differencing) for integers,
+    3 (floating point) for floats
+    """
+    if data_type in [gdal.GDT_Float32, gdal.GDT_Float64]:
+        return 3
+    return 2
+
+def output_predictor(settings, data_type):
+    """
+    Given the job's settings and a gdal data type, return the TIFF
+    predictor to write an output raster of that type with: the
+    output_predictor setting (one predictor, or one per kind of type in
+    the format {"int": X, "float": X}) if it's valid for the type,
+    otherwise default_predictor.  3 (floating point) is only valid for
+    floats, so integer rasters never get it.
+    """
+    is_float = data_type in [gdal.GDT_Float32, gdal.GDT_Float64]
+    predictor = settings.get('output_predictor')
+    if isinstance(predictor, dict):
+        predictor = predictor.get('float' if is_float else 'int')
+    if not predictor or (int(predictor) == 3 and not is_float):
+        return default_predictor(data_type)
+    return int(predictor)
+
+def creation_options(compress=True, predictor=None, tiled=False):
+    """
+    Given a compression codec (e.g. 'LZW', 'DEFLATE' - True means LZW and
+    False means uncompressed), an optional TIFF predictor and whether
+    or not to tile, return the GTiff creation options
+    """
+    options = []
+    if compress:
+        options.append('COMPRESS=%s' % ('LZW' if compress is True else compress))
+        if predictor:
+            options.append('PREDICTOR=%s' % predictor)
+    if tiled:
+        options += [
+            'TILED=YES',
+            'BLOCKXSIZE=%s' % s.COG_BLOCK_SIZE,
+            'BLOCKYSIZE=%s' % s.COG_BLOCK_SIZE
+        ]
+    return options
+
+def overview_levels(num_pix_wide, num_pix_high, block_size=None):
+    """
+    Given raster dimensions, return the overview decimation factors
+    (2, 4, 8, ...) needed until the smallest overview fits in one block
+    """
+    block_size = block_size or s.COG_BLOCK_SIZE
+    levels, factor = [], 2
+    while max(num_pix_wide, num_pix_high) / (factor / 2) > block_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
 def array2raster(array, template_rast_fn, out_fn=None, data_type=None,
-                 compress=True):
+                 compress=True, band_names=None, predictor=None):
     """
-    Given a 2-dimensional np array and a template raster,
+    Given a 2-dimensional np array (or a 3-dimensional one, in the format
+    [band, y, x], for a multi-band raster) and a template raster,
     write the array out to a georeferenced raster in the same style as the template.
 
+    band_names optionally sets the description of each band.
+    compress is the codec to use (True means LZW) and predictor the
+    optional TIFF predictor.
+
     For the no_data_val and data_type, if no value is specified it falls back
     to whatever those settings are in the template
     """
     if not out_fn:
         out_fn = os.path.join('/tmp', 'output_%s' % os.path.basename(template_rast_fn))
 
-    options = ['COMPRESS=LZW'] if compress else []
+    options = creation_options(compress, predictor)
+
+    bands = array if array.ndim == 3 else array[np.newaxis]
 
     template_ds = gdal.Open(template_rast_fn)
     ds_shape = (template_ds.RasterYSize, template_ds.RasterXSize)
-    if array.shape != ds_shape:
+    if bands.shape[1:] != ds_shape:
         raise Exception(
             'Dimensions of array %s and template raster %s don\'t match' % (
                 array.shape, ds_shape
             )
         )
+    out_ds = create_like(
+        template_ds, out_fn, bands.shape[0], data_type, options)
+    for i, band_array in enumerate(bands):
+        out_band = out_ds.GetRasterBand(i + 1)
+        if band_names:
+            out_band.SetDescription(band_names[i])
+        out_band.WriteArray(band_array, 0, 0)
+
+    return out_fn
+
+def create_like(template_ds, out_fn, num_bands=1, data_type=None,
+                options=[]):
+    """
+    Given a template raster datasource, an output filename and optionally
+    the number of bands, gdal data type (defaults to the template's) and
+    creation options, create a georeferenced raster the same size as
+    the template (NODATA set on every band).
+
+    Returns the (open) gdal datasource
+    """
     if not data_type:
         data_type = template_ds.GetRasterBand(1).DataType
 
-    driver = template_ds.GetDriver()
-    out_ds = driver.Create(
-        out_fn, template_ds.RasterXSize, template_ds.RasterYSize, 1, data_type,
-        options
+    out_ds = template_ds.GetDriver().Create(
+        out_fn, template_ds.RasterXSize, template_ds.RasterYSize,
+        num_bands, data_type, options
     )
-    out_band = out_ds.GetRasterBand(1)
-    out_band.SetNoDataValue(s.NODATA)
-    out_band.WriteArray(array, 0, 0)
-    
+    for i in range(num_bands):
+        out_ds.GetRasterBand(i + 1).SetNoDataValue(s.NODATA)
+
     # georeference image
     out_ds.SetGeoTransform(template_ds.GetGeoTransform())
     out_ds.SetProjection(template_ds.GetProjection())
+    return out_ds
 
-    return out_fn
-
-def data2raster(data, template_fn, out_fn='/tmp/rast.tif', compress=True):
+def data2raster(data, template_fn, out_fn='/tmp/rast.tif', compress=True,
+                data_type=None, band_names=None):
     """
     Given an iterable (list) in the format:
         {'pix_ctr_wkt': wkt, 'value': val}
     And a tif to use as a template,
     Create a new tif where the values are
     filled in to the raster.
+
+    If the values are lists, a multi-band tif is created with
+    one band per list item.
     
     Returns the new filename
     
     Note: NODATA value hardcoded as -99
     """
     template_ds = gdal.Open(template_fn)
+    ds_shape = (template_ds.RasterYSize, template_ds.RasterXSize)
 
-    # initialize array to all NODATA
-    holder = np.ones_like(ds2array(template_ds)) * s.NODATA
-    
+    holder = None
     for d in data:
         clean = d['pix_ctr_wkt'].replace('POINT(', '').replace(')', '').strip()
         lng, lat = [float(x) for x in clean.split(' ')]
-        val = float(d['value'])
+        val = d['value']
+
+        if holder is None:
+            # initialize array to all NODATA
+            num_bands = len(val) if isinstance(val, list) else 1
+            holder = nodata_array((num_bands,) + ds_shape, data_type)
         
         # figure out where the pixel goes
         x_off, y_off = get_pix_offsets_for_point(template_ds, lng, lat)
-        holder[y_off, x_off] = val  # careful!  matrix uses y, x notation
+        holder[:, y_off, x_off] = val  # careful!  matrix uses y, x notation
+
+    if holder is None:
+        holder = nodata_array((1,) + ds_shape, data_type)
    
-    return array2raster(holder, template_fn, out_fn, compress)
+    return array2raster(
+        holder, template_fn, out_fn, data_type=data_type, compress=compress,
+        band_names=band_names)
+
+
+def create_raster(out_fn, meta, num_bands=1, data_type=None, compress=True,
+                  band_names=None, predictor=None, tiled=False):
+    """
+    Given an output filename and grid metadata (see rast2meta),
+    create a georeferenced GeoTIFF with every band filled with NODATA.
+
+    band_names optionally sets the description of each band.
+    See creation_options for compress, predictor and tiled.
+
+    Returns the (open) gdal datasource
+    """
+    options = creation_options(compress, predictor, tiled)
+    num_pix_wide, num_pix_high = meta['size']
+
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(
+        out_fn, num_pix_wide, num_pix_high, num_bands,
+        data_type or gdal.GDT_Float32, options
+    )
+    out_ds.SetGeoTransform(meta['geotransform'])
+    out_ds.SetProjection(meta['projection'])
+    for i in range(num_bands):
+        out_band = out_ds.GetRasterBand(i + 1)
+        out_band.SetNoDataValue(s.NODATA)
+        out_band.Fill(s.NODATA)
+        if band_names:
+            out_band.SetDescription(band_names[i])
+    return out_ds
+
+def clip_raster(rast_fn, meta, out_fn):
+    """
+    Given a georeferenced raster, grid metadata (see rast2meta) and an
+    output filename, copy just the window of the raster that covers the
+    grid (all bands, snapped out to the raster's own pixels) to out_fn.
+
+    Returns out_fn, or None if the raster doesn't overlap the grid
+    """
+    ds = gdal.Open(rast_fn)
+    left_x, pix_width, x_rot, top_y, y_rot, pix_height = ds.GetGeoTransform()
+    grid_left_x, grid_width, _, grid_top_y, _, grid_height = \
+        meta['geotransform']
+    num_pix_wide, num_pix_high = meta['size']
+
+    # where the grid's edges fall on the raster
+    x_edges = [
+        (grid_left_x - left_x) / pix_width,
+        (grid_left_x + num_pix_wide * grid_width - left_x) / pix_width
+    ]
+    y_edges = [
+        (grid_top_y - top_y) / pix_height,
+        (grid_top_y + num_pix_high * grid_height - top_y) / pix_height
+    ]
+    x0 = max(int(np.floor(min(x_edges))), 0)
+    x1 = min(int(np.ceil(max(x_edges))), ds.RasterXSize)
+    y0 = max(int(np.floor(min(y_edges))), 0)
+    y1 = min(int(np.ceil(max(y_edges))), ds.RasterYSize)
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(
+        out_fn, x1 - x0, y1 - y0, ds.RasterCount,
+        ds.GetRasterBand(1).DataType
+    )
+    out_ds.SetGeoTransform([
+        left_x + x0 * pix_width, pix_width, x_rot,
+        top_y + y0 * pix_height, y_rot, pix_height
+    ])
+    out_ds.SetProjection(ds.GetProjection())
+    for b in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(b)
+        out_band = out_ds.GetRasterBand(b)
+        out_band.WriteArray(band.ReadAsArray(x0, y0, x1 - x0, y1 - y0))
+        if band.GetNoDataValue() is not None:
+            out_band.SetNoDataValue(band.GetNoDataValue())
+    out_ds.FlushCache()
+    return out_fn
+
+def warp2grid(rast_fn, meta, out_fn, resampling=None):
+    """
+    Given a georeferenced raster (in any projection), grid metadata (see
+    rast2meta or region_meta) and an output filename, reproject and
+    resample the raster on to the window of the grid that it covers.
+    Pixels of the window the raster doesn't cover are NODATA (the output
+    is Float32 so NODATA fits no matter the input data type).
+
+    resampling is a gdal.GRA_* constant, nearest neighbor by default.
+
+    Returns (out_fn, [<x offset>, <y offset>]) of the window in the grid,
+    or None if the raster doesn't overlap the grid
+    """
+    ds = gdal.Open(rast_fn)
+    left_x, pix_width, _, top_y, _, pix_height = ds.GetGeoTransform()
+    corners = [
+        (x, y)
+        for x in [left_x, left_x + ds.RasterXSize * pix_width]
+        for y in [top_y, top_y + ds.RasterYSize * pix_height]
+    ]
+    rast_srs = osr.SpatialReference(wkt=ds.GetProjection())
+    grid_srs = osr.SpatialReference(wkt=meta['projection'])
+    if not rast_srs.IsSame(grid_srs):
+        transform = osr.CoordinateTransformation(rast_srs, grid_srs)
+        corners = [transform.TransformPoint(x, y)[:2] for x, y in corners]
+
+    # where the raster's footprint falls on the grid
+    grid_left_x, grid_width, x_rot, grid_top_y, y_rot, grid_height = \
+        meta['geotransform']
+    num_pix_wide, num_pix_high = meta['size']
+    x_edges = [(x - grid_left_x) / grid_width for x, y in corners]
+    y_edges = [(y - grid_top_y) / grid_height for x, y in corners]
+    x0 = max(int(np.floor(min(x_edges))), 0)
+    x1 = min(int(np.ceil(max(x_edges))), num_pix_wide)
+    y0 = max(int(np.floor(min(y_edges))), 0)
+    y1 = min(int(np.ceil(max(y_edges))), num_pix_high)
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(
+        out_fn, x1 - x0, y1 - y0, ds.RasterCount, gdal.GDT_Float32)
+    out_ds.SetGeoTransform([
+        grid_left_x + x0 * grid_width, grid_width, x_rot,
+        grid_top_y + y0 * grid_height, y_rot, grid_height
+    ])
+    out_ds.SetProjection(meta['projection'])
+    for b in range(1, ds.RasterCount + 1):
+        out_band = out_ds.GetRasterBand(b)
+        out_band.SetNoDataValue(s.NODATA)
+        out_band.Fill(s.NODATA)
+
+    if resampling is None:
+        resampling = gdal.GRA_NearestNeighbour
+    gdal.ReprojectImage(
+        ds, out_ds, ds.GetProjection(), meta['projection'], resampling)
+    out_ds.FlushCache()
+    return out_fn, [x0, y0]
+
+def build_stack_vrt(rast_fns, band, meta, out_fn):
+    """
+    Given a list of raster filenames, a band number, grid metadata (see
+    rast2meta) and an output filename, build a VRT with that band of each
+    raster as one of its bands (in order), aligned to the grid (resampled
+    with nearest neighbor where needed).  Pixels a raster doesn't cover
+    are NODATA, but so can be pixels it does cover, so tell them apart
+    with stack_coverage.  The rasters' own nodata values are read as they
+    are, like apply_grid does.
+
+    Returns out_fn
+    """
+    top_left_x, pix_width, _, top_left_y, _, pix_height = meta['geotransform']
+    num_pix_wide, num_pix_high = meta['size']
+    gdal.BuildVRT(out_fn, rast_fns, options=gdal.BuildVRTOptions(
+        separate=True,
+        bandList=[band],
+        outputBounds=(
+            top_left_x,
+            top_left_y + num_pix_high * pix_height,
+            top_left_x + num_pix_wide * pix_width,
+            top_left_y
+        ),
+        xRes=abs(pix_width),
+        yRes=abs(pix_height),
+        resampleAlg='nearest',
+        srcNodata='None',
+        VRTNodata=s.NODATA
+    )).FlushCache()
+    return out_fn
+
+def raster2cog(rast_fn, out_fn, compress=True, predictor=None,
+               resampling='NEAREST'):
+    """
+    Given a raster, write a Cloud-Optimized GeoTIFF copy of it:
+    internally tiled, with overviews stored ahead of the full-resolution
+    data so that viewers can read any part of it with HTTP range requests.
+
+    Note: builds the overviews in to rast_fn itself
+
+    Returns the new filename
+    """
+    ds = gdal.Open(rast_fn, gdal.GA_Update)
+    levels = overview_levels(ds.RasterXSize, ds.RasterYSize)
+    if levels:
+        ds.BuildOverviews(resampling, levels)
+
+    options = creation_options(compress, predictor, tiled=True)
+    options.append('COPY_SRC_OVERVIEWS=YES')
+    out_ds = gdal.GetDriverByName('GTiff').CreateCopy(out_fn, ds, 0, options)
+    out_ds, ds = None, None  # flush to disk
+
+    return out_fn
+
+def data2block(data, meta, tile, tile_size, out_fn='/tmp/block.tif',
+               data_type=None, compress=True):
+    """
+    Like data2raster, but only for one tile of the grid.
+    Given an iterable (list) in the format:
+        {'pix_ctr_wkt': wkt, 'value': val}
+    (where val may be a list, for multi-band blocks),
+    grid metadata (see rast2meta), the (x, y) index of the tile and the
+    tile size, create a tif of just that tile with the values filled in.
+
+    Returns the new filename
+    """
+    data = list(data)
+    block_meta = tile_meta(meta, tile, tile_size)
+    num_pix_wide, num_pix_high = block_meta['size']
+
+    values = np.array([d['value'] for d in data], dtype=float)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]  # format [pixel, band]
+    x_offs, y_offs = wkts2offsets(
+        [d['pix_ctr_wkt'] for d in data], block_meta['geotransform'])
+
+    holder = nodata_array(
+        (values.shape[1], num_pix_high, num_pix_wide), data_type)
+    holder[:, y_offs, x_offs] = values.T  # careful!  matrix uses y, x notation
+
+    out_ds = create_raster(
+        out_fn, block_meta, holder.shape[0], data_type, compress)
+    for i, band_array in enumerate(holder):
+        out_ds.GetRasterBand(i + 1).WriteArray(band_array, 0, 0)
+    out_ds = None  # flush to disk
+
+    return out_fn
+
+def merge_blocks(block_fns, meta, out_fn='/tmp/rast.tif', data_type=None,
+                 compress=True, band_names=None, predictor=None, cog=True):
+    """
+    Given a list of block tifs (see data2block) and the metadata of the
+    grid they're tiles of, write each block in to its window of a
+    single raster covering the whole grid.  Only one block is held in
+    memory at a time.
+
+    Unless cog is False, the output is a Cloud-Optimized GeoTIFF
+    (see raster2cog).  See creation_options for compress and predictor.
+
+    Returns the new filename
+    """
+    merge_fn = out_fn + '.merge.tif' if cog else out_fn
+    num_bands = gdal.Open(block_fns[0]).RasterCount
+    out_ds = create_raster(
+        merge_fn, meta, num_bands, data_type,
+        compress=False if cog else compress,
+        band_names=band_names,
+        predictor=predictor,
+        tiled=cog
+    )
+    top_left_x, pix_width, _, top_left_y, _, pix_height = meta['geotransform']
+
+    for block_fn in block_fns:
+        block_ds = gdal.Open(block_fn)
+        block_left_x, _, _, block_top_y, _, _ = block_ds.GetGeoTransform()
+        x_off = int(round((block_left_x - top_left_x) / pix_width))
+        y_off = int(round((block_top_y - top_left_y) / pix_height))
+        for band in range(1, num_bands + 1):
+            out_ds.GetRasterBand(band).WriteArray(
+                ds2array(block_ds, band), x_off, y_off)
+    out_ds = None  # flush to disk
+
+    if cog:
+        raster2cog(merge_fn, out_fn, compress, predictor)
+        os.remove(merge_fn)
+
+    return out_fn
 
 
 ##################
 # Raster algebra
 ##################
 # numpy referenced in eval code
-def rast_algebra(rast_fn, eqn, mask_eqn=None, out_fn='/tmp/rast_algebra.tif'):
+def rast_algebra(rast_fn, eqn, mask_eqn=None, out_fn='/tmp/rast_algebra.tif',
+                 budget=None):
     """
     Given a raster file, 
     a string equation
     and an optional output file name,
 
     create a new raster with the equation applied to it
+
+    If a budget (in bytes) is given, the raster is read and written in
+    windows of rows that fit in it (see window_rows)
     """
     gdal.UseExceptions() # enable exception-throwing by GDAL
     
@@ -466,22 +1839,159 @@ def rast_algebra(rast_fn, eqn, mask_eqn=None, out_fn='/tmp/rast_algebra.tif'):
     if min_band <= 0:
         raise Exception('Invalid band "%s" - bands must be >= 1')
 
+    # each pixel of a window holds its bands, the result and a temporary
+    num_pix_wide, num_pix_high = ds.RasterXSize, ds.RasterYSize
+    rows = window_rows(
+        num_pix_wide * 8 * (len(all_bands) + 2), budget, num_pix_high)
+
+    out_ds = create_like(ds, out_fn, options=creation_options(True))
+    out_band = out_ds.GetRasterBand(1)
+    for y_off in xrange(0, num_pix_high, rows):
+        num_rows = min(rows, num_pix_high - y_off)
+        bands = dict([
+            (b, ds.GetRasterBand(b).ReadAsArray(
+                0, y_off, num_pix_wide, num_rows))
+            for b in all_bands
+        ])
+        out_band.WriteArray(band_algebra(bands, eqn, mask_eqn), 0, y_off)
+    out_ds = None  # flush to disk
+    return out_fn
+
+def band_algebra(bands, eqn, mask_eqn=None):
+    """
+    Given a dict of {<band number>: <array>} (arrays of any matching shape),
+    a string equation and an optional mask equation,
+    return the array with the equation applied to the bands
+    """
     # bands is referenced in the modified equations
-    bands = dict([(b, ds2array(ds, b)) for b in all_bands])
-    
+    all_bands = set(parse_eqn_bands(eqn) + parse_eqn_bands(mask_eqn or ''))
     band_replace = dict([('B%s' %b, 'bands[%s]' % b) for b in all_bands])
     mod_eqn = multiple_replace(eqn, band_replace)
 
     if mask_eqn:
         mod_mask_eqn = multiple_replace(mask_eqn, band_replace)
         no_data_val = s.NODATA  # referenced in modified equation below
-        data = eval(
+        return eval(
             'np.choose(%s, (no_data_val, %s)))' % (mod_mask_eqn, mod_eqn)
         )
-    else:
-        data = eval(mod_eqn)
+    return eval(mod_eqn)
+
+##################
+# Scene planning
+##################
+def rank_scenes(keynames, target_date):
+    """
+    Given the keynames of the analysis rasters and the target date,
+    group them by year and order each year's scenes by how close they
+    are to the target date (the order pick_winners prefers them in)
+
+    Returns a dict in the format {<year>: [<keyname>, ...], ...}
+    """
+    ranked = {}
+    for keyname in keynames:
+        code = filename2datecode(keyname)
+        ranked.setdefault(code // 1000, []).append((code, keyname))
+
+    for yr, scenes in ranked.iteritems():
+        target = date2code(datetime(
+            year=yr, month=target_date.month, day=target_date.day
+        ))
+        ordered = sorted(scenes, key=lambda x: abs(target - x[0]))
+        ranked[yr] = [keyname for code, keyname in ordered]
+    return ranked
+
+def mask2grid(mask_fn, meta):
+    """
+    Given a mask raster and grid metadata (see rast2meta), return a boolean
+    array in the shape of the grid that's True where the mask guarantees
+    an unmasked pixel (mask != 0).  Anything off the mask, or a mask on a
+    different pixel size than the grid, counts as not guaranteed.
+    """
+    num_pix_wide, num_pix_high = meta['size']
+    top_left_x, pix_width, _, top_left_y, _, pix_height = meta['geotransform']
+    out = np.zeros((num_pix_high, num_pix_wide), dtype=bool)
+
+    ds = gdal.Open(mask_fn)
+    mask_left_x, mask_width, _, mask_top_y, _, mask_height = \
+        ds.GetGeoTransform()
+    if (mask_width, mask_height) != (pix_width, pix_height):
+        return out
+
+    # where the mask sits on the grid
+    x_off = int(round((mask_left_x - top_left_x) / pix_width))
+    y_off = int(round((mask_top_y - top_left_y) / pix_height))
+    x0, y0 = max(x_off, 0), max(y_off, 0)
+    x1 = min(x_off + ds.RasterXSize, num_pix_wide)
+    y1 = min(y_off + ds.RasterYSize, num_pix_high)
+    if x0 >= x1 or y0 >= y1:
+        return out
+
+    mask_arr = ds2array(ds)
+    out[y0:y1, x0:x1] = mask_arr[y0 - y_off:y1 - y_off, x0 - x_off:x1 - x_off] != 0
+    return out
+
+def tiles_with(arr, tile_size):
+    """
+    Given a 2-dimensional boolean array and a tile size,
+    return the [x, y] indices of the tiles that have any True pixels
+    """
+    num_pix_high, num_pix_wide = arr.shape
+    tiles = []
+    for ty in range(0, (num_pix_high + tile_size - 1) // tile_size):
+        for tx in range(0, (num_pix_wide + tile_size - 1) // tile_size):
+            window = arr[ty * tile_size:(ty + 1) * tile_size,
+                         tx * tile_size:(tx + 1) * tile_size]
+            if window.any():
+                tiles.append([tx, ty])
+    return tiles
+
+def grid_tiles(meta, tile_size, mask=None):
+    """
+    Given grid metadata, a tile size and optionally a boolean array in
+    the shape of the grid, return the [x, y] indices of every tile of the
+    grid (that has any True pixels in the mask)
+    """
+    if mask is None:
+        num_pix_wide, num_pix_high = meta['size']
+        mask = np.ones((num_pix_high, num_pix_wide), dtype=bool)
+    return tiles_with(mask, tile_size)
+
+def plan_scenes(ranked, mask_fns, meta, tile_size, aoi_mask=None):
+    """
+    Given scenes ranked by rank_scenes, a dict of {<keyname>: <mask_fn>}
+    (mask_fn is None for scenes without a mask), the grid metadata and a
+    tile size, work out which tiles each scene needs to be read for.
+
+    A scene can only win a pixel if every scene ranked above it in its
+    year is masked there, so lower ranked scenes are only read for the
+    tiles that still have pixels unresolved by the scenes above them.
+
+    If a boolean aoi_mask (in the shape of the grid, see rasterize_geom)
+    is given, pixels outside it never need to be read.
+
+    Returns a dict in the format
+        {<keyname>: [[<tile x>, <tile y>], ...] or None, ...}
+    where None means every tile.  Scenes that can't win anywhere are
+    left out.
+    """
+    num_pix_wide, num_pix_high = meta['size']
+    all_tiles = grid_tiles(meta, tile_size)
+
+    plan = {}
+    for yr, keynames in ranked.iteritems():
+        unresolved = np.ones((num_pix_high, num_pix_wide), dtype=bool)
+        if aoi_mask is not None:
+            unresolved &= aoi_mask
+        for keyname in keynames:
+            tiles = tiles_with(unresolved, tile_size)
+            if not tiles:
+                break  # every pixel is resolved by higher ranked scenes
+            plan[keyname] = None if tiles == all_tiles else tiles
+
+            if mask_fns.get(keyname):
+                unresolved &= ~mask2grid(mask_fns[keyname], meta)
+    return plan
 
-    return array2raster(data, rast_fn, out_fn=out_fn)
 
 #############
 # Analysis
@@ -492,70 +2002,103 @@ def pick_winners(dict_list, target_date):
     """
     Given a list of dicts in the format:
     [
-        {'date': '2011-09-01', 'val': 160.0},
-        {'date': '2012-09-01', 'val': 160.0},
+        {'date': 2011244, 'val': 160.0},
+        {'date': 2012245, 'val': 160.0},
         ...
     ],
+    (dates are date codes - see date2code - or YYYY-MM-DD strings)
     and a target date (year doesn't matter)
     for each year, pick the dict closest to the target month/day
     """
     # group by year
     year_groups = {}
     for d in dict_list:
-        yr = parse_date(d['date']).year
-        year_groups[yr] = year_groups.get(yr, []) + [d]
+        code = as_datecode(d['date'])
+        year_groups.setdefault(code // 1000, []).append((code, d))
     
     # for each year, pick median pixel
     winners = []
     for yr, ds in year_groups.iteritems():
-        target = datetime(
+        target = date2code(datetime(
             year=yr, month=target_date.month, day=target_date.day
-        )
+        ))
         # order by date
-        ordered = sorted(
-            ds, key=lambda x: abs((target - parse_date(x['date'])).days)
-        )
+        ordered = sorted(ds, key=lambda x: abs(target - x[0]))
         # pick closest
-        winners.append(ordered[0])
+        winners.append(ordered[0][1])
 
     return winners
 
 def dicts2timeseries(dict_list):
     """
     Given a list of dicts in the format:
-        [{'date': '2011-09-01', 'val': 160.0}, {'date': '2012-09-01', 'val': 160.0}]
-    Put them into a sorted time series and return
+        [{'date': 2011244, 'val': 160.0}, {'date': 2012245, 'val': 160.0}]
+    (dates are date codes - see date2code - or YYYY-MM-DD strings)
+    Put them into a time series indexed by date code, sorted, and return
     """
-    dates = [parse_date(x['date']) for x in dict_list]
+    codes = [as_datecode(x['date']) for x in dict_list]
     vals = [x['val'] for x in dict_list]
-    series = pd.Series(data=vals, index=dates)
+    series = pd.Series(data=vals, index=codes)
     return series.sort_index()
 
 def timeseries2int_series(time_series):
     """
     It's tricky to do math on dates, so instead of having dates
     as the index for a series, start the series at 0 and instead 
-    use the number of days since the beginning of the series as the index.
+    use the number of years since the beginning of the series as the index.
+
+    The time series may be indexed by date codes or by datetimes.
 
     Returns a new series
 
     NOTE: Robert wanted to do by year rather than by day
     """
-    dates = time_series.index.values
+    index = time_series.index
+    if isinstance(index, pd.DatetimeIndex):
+        years = np.asarray(index.year)
+    else:
+        years = np.asarray(index) // 1000
+    return pd.Series(data=time_series.values, index=years - years[0])
+
+def despike_stack(stack):
+    """
+    Given an array of sorted series in the format [year, pixel]
+    (or a single series), return a boolean array of the same shape
+    that's True for each spike.
+
+    A point is a spike if its neighbors are both on the same side of it
+    (both above or both below), both more than a standard deviation away,
+    and it isn't equal to the last point that wasn't a spike.
+    The first and last points are never spikes.
+    """
+    stack = np.asarray(stack, dtype=float)
+    if stack.ndim == 1:  # single series
+        return despike_stack(stack[:, np.newaxis])[:, 0]
+
+    is_spike = np.zeros(stack.shape, dtype=bool)
+    if len(stack) < 3:
+        return is_spike
 
-    # USING JULIAN DAY 
-    #days_series = [
-    #    (d - dates[0]).astype('timedelta64[D]').item().days for d in dates
-    #]
-    #return pd.Series(data=time_series.values, index=days_series)
+    std_dev = np.std(stack, axis=0)  # standard deviation of each pixel
+    x, y, z = stack[:-2], stack[1:-1], stack[2:]
+    candidate = ~(((x <= y) & (y <= z)) | ((x >= y) & (y >= z))) & \
+        (np.abs(y - x) > std_dev) & (np.abs(y - z) > std_dev)
 
-    yr_0 = pd.to_datetime(str(dates[0])).year
-    years_series = [(pd.to_datetime(str(d)).year - yr_0) for d in dates]
-    return pd.Series(data=time_series.values, index=years_series)
+    # last_good is the value of the latest non-candidate point before each
+    # point (candidates that equal last_good are kept, but don't change it)
+    rows = np.arange(len(stack) - 1)[:, np.newaxis]
+    good_rows = np.where(np.vstack([
+        np.zeros((1, stack.shape[1]), dtype=bool), candidate
+    ]), 0, rows)
+    last_good_rows = np.maximum.accumulate(good_rows, axis=0)[:-1]
+    last_good = stack[last_good_rows, np.arange(stack.shape[1])]
+
+    is_spike[1:-1] = candidate & (y != last_good)
+    return is_spike
 
 def despike(time_series):
     """
-    Given a sorted timeseries, remove any spikes.
+    Given a sorted timeseries, remove any spikes (see despike_stack).
     
     Right now the algorithm is very simple, it just finds the standard 
     deviation and prunes out any points that are more than a standard 
@@ -563,22 +2106,41 @@ def despike(time_series):
 
     Outputs a modified series with nulled out outliers
     """
-    std_dev = np.std(time_series) # standard deviation
-    triples = [time_series[i:i+3] for i in range(0, len(time_series)-2)]
-    despiked = []
-    despiked.append(time_series[0]) # first not an outlier
-    last_good = time_series[0]
-    for x, y, z in triples:
-        # If x and z are on same side of y (both above or both below)
-        # and both x and z are more than a std_dev away...
-        if not ((x <= y <= z) or (x >= y >= z)) and \
-                ((abs(y-x) > std_dev) and (abs(y-z) > std_dev)) and \
-                y != last_good:
-            despiked.append(None)
-        else:
-            despiked.append(y)
-            last_good = y
-    despiked.append(time_series[-1]) # last not an outlier
+    vals = np.asarray(time_series.values, dtype=float)
+    despiked = np.where(despike_stack(vals), np.nan, vals)
+    return pd.Series(data=despiked, index=time_series.index.values)
+
+def mark_spikes(winner_lists):
+    """
+    Given the winners (see pick_winners) of many pixels, one list per
+    pixel, find the spikes of every pixel's series at once and mark them
+    with 'spike': True (see despike_marked).  Series of the same length
+    are despiked together as one [year, pixel] stack (see despike_stack).
+
+    Sorts each list by date, and returns the lists
+    """
+    by_length = {}
+    for winners in winner_lists:
+        winners.sort(key=lambda d: as_datecode(d['date']))
+        by_length.setdefault(len(winners), []).append(winners)
+
+    for group in by_length.itervalues():
+        stack = np.array([[d['val'] for d in w] for w in group], dtype=float)
+        is_spike = despike_stack(stack.T)
+        for year, pixel in zip(*np.where(is_spike)):
+            group[pixel][year]['spike'] = True
+    return winner_lists
+
+def despike_marked(time_series, winners):
+    """
+    Same as despike, but takes the spikes mark_spikes marked in the
+    winners the series was made from instead of finding them again
+    """
+    spikes = set(as_datecode(d['date']) for d in winners if d.get('spike'))
+    is_spike = np.array([code in spikes for code in time_series.index],
+                        dtype=bool)
+    vals = np.asarray(time_series.values, dtype=float)
+    despiked = np.where(is_spike, np.nan, vals)
     return pd.Series(data=despiked, index=time_series.index.values)
 
 def least_squares(series):
@@ -630,6 +2192,36 @@ def segmented_least_squares(series, line_cost):
     list_indices += [n-1] # last index always in
     return [series.index.values[x] for x in list_indices]
 
+def classify_series(series, line_cost):
+    """
+    Given a series and a line cost, cheaply check whether it can have any
+    vertices besides its endpoints.  Returns the reason it can't:
+        'short' - fewer than settings.MIN_SERIES_LENGTH points
+        'constant' - every point is the same
+        'stable' - a single line through it has a sum of squared errors
+            no more than line_cost, so splitting it (which adds at least
+            one more line_cost) can never be cheaper
+    or None if it needs the full segmented_least_squares
+    """
+    series = series.dropna()  # remove any NaN vals
+    vals = series.values
+    if len(vals) < s.MIN_SERIES_LENGTH:
+        return 'short'
+    if vals.min() == vals.max():
+        return 'constant'
+    if least_squares(series)[1] <= line_cost:
+        return 'stable'
+    return None
+
+def single_segment(series):
+    """
+    Given a series, return the indices of the endpoints of a single line
+    through it (what segmented_least_squares returns for the series
+    classify_series picks out)
+    """
+    x = series.dropna().index.values
+    return [x[0], x[-1]]
+
 def find_segments(j, e, c, OPT):
     """
     Given an index j, a residuals dictionary, a line cost, and a
@@ -643,6 +2235,95 @@ def find_segments(j, e, c, OPT):
         min_index = vals.index(min(vals))
         return find_segments(min_index-1, e, c, OPT) + [min_index]
 
+def sls_state(series, line_cost):
+    """
+    Given a series and a line cost, run the same dynamic program as
+    segmented_least_squares, but keep everything needed to append more
+    points later without starting over:
+    {
+        'line_cost': <line_cost>,
+        'x': [<index of each non-NaN point>, ...],
+        'sums': [[sum_x, sum_y, sum_xx, sum_xy, sum_yy], ...],  # prefix sums
+        'opt': [<optimal cost up to each point>, ...],
+        'back': [<start of the last segment ending at each point>, ...]
+    }
+    The prefix sums make the residual of any segment O(1) to compute.
+    Returns the state (a JSON-friendly dict)
+    """
+    state = {
+        'line_cost': line_cost,
+        'x': [],
+        'sums': [[0.0] * 5],
+        'opt': [],
+        'back': []
+    }
+    return extend_sls_state(state, series)
+
+def extend_sls_state(state, series):
+    """
+    Given a state from sls_state and a series of points that all come
+    after the points already in the state, extend the dynamic program by
+    those points.  The optimal costs of the existing points don't depend on
+    anything after them, so only the new points are computed.
+
+    Returns a new state
+    """
+    series = series.dropna()  # remove any NaN vals
+    line_cost = state['line_cost']
+    xs, opt, back = list(state['x']), list(state['opt']), list(state['back'])
+    sums = [list(row) for row in state['sums']]
+
+    for x, y in zip(series.index.values, series.values):
+        if xs and x <= xs[-1]:
+            raise ValueError('Can only append points after %s' % xs[-1])
+        x, y = float(x), float(y)
+        last = sums[-1]
+        sums.append([
+            last[0] + x, last[1] + y, last[2] + x * x,
+            last[3] + x * y, last[4] + y * y
+        ])
+        xs.append(x)
+
+        # residuals of the segments i..j for every start i
+        j = len(xs) - 1
+        arr = np.array(sums)
+        diffs = arr[j + 1] - arr[:j + 1]
+        num = np.arange(j + 1, 0, -1, dtype=float)
+        sx, sy, sxx, sxy, syy = diffs.T
+        var_x = sxx - sx * sx / num
+        cov = sxy - sx * sy / num
+        var_y = syy - sy * sy / num
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resid = np.where(var_x > 0, var_y - cov * cov / var_x, 0.0)
+        resid[num <= 2] = 0.0  # lines through 1 or 2 points fit exactly
+        resid = np.maximum(resid, 0.0)
+
+        vals = resid + line_cost + np.array([0.0] + opt)
+        min_index = int(np.argmin(vals))
+        opt.append(float(vals[min_index]))
+        back.append(min_index)
+
+    return {
+        'line_cost': line_cost,
+        'x': xs,
+        'sums': sums,
+        'opt': opt,
+        'back': back
+    }
+
+def sls_vertices(state):
+    """
+    Given a state from sls_state, unfurl the optimal segments backwards and
+    return the series indices of the endpoints of the lines
+    (the same output as segmented_least_squares)
+    """
+    back = state['back']
+    starts, j = [], len(back) - 1
+    while j >= 0:
+        starts.insert(0, back[j])
+        j = back[j] - 1
+    return [state['x'][i] for i in starts + [len(back) - 1]]
+
 def vertices2eqns(series, is_vertex):
     """
     Given a series and an equally long boolean array of whether or not each 
@@ -731,62 +2412,188 @@ def get_idx(array_like, idx):
     else:
         return array_like[idx]
 
-from classes import Trendline, TrendlinePoint
-def analyze(pix_datas, line_cost, target_date):
+from classes import Trendline, TRENDLINE_DTYPE, StageProfiler
+import time
+
+def env_profiler():
+    """
+    Returns a classes.StageProfiler timing every Nth call of analyze if
+    the settings.PROFILE_ENV environment variable is set to N, else None
+    """
+    every = os.environ.get(s.PROFILE_ENV)
+    return StageProfiler(int(every)) if every else None
+
+def profiled(profiler, stage, fn, *args):
+    """
+    Call fn with args, timing it as stage of profiler (if it isn't None)
+    """
+    if profiler is None:
+        return fn(*args)
+    start = time.time()
+    out = fn(*args)
+    profiler.record(stage, time.time() - start)
+    return out
+
+def analyze(pix_datas, line_cost, target_date, profiler=None,
+            spikes_marked=False):
     """
     Given data in the format:
     [
-        {'date': '2011-09-01', 'val': 160.0}, 
-        {'date': '2012-09-01', 'val': 180.0},
+        {'date': 2011244, 'val': 160.0}, 
+        {'date': 2012245, 'val': 180.0},
         ...
     ]
+    (dates are date codes - see date2code)
     Run a bunch of analysis on it to do change labeling
 
+    If a classes.StageProfiler is given, each stage of the calls it
+    samples is timed.
+
+    If spikes_marked, the winners' spikes were already found for a whole
+    tile at once (see mark_spikes) and aren't looked for again.
+
     Returns a Trendline
     """
+    if profiler is not None and not profiler.sample():
+        profiler = None  # not timing this one
+
     # pick winners
-    winners = pick_winners(pix_datas, target_date)
+    winners = profiled(
+        profiler, 'pick_winners', pick_winners, pix_datas, target_date)
 
     # convert to time series 
-    ts = dicts2timeseries(winners)
-    formatted_dates = [d.strftime('%Y-%m-%d') for d in ts.index]
+    ts = profiled(profiler, 'dicts2timeseries', dicts2timeseries, winners)
 
     # despike
-    despiked = despike(ts)
-    is_spike = pd.isnull(despiked)
+    if spikes_marked:
+        despiked = profiled(
+            profiler, 'despike', despike_marked, ts, winners)
+    else:
+        despiked = profiled(profiler, 'despike', despike, ts)
 
     # convert from time series to int series (for least squares)
-    int_series = timeseries2int_series(despiked)
+    int_series = profiled(
+        profiler, 'timeseries2int_series', timeseries2int_series, despiked)
+
+    # get vertices (skipping the search for series that can't have any
+    # besides their endpoints)
+    if profiled(profiler, 'classify_series',
+                classify_series, int_series, line_cost):
+        vertices = single_segment(int_series)
+    else:
+        vertices = profiled(
+            profiler, 'segmented_least_squares',
+            segmented_least_squares, int_series, line_cost)
+
+    return build_trendline(ts, despiked, int_series, vertices, profiler)
 
-    # get vertices
-    vertices = segmented_least_squares(int_series, line_cost)
+def analyze_cached(pix_datas, line_cost, target_date, label_rules, cache,
+                   profiler=None, spikes_marked=False):
+    """
+    Same as analyze followed by change_labeling, but looks the result up
+    in cache (a classes.LRUCache) first.  Pixels with the exact same
+    winners (dates and values) and line_cost share the same result.
+
+    Returns (Trendline, change labels)
+    """
+    winners = pick_winners(pix_datas, target_date)
+    key = (line_cost, tuple(sorted(
+        (as_datecode(d['date']), d['val']) for d in winners
+    )))
+    result = cache.get(key)
+    if result is None:
+        trendline = analyze(
+            winners, line_cost, target_date, profiler, spikes_marked)
+        result = (trendline, change_labeling(trendline, label_rules))
+        cache.put(key, result)
+    return result
+
+def build_trendline(ts, despiked, int_series, vertices, profiler=None):
+    """
+    Given the winners time series, its despiked version, the int series
+    used for least squares and the vertices found in it,
+    fit the regression lines and return a Trendline
+
+    (profiler, if given, times the stages - see analyze)
+    """
+    is_spike = pd.isnull(despiked)
     is_vertex = [x in vertices for x in int_series.index]
 
     # get least squares regression equations at each point
-    eqns_right = vertices2eqns(int_series, is_vertex)
+    eqns_right = profiled(
+        profiler, 'vertices2eqns', vertices2eqns, int_series, is_vertex)
 
     # calculate fitted values
-    vals_fit, eqns_fit = eqns2fitted_points(int_series, eqns_right)
-
-    outs = {
-        'val_raw': ts.values, 
-        'val_fit': vals_fit, 
-        'eqn_fit': eqns_fit,
-        'eqn_right': eqns_right,
-        'index_date': formatted_dates, 
-        'index_day': int_series.index, 
-        'spike': is_spike, 
-        'vertex': is_vertex
+    vals_fit, eqns_fit = profiled(
+        profiler, 'eqns2fitted_points',
+        eqns2fitted_points, int_series, eqns_right)
+
+    array = np.zeros(ts.size, dtype=TRENDLINE_DTYPE)
+    array['val_raw'] = ts.values
+    array['val_fit'] = vals_fit
+    array['eqn_fit'] = list(eqns_fit)
+    array['eqn_right'] = list(eqns_right)
+    array['index_date'] = ts.index
+    array['index_day'] = int_series.index
+    array['spike'] = is_spike
+    array['vertex'] = is_vertex
+    return Trendline(array)
+
+def analyze_incremental(pix_datas, line_cost, target_date, state=None):
+    """
+    Same as analyze, but also returns the pixel's fitting state so that
+    next year's observations can be appended without re-segmenting
+    the whole history.  The state is a JSON-friendly dict:
+    {
+        'winners': [{'date': 2011244, 'val': 160.0}, ...],
+        'spike': [False, ...],
+        'fit': <see sls_state>
     }
-    trendline_points = []
-    for i in range(ts.size):
-        kwargs = dict([
-            (key, get_idx(series, i)) 
-            for key, series in outs.iteritems()
-        ])
-        trendline_points.append(TrendlinePoint(**kwargs))
-    
-    return Trendline(trendline_points)
+
+    If a state from a previous run is passed in, pix_datas only needs
+    to contain the new observations.  The dynamic program is extended
+    when the old winners and spikes are unchanged by the new data,
+    otherwise it's recomputed from the stored winners.
+
+    Returns (Trendline, state)
+    """
+    old_winners = [
+        {'date': as_datecode(d['date']), 'val': d['val']}
+        for d in (state['winners'] if state else [])
+    ]
+    winners = pick_winners(old_winners + list(pix_datas), target_date)
+
+    ts = dicts2timeseries(winners)
+    despiked = despike(ts)
+    is_spike = [bool(x) for x in pd.isnull(despiked)]
+    int_series = timeseries2int_series(despiked)
+
+    sorted_winners = [
+        {'date': int(code), 'val': float(v)}
+        for code, v in zip(ts.index, ts.values)
+    ]
+
+    n_old = len(old_winners)
+    reusable = (
+        state is not None and
+        state['fit']['line_cost'] == line_cost and
+        sorted_winners[:n_old] == old_winners and
+        is_spike[:n_old] == state['spike']
+    )
+    if reusable:
+        fit = extend_sls_state(state['fit'], int_series.iloc[n_old:])
+    else:
+        fit = sls_state(int_series, line_cost)
+
+    # same shortcut as analyze, so both find the same vertices
+    if classify_series(int_series, line_cost):
+        vertices = single_segment(int_series)
+    else:
+        vertices = sls_vertices(fit)
+
+    trendline = build_trendline(ts, despiked, int_series, vertices)
+    new_state = {'winners': sorted_winners, 'spike': is_spike, 'fit': fit}
+    return trendline, new_state
 
 
 #######################
@@ -805,8 +2612,13 @@ def change_labeling(pix_trendline, label_rules):
             'duration': X
         }, ...
     }
+
+    Pixels that are mostly NODATA get no labels
     """
     labels = {}
+    if pix_trendline.mostly_nodata():
+        return labels
+
     for rule in label_rules:
         match = pix_trendline.match_rule(rule)
         if match:
@@ -818,3 +2630,479 @@ def change_labeling(pix_trendline, label_rules):
             }
 
     return labels
+
+def table2disturbances(table):
+    """
+    Given a vertex table array in the format [band, ...] with the bands
+    laid out as in Trendline.vertex_table, calculate the disturbance
+    between each pair of neighboring vertices.
+
+    Returns a dict of arrays in the format [vertex, ...]:
+        onset_year, initial_val, magnitude, duration and valid
+    (valid is False where either vertex is padding)
+    """
+    width = table.shape[0] / len(s.VERTEX_TABLE_FIELDS)
+    years, vals_fit = table[:width], table[width:2 * width]
+    valid = (years != s.NODATA)
+    return {
+        'onset_year': years[:-1],
+        'initial_val': vals_fit[:-1],
+        'magnitude': vals_fit[:-1] - vals_fit[1:],
+        'duration': years[1:] - years[:-1],
+        'valid': valid[:-1] & valid[1:]
+    }
+
+def change_labeling_table(table, label_rules):
+    """
+    Vectorized version of change_labeling.
+    Given a vertex table array (see table2disturbances) for any number of
+    pixels and a list of LabelRules, output arrays with the labels of every
+    pixel (NODATA where a pixel doesn't match):
+    {
+        <label_name>: {
+            'class_val': <array>,
+            'onset_year': <array>,
+            'magnitude': <array>,
+            'duration': <array>
+        }, ...
+    }
+    """
+    dists = table2disturbances(table)
+    out_shape = table.shape[1:]
+    num_dists = dists['valid'].shape[0]
+    flat = dict([(k, v.reshape(num_dists, -1)) for k, v in dists.iteritems()])
+    pix_idx = np.arange(flat['valid'].shape[1])
+
+    labels = {}
+    for rule in label_rules:
+        if not num_dists:  # a single year can't have any disturbances
+            labels[rule.name] = dict([
+                (k, np.ones(out_shape) * s.NODATA) for k in s.LABEL_KEYS
+            ])
+            continue
+
+        match = flat['valid'].copy()
+
+        if rule.onset_year:
+            qualifier, yr = rule.onset_year
+            if qualifier == '=':
+                match &= (flat['onset_year'] == yr)
+            elif qualifier == '<=':
+                match &= (flat['onset_year'] <= yr)
+            elif qualifier == '>=':
+                match &= (flat['onset_year'] >= yr)
+
+        if rule.duration:
+            qualifier, yr_length = rule.duration
+            if qualifier == '>':
+                match &= (flat['duration'] > yr_length)
+            elif qualifier == '<':
+                match &= (flat['duration'] < yr_length)
+
+        if rule.pre_threshold:
+            qualifier, threshold = rule.pre_threshold
+            if qualifier == '>':
+                match &= (flat['initial_val'] > threshold)
+            elif qualifier == '<':
+                match &= (flat['initial_val'] < threshold)
+
+        # pick winner by change type (first one wins ties, like match_rule)
+        if rule.change_type == 'FD':
+            winner = np.argmin(np.where(match, flat['onset_year'], np.inf), 0)
+        elif rule.change_type == 'GD':
+            winner = np.argmax(np.where(match, flat['magnitude'], -np.inf), 0)
+        elif rule.change_type == 'LD':
+            winner = np.argmax(np.where(match, flat['duration'], -np.inf), 0)
+        else:
+            winner = np.argmax(match, 0)
+
+        has_match = match.any(0)
+        rule_labels = {'class_val': np.where(has_match, rule.val, s.NODATA)}
+        for key in ['onset_year', 'magnitude', 'duration']:
+            rule_labels[key] = np.where(
+                has_match, flat[key][winner, pix_idx], s.NODATA)
+        labels[rule.name] = dict([
+            (k, v.reshape(out_shape)) for k, v in rule_labels.iteritems()
+        ])
+
+    return labels
+
+
+####################
+### Job Planning ###
+####################
+import math
+
+def time_analyze(num_years, line_cost, repeat=3):
+    """
+    Given a number of years and a line cost, return the seconds utils.analyze
+    takes (the fastest of repeat runs) on this machine for a noisy pixel
+    with a disturbance in the middle
+    """
+    rand = np.random.RandomState(0)
+    vals = 1000 + rand.normal(0, 20, num_years)
+    vals[num_years // 2:] -= 500
+    pix_datas = [
+        {'date': (2000 + i) * 1000 + 182, 'val': float(v)}
+        for i, v in enumerate(vals)
+    ]
+    target_date = parse_date('2000-07-01')
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        analyze(pix_datas, line_cost, target_date)
+        times.append(time.time() - start)
+    return min(times)
+
+def plan_memory(scene_meta, pixels, num_scenes, num_years, settings,
+                tile_size):
+    """
+    Given the header of one scene (see rast2meta), the number
+    of grid pixels, scenes and years, the job's settings and an output
+    tile size, return the estimated peak bytes of each kind of task in
+    the format {<stage>: <bytes>, ...}
+    """
+    num_eqn_bands = len(set(parse_eqn_bands(settings['index_eqn'])))
+    tile_pixels = tile_size * tile_size
+    if settings.get('stack_scenes'):
+        # [scene, y, x] cubes of each equation band, the index and the mask
+        parse = tile_pixels * num_scenes * 8 * (num_eqn_bands + 2)
+    else:
+        # a whole scene's equation bands, index and mask, plus the grid
+        scene_pixels = scene_meta['size'][0] * scene_meta['size'][1]
+        parse = (scene_pixels * 8 * (num_eqn_bands + 2) +
+                 pixels * s.PLAN_GRID_ROW_BYTES)
+    # ... but it reads windows that fit in its memory budget
+    parse = min(parse, max(memory_budget(settings) - s.PLAN_TASK_OVERHEAD,
+                           s.MIN_WINDOW_BUDGET))
+    cache_size = settings.get('analysis_cache_size', s.ANALYSIS_CACHE_SIZE)
+    analysis = cache_size * num_years * TRENDLINE_DTYPE.itemsize * 2
+    block = tile_pixels * (s.PLAN_PIXEL_BYTES + 8 * num_years)
+    output = tile_pixels * 8 * num_years  # one block at a time
+    return dict([
+        (stage, s.PLAN_TASK_OVERHEAD + int(bytes_))
+        for stage, bytes_ in [
+            ('parse_mapper', parse), ('analysis_reducer', analysis),
+            ('block_reducer', block), ('output_reducer', output)
+        ]
+    ])
+
+def plan_job(grid_meta, scene_meta, scenes, settings, pixels=None,
+             analyze_seconds=None, tile_size=s.OUT_TILE_SIZE):
+    """
+    Given the grid metadata of a job (see rast2meta), the header of one of
+    its scenes (also rast2meta), its scenes in the format
+    [(<keyname>, <archive bytes>), ...] and its settings, estimate what
+    running it takes before launching it.
+
+    pixels is the number of grid pixels that are sampled (defaults to the
+    whole grid) and analyze_seconds the seconds utils.analyze takes per
+    pixel (see time_analyze, defaults to PLAN_ANALYZE_SECONDS per year
+    squared - the segmented least squares is quadratic in the years).
+
+    Returns a dict in the format:
+    {
+        'pixels': X, 'scenes': X, 'years': X, 'archive_bytes': X,
+        'scenes_per_year': {'min': X, 'mean': X, 'max': X},
+        'shuffle_records': X, 'shuffle_bytes': X,
+        'memory': {<stage>: <peak bytes>, ...}, 'peak_memory': X,
+        'cpu_hours': {'sample': X, 'analyze': X, 'total': X},
+        'recommend': {'stack_scenes': X, 'tile_size': X, 'reducers': X,
+                      'instance_type': X}
+    }
+    """
+    if pixels is None:
+        pixels = grid_meta['size'][0] * grid_meta['size'][1]
+    per_year = {}
+    for keyname, _ in scenes:
+        year = filename2datecode(keyname) // 1000
+        per_year[year] = per_year.get(year, 0) + 1
+    num_scenes, num_years = len(scenes), len(per_year)
+    if analyze_seconds is None:
+        analyze_seconds = s.PLAN_ANALYZE_SECONDS * num_years ** 2
+
+    # size of one parse_mapper output line (point WKT, winner)
+    x, y = grid_meta['geotransform'][0], grid_meta['geotransform'][3]
+    record_bytes = len(json.dumps('POINT(%s %s)' % (x, y))) + len(
+        json.dumps({'date': 2000182, 'val': -1234.5678})) + 2
+
+    # parse_mapper emits every sampled pixel of every scene, or only each
+    # year's winner when stacking scenes (pruning only lowers the former)
+    scene_records = pixels * num_scenes
+    stack_records = pixels * num_years
+    stack = bool(settings.get('stack_scenes'))
+    records = stack_records if stack else scene_records
+
+    memory = plan_memory(
+        scene_meta, pixels, num_scenes, num_years, settings, tile_size)
+    peak_memory = max(memory.values())
+
+    cpu_hours = {
+        'sample': records * s.PLAN_SAMPLE_SECONDS / 3600.0,
+        'analyze': pixels * analyze_seconds / 3600.0
+    }
+    cpu_hours['total'] = cpu_hours['sample'] + cpu_hours['analyze']
+
+    # recommendations (tiles whose tasks fit in the memory budget, so a
+    # bigger budget never means smaller tiles)
+    task_memory = memory_budget(settings) + s.PLAN_TASK_OVERHEAD
+    tile_sizes = [
+        size for size in s.PLAN_TILE_SIZES
+        if max(plan_memory(scene_meta, pixels, num_scenes, num_years,
+                           settings, size).values()) <= task_memory
+    ]
+    reducers = max(
+        1,
+        int(math.ceil(records * record_bytes / float(s.PLAN_REDUCER_BYTES))),
+        int(math.ceil(cpu_hours['analyze'] / s.PLAN_REDUCER_HOURS))
+    )
+    instance_type = None
+    for name, memory_gb, vcpus in s.EMR_INSTANCE_TYPES:
+        if memory_gb * 2 ** 30 / vcpus >= peak_memory:
+            instance_type = name
+            break
+
+    return {
+        'pixels': pixels,
+        'scenes': num_scenes,
+        'years': num_years,
+        'archive_bytes': sum(size for _, size in scenes),
+        'scenes_per_year': {
+            'min': min(per_year.values()) if per_year else 0,
+            'mean': num_scenes / float(num_years) if num_years else 0,
+            'max': max(per_year.values()) if per_year else 0
+        },
+        'shuffle_records': records,
+        'shuffle_bytes': records * record_bytes,
+        'memory': memory,
+        'peak_memory': peak_memory,
+        'cpu_hours': cpu_hours,
+        'recommend': {
+            # stacking pays off when it at least halves the shuffle
+            'stack_scenes': (not settings.get('region') and
+                             stack_records * 2 <= scene_records),
+            'tile_size': max(tile_sizes) if tile_sizes else min(
+                s.PLAN_TILE_SIZES),
+            'reducers': reducers,
+            'instance_type': instance_type
+        }
+    }
+
+def plan_summary(plan):
+    """
+    Given a plan (see plan_job), return the lines of a readable summary
+    """
+    mb = float(2 ** 20)
+    rec = plan['recommend']
+    lines = [
+        'pixels: %d' % plan['pixels'],
+        'scenes: %d in %d years (%d-%d per year, %.1f mean), %.1f MB' % (
+            plan['scenes'], plan['years'], plan['scenes_per_year']['min'],
+            plan['scenes_per_year']['max'], plan['scenes_per_year']['mean'],
+            plan['archive_bytes'] / mb),
+        'shuffle: %d records, %.1f MB' % (
+            plan['shuffle_records'], plan['shuffle_bytes'] / mb),
+    ]
+    for stage, bytes_ in sorted(plan['memory'].iteritems()):
+        lines.append('peak memory of %s: %.0f MB' % (stage, bytes_ / mb))
+    lines += [
+        'cpu hours: %.2f (sampling %.2f, analysis %.2f)' % (
+            plan['cpu_hours']['total'], plan['cpu_hours']['sample'],
+            plan['cpu_hours']['analyze']),
+        'recommended stack_scenes: %s' % str(rec['stack_scenes']).lower(),
+        'recommended tile_size: %d' % rec['tile_size'],
+        'recommended reducers: %d' % rec['reducers'],
+        'recommended instance type: %s' % (
+            rec['instance_type'] or
+            'none fits %.0f MB per task - use a smaller tile_size' % (
+                plan['peak_memory'] / mb))
+    ]
+    return lines
+
+
+####################
+# Previews
+####################
+def preview_grid(meta, mask, step, num_tiles, tile_size, seed=0):
+    """
+    Given grid metadata, a boolean array of the grid's pixels to sample
+    (None for every pixel), a decimation step, a number of tiles and a
+    tile size, return the metadata and mask (see crop2mask) of a preview
+    grid: pixels step times as wide and high, each sampling the grid pixel
+    at its center, in a random sample of num_tiles of the grid's tiles
+    (every tile, if num_tiles is None)
+    """
+    num_pix_wide, num_pix_high = meta['size']
+    left_x, pix_width, x_rot, top_y, y_rot, pix_height = meta['geotransform']
+    size = [max(num_pix_wide // step, 1), max(num_pix_high // step, 1)]
+    preview_meta = dict(meta, size=size, geotransform=[
+        left_x, pix_width * step, x_rot, top_y, y_rot, pix_height * step
+    ])
+
+    # grid pixels at the centers of the preview pixels
+    cols = np.minimum(np.arange(size[0]) * step + step // 2, num_pix_wide - 1)
+    rows = np.minimum(np.arange(size[1]) * step + step // 2, num_pix_high - 1)
+    if mask is None:
+        preview_mask = np.ones((size[1], size[0]), dtype=bool)
+    else:
+        preview_mask = mask[np.ix_(rows, cols)]
+
+    # tiles of the original grid, so a sample covers as much ground at
+    # any step
+    tile_ids = ((cols // tile_size)[np.newaxis, :] * 1000000 +
+                (rows // tile_size)[:, np.newaxis])
+    tiles = np.unique(tile_ids[preview_mask])
+    if num_tiles and len(tiles) > num_tiles:
+        rand = np.random.RandomState(seed)
+        keep = rand.choice(tiles, num_tiles, replace=False)
+        preview_mask &= np.in1d(tile_ids, keep).reshape(preview_mask.shape)
+    return preview_meta, preview_mask
+
+def preview_windows(mask, step, tile_size):
+    """
+    Given the mask of a preview grid (see preview_grid), its decimation
+    step and the tile size of the grid it was made from, return the
+    windows of preview pixels that cover the mask in the format
+    [[<x start>, <y start>, <x end>, <y end>], ...], one per tile of the
+    original grid that has any (see preview_raster)
+    """
+    rows, cols = np.where(mask)
+    tile_ids = ((cols * step + step // 2) // tile_size * 1000000 +
+                (rows * step + step // 2) // tile_size)
+    windows = []
+    for tile_id in np.unique(tile_ids):
+        in_tile = (tile_ids == tile_id)
+        windows.append([
+            int(cols[in_tile].min()), int(rows[in_tile].min()),
+            int(cols[in_tile].max()) + 1, int(rows[in_tile].max()) + 1
+        ])
+    return windows
+
+def preview_raster(rast_fn, meta, out_fn):
+    """
+    Given a georeferenced raster on the grid a preview grid was made from
+    (or its own footprint of the same pixels), the preview grid's metadata
+    (with its 'step' and 'windows' under 'preview', see preview_windows)
+    and an output filename, write the raster's pixels at the centers of
+    the preview pixels to out_fn, on the preview grid.
+
+    Only the preview windows are read, at the preview's resolution (GDAL
+    picks the center pixel of each step x step block), and out_fn only
+    covers the preview pixels that are wholly on the raster.
+
+    Returns out_fn, or None if the raster doesn't overlap the preview
+    """
+    step = meta['preview']['step']
+    ds = gdal.Open(rast_fn)
+    left_x, pix_width, x_rot, top_y, y_rot, pix_height = ds.GetGeoTransform()
+    grid_left_x, grid_width, _, grid_top_y, _, grid_height = \
+        meta['geotransform']
+    num_pix_wide, num_pix_high = meta['size']
+
+    # the raster pixel at the preview grid's origin, and the preview
+    # pixels that are wholly on the raster
+    x_off = int(round((grid_left_x - left_x) / pix_width))
+    y_off = int(round((grid_top_y - top_y) / pix_height))
+    x0, y0 = max(-(x_off // step), 0), max(-(y_off // step), 0)
+    x1 = min((ds.RasterXSize - x_off) // step, num_pix_wide)
+    y1 = min((ds.RasterYSize - y_off) // step, num_pix_high)
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(
+        out_fn, x1 - x0, y1 - y0, ds.RasterCount,
+        ds.GetRasterBand(1).DataType
+    )
+    out_ds.SetGeoTransform([
+        grid_left_x + x0 * grid_width, grid_width, x_rot,
+        grid_top_y + y0 * grid_height, y_rot, grid_height
+    ])
+    out_ds.SetProjection(ds.GetProjection())
+    for b in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(b)
+        out_band = out_ds.GetRasterBand(b)
+        if band.GetNoDataValue() is not None:
+            out_band.SetNoDataValue(band.GetNoDataValue())
+        for win_x0, win_y0, win_x1, win_y1 in meta['preview']['windows']:
+            win_x0, win_y0 = max(win_x0, x0), max(win_y0, y0)
+            win_x1, win_y1 = min(win_x1, x1), min(win_y1, y1)
+            if win_x0 >= win_x1 or win_y0 >= win_y1:
+                continue
+            out_band.WriteArray(band.ReadAsArray(
+                x_off + win_x0 * step, y_off + win_y0 * step,
+                (win_x1 - win_x0) * step, (win_y1 - win_y0) * step,
+                win_x1 - win_x0, win_y1 - win_y0
+            ), win_x0 - x0, win_y0 - y0)
+    out_ds.FlushCache()
+    return out_fn
+
+def preview_summary(table, label_rules):
+    """
+    Given the vertex table (see table2disturbances) of a preview job and
+    a list of LabelRules, return statistics of its fitted pixels in the
+    format:
+    {
+        'pixels': <pixels with any vertices>,
+        'vertices': {<number of vertices>: <pixels>, ...},
+        'labels': {
+            <label_name>: {
+                'pixels': X,
+                'fraction': <of the fitted pixels>,
+                'magnitude': {<percentile>: X, ...},
+                'duration': {<percentile>: X, ...},
+                'onset_year': {<percentile>: X, ...}
+            }, ...
+        }
+    }
+    (at settings.PREVIEW_PERCENTILES, None where no pixel has the label)
+    """
+    width = table.shape[0] / len(s.VERTEX_TABLE_FIELDS)
+    num_vertices = (table[:width] != s.NODATA).sum(axis=0)
+    fitted = num_vertices > 0
+    num_fitted = int(fitted.sum())
+    vertices = dict([
+        (n, int(count))
+        for n, count in enumerate(np.bincount(num_vertices[fitted].ravel()))
+        if count
+    ])
+
+    labels = {}
+    for name, data in change_labeling_table(table, label_rules).iteritems():
+        labeled = fitted & (data['class_val'] != s.NODATA)
+        stats = {
+            'pixels': int(labeled.sum()),
+            'fraction': labeled.sum() / float(num_fitted) if num_fitted else 0.0
+        }
+        for key in ['magnitude', 'duration', 'onset_year']:
+            vals = data[key][labeled]
+            stats[key] = dict(zip(
+                s.PREVIEW_PERCENTILES,
+                [float(v) for v in np.percentile(vals, s.PREVIEW_PERCENTILES)]
+            )) if vals.size else None
+        labels[name] = stats
+    return {'pixels': num_fitted, 'vertices': vertices, 'labels': labels}
+
+def preview_report(summary):
+    """
+    Given a preview summary (see preview_summary), return the lines of
+    a readable report
+    """
+    num_fitted = summary['pixels']
+    lines = ['fitted pixels: %d' % num_fitted]
+    for n, count in sorted(summary['vertices'].iteritems(),
+                           key=lambda item: int(item[0])):
+        lines.append('%s vertices: %d pixels (%.1f%%)' % (
+            n, count, 100.0 * count / num_fitted))
+    header = ' / '.join('p%s' % p for p in s.PREVIEW_PERCENTILES)
+    for name, stats in sorted(summary['labels'].iteritems()):
+        lines.append('label %s: %d pixels (%.1f%% of fitted)' % (
+            name, stats['pixels'], 100.0 * stats['fraction']))
+        for key in ['magnitude', 'duration', 'onset_year']:
+            if stats[key] is None:
+                continue
+            # JSON round trips turn the percentiles in to strings
+            vals = dict([(int(p), v) for p, v in stats[key].iteritems()])
+            lines.append('    %s %s: %s' % (key, header, ' / '.join(
+                '%g' % vals[p] for p in s.PREVIEW_PERCENTILES)))
+    return lines